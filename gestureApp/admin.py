@@ -1,5 +1,15 @@
 from django.contrib import admin
-from .models import Subject, User, Experiment, Trial, Block, Keypress
+from .models import (
+    Subject,
+    User,
+    Experiment,
+    Trial,
+    Block,
+    Keypress,
+    Participation,
+    GroupAssignment,
+    TrialMetrics,
+)
 
 # Register your models here.
 from django.contrib.auth.admin import UserAdmin
@@ -12,4 +22,6 @@ admin.site.register(Trial, admin.ModelAdmin)
 admin.site.register(Block, admin.ModelAdmin)
 admin.site.register(Subject, admin.ModelAdmin)
 admin.site.register(Keypress, admin.ModelAdmin)
-
+admin.site.register(Participation, admin.ModelAdmin)
+admin.site.register(GroupAssignment, admin.ModelAdmin)
+admin.site.register(TrialMetrics, admin.ModelAdmin)
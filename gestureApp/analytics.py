@@ -0,0 +1,279 @@
+"""Summaries of the data of experiments and studies, to look at the results without downloading the data files.
+
+The learning curves summarize the processed data of an experiment for every subject and block. The study
+analytics summarize the stored trial metrics of every block of the experiments of a study, per group.
+"""
+
+import io
+import json
+import logging
+import tempfile
+from itertools import islice
+
+from django.db.models import Count, Max
+
+import numpy as np
+
+from . import processing
+from .models import Trial
+from .trial_metrics import TRIAL_METRICS_VERSION, rebuild_trial_metrics
+
+# Percentiles of the tapping speed of every block in the learning curves
+LEARNING_CURVE_PERCENTILES = [25, 50, 75]
+# Version of the study analytics calculated by study_analytics. Increase it whenever their output changes,
+#   so that cloud_process_data calculates the stored analytics again from scratch.
+STUDY_ANALYTICS_VERSION = "1"
+# Trial metrics summarized by the study analytics. Correct is 1 or 0, so its mean is the fraction of correct trials.
+STUDY_ANALYTICS_METRICS = ["correct", "execution_time_ms", "tapping_speed_mean"]
+# Number of rows fetched at a time from the database cursor
+CHUNK_SIZE = 2000
+
+
+def _optional_float(value):
+    """Converts a NumPy float into a float that can be sent as json, with None instead of NaN"""
+    return None if np.isnan(value) else float(value)
+
+
+def summarize_learning_curve(experiment, columns):
+    """Per-subject, per-block summary of the processed data of an experiment, to plot learning curves without
+    downloading the processed data: number of trials and correct trials, median and mean execution time of
+    the correct trials, and percentiles of their tapping speed.
+
+    Args:
+        experiment (Experiment): experiment to summarize
+        columns (dict): typed columns of the processed data of the experiment (see views.process_data_chunks),
+            or None if it has no data
+
+    Returns:
+        dict: experiment code and name, and the blocks of every subject in the order of the processed data
+    """
+    summary = {"code": experiment.code, "name": experiment.name, "subjects": []}
+    if columns is None:
+        return summary
+    block_ids = columns["block_id"]
+    # Groups of trials of the same subject and block, numbered in the order of the processed data
+    subject_index = processing.factorize(columns["subject_code"])
+    subject_blocks = subject_index * (block_ids.max() + 1) + block_ids
+    groups = processing.first_appearance_codes(subject_blocks) - 1
+    _, first_rows = np.unique(groups, return_index=True)
+    num_groups = len(first_rows)
+
+    num_trials = np.bincount(groups, minlength=num_groups)
+    correct_trials = np.bincount(
+        groups, weights=columns["correct_trial"], minlength=num_groups
+    )
+    execution_time_ms = columns["execution_time_ms"]
+    execution_time_median = processing.group_quantiles(
+        execution_time_ms, groups, num_groups, [0.5]
+    )[0]
+    execution_time_mean = processing.group_means(execution_time_ms, groups, num_groups)
+    tapping_speed = processing.group_quantiles(
+        columns["tapping_speed_mean"],
+        groups,
+        num_groups,
+        [percentile / 100 for percentile in LEARNING_CURVE_PERCENTILES],
+    )
+
+    subjects = {}
+    for group, row in enumerate(first_rows.tolist()):
+        subject_code = columns["subject_code"][row]
+        if subject_code not in subjects:
+            subjects[subject_code] = {"subject_code": subject_code, "blocks": []}
+        subjects[subject_code]["blocks"].append(
+            {
+                "block_id": int(block_ids[row]),
+                "block_sequence": columns["block_sequence"][row],
+                "num_trials": int(num_trials[group]),
+                "correct_trials": int(correct_trials[group]),
+                "execution_time_ms": {
+                    "median": _optional_float(execution_time_median[group]),
+                    "mean": _optional_float(execution_time_mean[group]),
+                },
+                "tapping_speed": {
+                    f"p{percentile}": _optional_float(values[group])
+                    for percentile, values in zip(
+                        LEARNING_CURVE_PERCENTILES, tapping_speed
+                    )
+                },
+            }
+        )
+    summary["subjects"] = list(subjects.values())
+    return summary
+
+
+def _experiment_analytics(experiment, previous=None):
+    """Summarizes the trials of an experiment for study_analytics, per block. See study_analytics.
+
+    Args:
+        experiment (Experiment): experiment to summarize
+        previous (dict, optional): previous summary of the experiment, to only add the trials saved since then
+
+    Returns:
+        dict: summary of the experiment
+    """
+    starting_date_useful_data = experiment.created_at
+    if experiment.published:
+        starting_date_useful_data = experiment.published_timestamp
+    # Stream the stored metrics of the trials instead of their keypresses
+    rebuild_trial_metrics(experiment)
+    trials = Trial.objects.filter(
+        block__experiment=experiment, started_at__gt=starting_date_useful_data
+    )
+    # Trials saved while the summary is being calculated are left for the next one
+    totals = trials.aggregate(last_trial_id=Max("id"), num_trials=Count("id"))
+    last_trial_id = totals["last_trial_id"] or 0
+    blocks = list(experiment.blocks.order_by("id").values_list("id", "sequence"))
+    block_ids = np.array([block for block, _ in blocks], dtype=np.int64)
+    shape = (len(STUDY_ANALYTICS_METRICS), len(blocks))
+    count = np.zeros(shape, dtype=np.int64)
+    mean = np.zeros(shape)
+    m2 = np.zeros(shape)
+
+    summary = {
+        "code": experiment.code,
+        "name": experiment.name,
+        "trials_after": starting_date_useful_data.isoformat(),
+        "last_trial_id": last_trial_id,
+        "num_trials": totals["num_trials"],
+    }
+    processed_trial_id = 0
+    # The previous summary can only be updated if no trial was saved with a lower id than its last trial
+    #   after it was calculated (see _new_subjects), and the experiment has the same blocks
+    if (
+        previous is not None
+        and previous["trials_after"] == summary["trials_after"]
+        and [block["id"] for block in previous["blocks"]] == block_ids.tolist()
+        and previous["last_trial_id"] <= last_trial_id
+        and trials.filter(id__lte=previous["last_trial_id"]).count()
+        == previous["num_trials"]
+    ):
+        if previous["last_trial_id"] == last_trial_id:
+            return previous
+        processed_trial_id = previous["last_trial_id"]
+        for i, block in enumerate(previous["blocks"]):
+            for m, metric in enumerate(STUDY_ANALYTICS_METRICS):
+                statistics = block[metric]
+                count[m, i] = statistics["count"]
+                mean[m, i] = statistics["mean"] or 0
+                m2[m, i] = statistics["m2"]
+
+    fields = [
+        metric if metric == "correct" else f"metrics__{metric}"
+        for metric in STUDY_ANALYTICS_METRICS
+    ]
+    rows = (
+        trials.filter(id__gt=processed_trial_id, id__lte=last_trial_id)
+        .order_by()
+        .values_list("block_id", *fields)
+        .iterator(chunk_size=CHUNK_SIZE)
+    )
+    while True:
+        chunk = list(islice(rows, CHUNK_SIZE))
+        if not chunk:
+            break
+        trial_blocks, *values = processing.rows_to_columns(
+            chunk, [np.int64] + [float] * len(STUDY_ANALYTICS_METRICS)
+        )
+        block_index = np.searchsorted(block_ids, trial_blocks)
+        for m, metric_values in enumerate(values):
+            count[m], mean[m], m2[m] = processing.welford_update(
+                count[m], mean[m], m2[m], block_index, metric_values
+            )
+
+    summary["blocks"] = []
+    for i, (block, sequence) in enumerate(blocks):
+        block_summary = {"id": block, "block_id": i + 1, "block_sequence": sequence}
+        for m, metric in enumerate(STUDY_ANALYTICS_METRICS):
+            n = int(count[m, i])
+            block_summary[metric] = {
+                "count": n,
+                "mean": float(mean[m, i]) if n > 0 else None,
+                "std": float(np.sqrt(m2[m, i] / (n - 1))) if n > 1 else None,
+                "m2": float(m2[m, i]),
+            }
+        summary["blocks"].append(block_summary)
+    return summary
+
+
+def study_analytics(study, previous=None):
+    """Summary statistics of every block of the experiments of a study, per group, to compare the groups of a
+    between-groups design without exporting every experiment. For each trial metric (see STUDY_ANALYTICS_METRICS),
+    it has the number of trials with a value, and their mean and sample standard deviation.
+    The trials are streamed from the database in chunks, and added to running (Welford) statistics, so the memory
+    used doesn't depend on the number of trials. The running statistics are kept in the summary ("m2" is the sum
+    of squared deviations from the mean), so a previous summary can be updated with only the newer trials.
+
+    Args:
+        study (Study): study to summarize
+        previous (dict, optional): previous summary of the study, to update instead of calculating it from scratch
+
+    Returns:
+        dict: study code and name, and the experiments of every group with the summary of each of their blocks.
+            Blocks are numbered in the order they are shown to subjects.
+    """
+    previous_experiments = {}
+    if previous is not None:
+        previous_experiments = {
+            experiment["code"]: experiment
+            for group in previous["groups"]
+            for experiment in group["experiments"]
+        }
+    groups = []
+    for group in study.groups.order_by("created_at", "code"):
+        experiments = group.experiments.order_by("created_at", "code")
+        groups.append(
+            {
+                "code": group.code,
+                "name": group.name,
+                "experiments": [
+                    _experiment_analytics(
+                        experiment, previous_experiments.get(experiment.code)
+                    )
+                    for experiment in experiments
+                ],
+            }
+        )
+    return {"code": study.code, "name": study.name, "groups": groups}
+
+
+def process_study_analytics(file_storage, study, rebuild):
+    """Calculates or updates the analytics of a published study (see study_analytics) in the file storage
+
+    Args:
+        file_storage (StorageBackend): file storage backend
+        study (Study): published study
+        rebuild (bool): whether to calculate the analytics from scratch
+
+    Returns:
+        str: "skipped" if the analytics were up to date, "updated" if new trials were added to them,
+            or "processed" if they were calculated from scratch
+    """
+    name = f"study_analytics/{study.code}.json"
+    metadata = {
+        "processing_version": STUDY_ANALYTICS_VERSION,
+        "trial_metrics_version": str(TRIAL_METRICS_VERSION),
+    }
+    stored_file = file_storage.get(name)
+    previous = None
+    if (
+        not rebuild
+        and stored_file is not None
+        and all(
+            stored_file.metadata.get(key) == value for key, value in metadata.items()
+        )
+    ):
+        with tempfile.TemporaryFile(mode="w+b") as f:
+            file_storage.download_to_file(name, f)
+            f.seek(0)
+            previous = json.load(f)
+    analytics = study_analytics(study, previous)
+    if analytics == previous:
+        logging.info(f"[{study.code}][study_analytics] Study already processed")
+        return "skipped"
+    file_storage.upload_file(
+        name,
+        io.BytesIO(json.dumps(analytics).encode("utf-8")),
+        content_type="application/json",
+        metadata=metadata,
+    )
+    return "processed" if previous is None else "updated"
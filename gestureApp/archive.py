@@ -0,0 +1,121 @@
+"""ZIP archives with the data files of every experiment of a study, streamed while they are written."""
+
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+import json
+import logging
+import zipfile
+
+from django.utils import timezone
+
+# Number of experiments whose files are prepared at the same time when exporting a study
+STUDY_ARCHIVE_WORKERS = 4
+# Size in bytes of each piece of the archive that is yielded
+ARCHIVE_CHUNK_SIZE = 1024 * 1024
+
+
+class _ArchiveStream:
+    """Non-seekable file that a ZIP archive is written to, keeping the written bytes until they are sent"""
+
+    def __init__(self):
+        self.chunks = []
+        self.size = 0
+
+    def write(self, data):
+        self.chunks.append(bytes(data))
+        self.size += len(data)
+        return len(data)
+
+    def flush(self):
+        pass
+
+    def pop(self):
+        """Returns the bytes written since the last call"""
+        data = b"".join(self.chunks)
+        self.chunks = []
+        self.size = 0
+        return data
+
+
+def study_archive(study, experiments, prepare_files, generate_files):
+    """Generator that writes a ZIP archive with the data files of the experiments of a study, plus a manifest.json
+    file that lists them, and yields its bytes as they are written.
+    The archive is never fully in memory nor in a temporary file. The files of the next experiments are
+    prepared by a pool of STUDY_ARCHIVE_WORKERS threads while the current one is written.
+
+    Args:
+        study (Study): exported study
+        experiments (list): experiments of the study to export, with their group
+        prepare_files (function): returns the files of an experiment that are prepared in a worker thread, as a list
+            with the name of each file, where its content comes from ("storage" or "generated"), and its bytes chunks
+        generate_files (function): returns the files of an experiment that are generated while they are written,
+            like prepare_files. They are added even if preparing the other files failed.
+
+    Yields:
+        bytes: pieces of the archive
+    """
+    manifest = {
+        "study": {"code": study.code, "name": study.name},
+        "created_at": timezone.now().isoformat(),
+        "experiments": [],
+    }
+    stream = _ArchiveStream()
+    remaining = iter(experiments)
+    pending = deque()
+    executor = ThreadPoolExecutor(max_workers=STUDY_ARCHIVE_WORKERS)
+
+    def submit_next():
+        experiment = next(remaining, None)
+        if experiment is not None:
+            pending.append(
+                (
+                    experiment,
+                    executor.submit(prepare_files, experiment),
+                )
+            )
+
+    try:
+        # Only a few experiments are prepared ahead of the one being written, so their files don't pile up
+        for _ in range(2 * STUDY_ARCHIVE_WORKERS):
+            submit_next()
+        with zipfile.ZipFile(stream, "w", compression=zipfile.ZIP_DEFLATED) as archive:
+            while pending:
+                experiment, job = pending.popleft()
+                submit_next()
+                folder = f"{experiment.group.code}/{experiment.code}"
+                experiment_manifest = {
+                    "code": experiment.code,
+                    "name": experiment.name,
+                    "group": {
+                        "code": experiment.group.code,
+                        "name": experiment.group.name,
+                    },
+                    "published": experiment.published,
+                    "files": [],
+                }
+                manifest["experiments"].append(experiment_manifest)
+                try:
+                    files = job.result()
+                except Exception as e:
+                    logging.error(f"[{experiment.code}][study_archive] Failed: {e}")
+                    experiment_manifest["error"] = str(e)
+                    files = []
+                files += generate_files(experiment)
+                for file_name, source, chunks in files:
+                    name = f"{folder}/{file_name}.csv"
+                    size = 0
+                    # Files can be larger than 4 GB, and their size is not known beforehand
+                    with archive.open(name, "w", force_zip64=True) as entry:
+                        for chunk in chunks:
+                            entry.write(chunk)
+                            size += len(chunk)
+                            if stream.size >= ARCHIVE_CHUNK_SIZE:
+                                yield stream.pop()
+                    experiment_manifest["files"].append(
+                        {"name": name, "source": source, "size": size}
+                    )
+            archive.writestr("manifest.json", json.dumps(manifest, indent=2))
+        yield stream.pop()
+    finally:
+        # Stop preparing files if the download is interrupted
+        executor.shutdown(wait=True, cancel_futures=True)
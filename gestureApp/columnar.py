@@ -0,0 +1,216 @@
+"""Typed columnar versions of the data files, which load much faster than csv files in pandas or MATLAB.
+
+Data is written as Parquet or Arrow IPC files when pyarrow is installed, and always as NumPy .npz files, which
+only need NumPy to be read. Columns are the same as in the csv files, with their own types: timestamps are int64
+microseconds since the epoch, instead of strings. Missing values are nulls in Parquet and Arrow files. In .npz
+files, they are NaN in float columns, processing.MISSING_TIMESTAMP in int64 columns and empty strings in text columns.
+
+Columns are handled as dictionaries of NumPy arrays, where text columns are object arrays that can contain None.
+"""
+
+import numpy as np
+
+from . import processing
+
+try:
+    import pyarrow as pa
+    import pyarrow.parquet as pq
+except ImportError:
+    pa = None
+
+# Content type of each columnar format, which is also the extension of its files
+CONTENT_TYPES = {
+    "parquet": "application/vnd.apache.parquet",
+    "arrow": "application/vnd.apache.arrow.file",
+    "npz": "application/octet-stream",
+}
+# Formats written with pyarrow
+ARROW_FORMATS = ["parquet", "arrow"]
+# Number of rows read at a time from Parquet and Arrow files
+READ_BATCH_SIZE = 65536
+
+
+def available_formats():
+    """Columnar formats that can be written with the installed packages
+
+    Returns:
+        list: format names
+    """
+    return [
+        file_format
+        for file_format in CONTENT_TYPES
+        if pa is not None or file_format not in ARROW_FORMATS
+    ]
+
+
+def concatenate(chunks):
+    """Joins several chunks of the same columns into one
+
+    Args:
+        chunks (list): dictionaries of columns
+
+    Returns:
+        dict: concatenated columns, or an empty dictionary if there were no chunks
+    """
+    if not chunks:
+        return {}
+    return {
+        name: np.concatenate([chunk[name] for chunk in chunks]) for name in chunks[0]
+    }
+
+
+def _to_arrow(values):
+    """Converts a column into an Arrow array, turning missing values into nulls"""
+    if values.dtype.kind in "OU":
+        return pa.array(values.tolist(), type=pa.string())
+    if values.dtype.kind == "f":
+        return pa.array(values, mask=np.isnan(values))
+    if values.dtype.kind == "i":
+        return pa.array(
+            values.astype(np.int64), mask=values == processing.MISSING_TIMESTAMP
+        )
+    return pa.array(values)
+
+
+def _from_arrow(values):
+    """Converts an Arrow column back into a NumPy column, the inverse of _to_arrow"""
+    if pa.types.is_string(values.type):
+        return np.array(values.to_pylist(), dtype=object)
+    if pa.types.is_floating(values.type):
+        return values.fill_null(np.nan).to_numpy()
+    if pa.types.is_integer(values.type):
+        return values.fill_null(processing.MISSING_TIMESTAMP).to_numpy()
+    return values.to_numpy(zero_copy_only=False)
+
+
+def _to_npz(values):
+    """Converts a column into an array that can be saved without pickling, with empty strings for None"""
+    if values.dtype.kind == "O":
+        return np.array(["" if value is None else value for value in values], dtype=str)
+    return values
+
+
+def _from_npz(values):
+    """Converts a column of a .npz file back into a NumPy column, the inverse of _to_npz"""
+    if values.dtype.kind == "U":
+        values = values.astype(object)
+        values[values == ""] = None
+    return values
+
+
+class ColumnarWriter:
+    """Writes chunks of columns into a file in one of the columnar formats.
+    Parquet and Arrow files are written a chunk at a time. The .npz format can only save whole arrays, so
+    its chunks are kept in memory until the writer is closed.
+    """
+
+    def __init__(self, file, file_format):
+        """
+        Args:
+            file (file): binary file to write to
+            file_format (str): one of available_formats()
+        """
+        self.file = file
+        self.file_format = file_format
+        self.writer = None
+        self.chunks = []
+
+    def write(self, columns):
+        """Writes a chunk of columns. Every chunk must have the same columns."""
+        if self.file_format == "npz":
+            self.chunks.append(
+                {name: _to_npz(values) for name, values in columns.items()}
+            )
+            return
+        table = pa.table({name: _to_arrow(values) for name, values in columns.items()})
+        if self.writer is None:
+            if self.file_format == "parquet":
+                self.writer = pq.ParquetWriter(self.file, table.schema)
+            else:
+                self.writer = pa.ipc.new_file(self.file, table.schema)
+        self.writer.write_table(table)
+
+    def close(self):
+        """Finishes the file. A file without chunks has no columns."""
+        if self.file_format == "npz":
+            np.savez(self.file, **concatenate(self.chunks))
+            self.chunks = []
+            return
+        if self.writer is None:
+            self.write({})
+        self.writer.close()
+
+
+def read_batches(file, file_format):
+    """Generator that reads a columnar file in batches of rows
+
+    Args:
+        file (file): binary file to read from
+        file_format (str): one of available_formats()
+
+    Yields:
+        dict: columns of each batch
+    """
+    if file_format == "npz":
+        with np.load(file, allow_pickle=False) as data:
+            if data.files:
+                yield {name: _from_npz(data[name]) for name in data.files}
+        return
+    if file_format == "parquet":
+        batches = pq.ParquetFile(file).iter_batches(batch_size=READ_BATCH_SIZE)
+    else:
+        reader = pa.ipc.open_file(file)
+        batches = (reader.get_batch(i) for i in range(reader.num_record_batches))
+    for batch in batches:
+        if batch.num_rows > 0:
+            yield {
+                name: _from_arrow(column)
+                for name, column in zip(batch.schema.names, batch.columns)
+            }
+
+
+def merge_subject_batches(stored_batches, new_columns, subjects_starting_timestamp):
+    """Generator that merges the rows of new subjects into the batches of a stored file, keeping the rows ordered
+    by the time each subject started the experiment. Rows are placed like in the csv files (see
+    views._merge_csv_rows): new rows go right before the first stored row of a subject that started later.
+
+    Args:
+        stored_batches (iterable): column batches of the stored file, ordered by subject starting time
+        new_columns (dict): columns of the new subjects, ordered by subject starting time
+        subjects_starting_timestamp (dict): timestamp at which every subject started the experiment
+
+    Yields:
+        dict: merged column batches
+    """
+
+    def starting_times(columns):
+        return np.array(
+            [
+                processing.to_microseconds(subjects_starting_timestamp[subject])
+                for subject in columns["subject_code"]
+            ],
+            dtype=np.int64,
+        )
+
+    new_started_at = starting_times(new_columns) if new_columns else None
+    for batch in stored_batches:
+        if new_started_at is None or len(new_started_at) == 0:
+            yield batch
+            continue
+        batch_started_at = starting_times(batch)
+        # New rows that go before some row of this batch. The rest go after it.
+        num_before = np.searchsorted(new_started_at, batch_started_at[-1], side="left")
+        # A stable sort keeps the stored rows first when subjects started at the same time
+        order = np.argsort(
+            np.r_[batch_started_at, new_started_at[:num_before]], kind="stable"
+        )
+        yield {
+            name: np.concatenate((values, new_columns[name][:num_before]))[order]
+            for name, values in batch.items()
+        }
+        new_columns = {
+            name: values[num_before:] for name, values in new_columns.items()
+        }
+        new_started_at = new_started_at[num_before:]
+    if new_columns and len(new_started_at) > 0:
+        yield new_columns
@@ -0,0 +1,148 @@
+"""Opt-in instrumentation of the requests served by the app, enabled with the REQUEST_METRICS setting.
+
+For each request, RequestMetricsMiddleware records the number of SQL queries and the time spent running them,
+the time spent in file storage calls (Google Cloud Storage in production) and the total latency. Requests slower
+than REQUEST_METRICS_SLOW_MS are logged with their most repeated SQL statements, which usually point to N+1
+query patterns. The latest requests of each view are kept in memory, to report percentiles per view.
+
+Only the work done in the thread of the request is measured: queries and storage calls made by worker threads,
+or while a streaming response is being sent, are not included. Metrics are kept per process.
+"""
+
+from collections import Counter, deque
+from contextlib import contextmanager
+import contextvars
+import logging
+import threading
+import time
+
+from django.conf import settings
+from django.core.exceptions import MiddlewareNotUsed
+from django.db import connection
+
+import numpy as np
+
+# Number of latest requests of each view used to calculate the percentiles
+SAMPLES_PER_VIEW = 1000
+# Number of repeated SQL statements logged for a slow request
+LOGGED_STATEMENTS = 5
+PERCENTILES = [50, 90, 99]
+
+# Metrics of the request being served, if the middleware is enabled
+_current_metrics = contextvars.ContextVar("request_metrics", default=None)
+# Latest metrics of each view
+_view_samples = {}
+_view_requests = Counter()
+_lock = threading.Lock()
+
+
+class RequestMetrics:
+    """Metrics of a single request. Also works as a database execution wrapper that measures every query."""
+
+    def __init__(self):
+        self.queries = 0
+        self.db_seconds = 0.0
+        self.storage_seconds = 0.0
+        self.statements = Counter()
+
+    def __call__(self, execute, sql, params, many, context):
+        start = time.perf_counter()
+        try:
+            return execute(sql, params, many, context)
+        finally:
+            self.db_seconds += time.perf_counter() - start
+            self.queries += 1
+            # Parameters are left out, so that the same statement with different values is counted together
+            self.statements[sql] += 1
+
+
+@contextmanager
+def storage_call():
+    """Adds the time spent inside the block to the storage time of the current request, if it is measured"""
+    start = time.perf_counter()
+    try:
+        yield
+    finally:
+        metrics = _current_metrics.get()
+        if metrics is not None:
+            metrics.storage_seconds += time.perf_counter() - start
+
+
+def _record(view_name, seconds, metrics):
+    """Saves the metrics of a request in the samples of its view"""
+    sample = (
+        seconds * 1000,
+        metrics.queries,
+        metrics.db_seconds * 1000,
+        metrics.storage_seconds * 1000,
+    )
+    with _lock:
+        if view_name not in _view_samples:
+            _view_samples[view_name] = deque(maxlen=SAMPLES_PER_VIEW)
+        _view_samples[view_name].append(sample)
+        _view_requests[view_name] += 1
+
+
+def view_percentiles():
+    """Percentiles of the latest requests of each view
+
+    Returns:
+        dict: for each view name, its number of requests since the process started, and the percentiles
+            of the latency, number of queries, database time and storage time (in milliseconds)
+    """
+    with _lock:
+        samples = {view: np.array(s) for view, s in _view_samples.items()}
+        requests = dict(_view_requests)
+    percentiles = {}
+    for view, view_samples in sorted(samples.items()):
+        values = np.percentile(view_samples, PERCENTILES, axis=0)
+        percentiles[view] = {"requests": requests[view]}
+        for i, metric in enumerate(["latency_ms", "queries", "db_ms", "storage_ms"]):
+            percentiles[view][metric] = {
+                f"p{percentile}": round(float(value), 3)
+                for percentile, value in zip(PERCENTILES, values[:, i])
+            }
+            percentiles[view][metric]["max"] = round(float(view_samples[:, i].max()), 3)
+    return percentiles
+
+
+class RequestMetricsMiddleware:
+    """Measures every request, if the REQUEST_METRICS setting is enabled"""
+
+    def __init__(self, get_response):
+        if not settings.REQUEST_METRICS:
+            raise MiddlewareNotUsed
+        self.get_response = get_response
+
+    def __call__(self, request):
+        metrics = RequestMetrics()
+        token = _current_metrics.set(metrics)
+        start = time.perf_counter()
+        try:
+            with connection.execute_wrapper(metrics):
+                response = self.get_response(request)
+        finally:
+            _current_metrics.reset(token)
+        seconds = time.perf_counter() - start
+
+        view_name = "unresolved"
+        if request.resolver_match is not None:
+            view_name = request.resolver_match.view_name
+        _record(view_name, seconds, metrics)
+        if seconds * 1000 >= settings.REQUEST_METRICS_SLOW_MS:
+            repeated_statements = "".join(
+                f"\n  {count}x {sql}"
+                for sql, count in metrics.statements.most_common(LOGGED_STATEMENTS)
+                if count > 1
+            )
+            logging.warning(
+                f"[{view_name}] Slow request to {request.path}: {seconds * 1000:.0f} ms, "
+                f"{metrics.queries} queries in {metrics.db_seconds * 1000:.0f} ms, "
+                f"{metrics.storage_seconds * 1000:.0f} ms in storage calls"
+                + (
+                    f". Repeated statements:{repeated_statements}"
+                    if repeated_statements
+                    else ""
+                )
+            )
+        return response
@@ -0,0 +1,33 @@
+from django.core.management.base import BaseCommand
+
+from gestureApp.models import Experiment
+from gestureApp.trial_metrics import rebuild_trial_metrics
+
+
+class Command(BaseCommand):
+    help = """Calculates the stored metrics of the trials that don't have them yet, or whose metrics were
+    calculated by an older version of the app, so that process_data can read them instead of the keypresses"""
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            "experiments",
+            nargs="*",
+            help="Codes of the experiments to backfill. Defaults to all experiments.",
+        )
+        parser.add_argument(
+            "--all",
+            action="store_true",
+            help="Calculate the metrics of every trial again, even if they are up to date",
+        )
+
+    def handle(self, *args, **options):
+        experiments = Experiment.objects.all()
+        if options["experiments"]:
+            experiments = experiments.filter(code__in=options["experiments"])
+        for experiment in experiments:
+            num_subjects = rebuild_trial_metrics(
+                experiment, outdated_only=not options["all"]
+            )
+            self.stdout.write(
+                f"{experiment.code}: trial metrics of {num_subjects} subjects calculated"
+            )
@@ -0,0 +1,200 @@
+import json
+import statistics
+import subprocess
+import time
+import tracemalloc
+import uuid
+
+from django.conf import settings
+from django.core.management.base import BaseCommand
+from django.db import connection
+from django.test import RequestFactory
+from django.utils import timezone
+
+from gestureApp import trial_metrics, views
+from gestureApp.models import Subject, Trial, User
+from gestureApp.synthetic_data import generate_experiment, subject_performance
+
+
+def measure(function, repeat):
+    """Runs a benchmark function several times, measuring it
+
+    Args:
+        function (callable): function to measure, without arguments
+        repeat (int): number of timed runs
+
+    Returns:
+        tuple: wall time in seconds of each run, queries per run, and peak memory in bytes allocated by Python
+    """
+    times = []
+    query_counter = views.QueryCounter()
+    for _ in range(repeat):
+        with connection.execute_wrapper(query_counter):
+            start = time.perf_counter()
+            function()
+            times.append(time.perf_counter() - start)
+    # Memory is traced in a separate run, as tracing slows the function down
+    tracemalloc.start()
+    try:
+        function()
+        _, peak_memory = tracemalloc.get_traced_memory()
+    finally:
+        tracemalloc.stop()
+    return times, query_counter.count // repeat, peak_memory
+
+
+def current_commit():
+    """Returns the commit of the code being measured, or None if it is not in a git repository"""
+    try:
+        result = subprocess.run(
+            ["git", "rev-parse", "HEAD"],
+            cwd=settings.BASE_DIR,
+            capture_output=True,
+            text=True,
+        )
+    except OSError:
+        return None
+    return result.stdout.strip() or None
+
+
+class Command(BaseCommand):
+    help = """Measures the wall time, peak memory and number of queries of raw_data, process_data,
+    download_survey and create_trials on synthetic experiments of several sizes, and writes the results as json.
+    The synthetic data is created in the database given by DATABASE_URL, and deleted at the end."""
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            "--sizes",
+            type=int,
+            nargs="+",
+            default=[10, 50, 200],
+            help="Number of subjects of each synthetic experiment",
+        )
+        parser.add_argument("--blocks", type=int, default=4)
+        parser.add_argument("--trials", type=int, default=20, help="Trials per block")
+        parser.add_argument(
+            "--repeat", type=int, default=3, help="Timed runs of each benchmark"
+        )
+        parser.add_argument("--seed", type=int, default=0)
+        parser.add_argument("--output", default="benchmark.json")
+        parser.add_argument(
+            "--compare", help="Results of a previous run to compare these ones with"
+        )
+        parser.add_argument(
+            "--keep", action="store_true", help="Don't delete the synthetic data"
+        )
+
+    def benchmarks(self, experiment):
+        """Functions to measure on an experiment"""
+        user = experiment.creator
+        request_factory = RequestFactory()
+
+        def raw_data():
+            for _ in views.raw_data(user, experiment.code):
+                pass
+
+        def process_data():
+            for _ in views.process_data(user, experiment.code):
+                pass
+
+        def download_survey():
+            request = request_factory.get("/")
+            request.user = user
+            response = views.download_survey(request, experiment.code)
+            for _ in response.streaming_content if response.streaming else [response]:
+                pass
+
+        def create_trials():
+            body = json.dumps(subject_performance(experiment))
+            views.create_trials(
+                request_factory.post("/", body, content_type="application/json")
+            )
+
+        # create_trials goes last, as it adds subjects to the experiment
+        return [
+            ("raw_data", raw_data),
+            ("process_data", process_data),
+            ("download_survey", download_survey),
+            ("create_trials", create_trials),
+        ]
+
+    def handle(self, *args, **options):
+        user = User.objects.create(username=f"benchmark-{uuid.uuid4().hex[:8]}")
+        results = []
+        try:
+            for num_subjects in options["sizes"]:
+                experiment = generate_experiment(
+                    user,
+                    num_subjects,
+                    options["blocks"],
+                    options["trials"],
+                    seed=options["seed"],
+                )
+                trials = Trial.objects.filter(block__experiment=experiment)
+                size = {
+                    "subjects": num_subjects,
+                    "trials": trials.count(),
+                    "keypresses": len(trial_metrics.load_keypresses(trials, False)[0]),
+                }
+                for name, function in self.benchmarks(experiment):
+                    times, queries, peak_memory = measure(function, options["repeat"])
+                    results.append(
+                        {
+                            "benchmark": name,
+                            **size,
+                            "seconds": statistics.median(times),
+                            "runs": times,
+                            "queries": queries,
+                            "peak_memory_bytes": peak_memory,
+                        }
+                    )
+                    self.stdout.write(
+                        f"{name:>16} {num_subjects:>6} subjects: {statistics.median(times):8.3f} s "
+                        f"{queries:6} queries {peak_memory / 2 ** 20:8.1f} MiB"
+                    )
+        finally:
+            if not options["keep"]:
+                subjects = list(
+                    Subject.objects.filter(
+                        participations__experiment__creator=user
+                    ).values_list("code", flat=True)
+                )
+                user.delete()
+                Subject.objects.filter(code__in=subjects).delete()
+
+        output = {
+            "commit": current_commit(),
+            "created_at": timezone.now().isoformat(),
+            "database": connection.vendor,
+            "packed_keypresses": settings.PACKED_KEYPRESSES,
+            "blocks": options["blocks"],
+            "trials_per_block": options["trials"],
+            "repeat": options["repeat"],
+            "results": results,
+        }
+        with open(options["output"], "w") as f:
+            json.dump(output, f, indent=2)
+        self.stdout.write(f"Results saved in {options['output']}")
+        if options["compare"]:
+            self.compare(options["compare"], results)
+
+    def compare(self, file_name, results):
+        """Prints the changes between the results of a previous run and the current ones"""
+        with open(file_name) as f:
+            previous = json.load(f)
+        self.stdout.write(
+            self.style.MIGRATE_HEADING(f"\nCompared with {previous['commit']}")
+        )
+        previous_results = {
+            (r["benchmark"], r["subjects"]): r for r in previous["results"]
+        }
+        for result in results:
+            before = previous_results.get((result["benchmark"], result["subjects"]))
+            if before is None:
+                continue
+            self.stdout.write(
+                f"{result['benchmark']:>16} {result['subjects']:>6} subjects: "
+                f"time x{result['seconds'] / before['seconds']:.2f}, "
+                f"queries {before['queries']} -> {result['queries']}, "
+                f"memory x{result['peak_memory_bytes'] / before['peak_memory_bytes']:.2f}"
+            )
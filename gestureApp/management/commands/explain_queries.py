@@ -0,0 +1,167 @@
+from django.core.management.base import BaseCommand, CommandError
+from django.db import connection, transaction
+from django.db.models import Count, F, Max, Min, Q
+from django.db.models.functions import Coalesce
+
+from gestureApp.models import Block, Experiment, Keypress, Subject, Trial, User
+from gestureApp.synthetic_data import generate_experiment
+from gestureApp.views import EXPORT_TRIALS_PER_CHUNK
+
+# Indexes added by migration 0040 for these queries
+QUERY_INDEXES = [
+    "keypress_trial_time_idx",
+    "trial_block_subject_start_idx",
+    "trial_subject_start_idx",
+]
+
+
+class Command(BaseCommand):
+    help = """Prints the query plans of the export and participation queries of an experiment.
+    With --subjects, the experiment is generated with synthetic data first. With --compare, the plans
+    are also printed without the indexes of migration 0040. Generated data and dropped indexes are
+    rolled back when the command ends."""
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            "--experiment",
+            help="Code of the experiment to use. Defaults to the one with the most trials.",
+        )
+        parser.add_argument(
+            "--subjects",
+            type=int,
+            help="Generate an experiment with this number of synthetic subjects to explain the queries with",
+        )
+        parser.add_argument("--blocks", type=int, default=4)
+        parser.add_argument("--trials", type=int, default=20, help="Trials per block")
+        parser.add_argument(
+            "--seed", type=int, help="Seed to generate the same data again"
+        )
+        parser.add_argument(
+            "--compare",
+            action="store_true",
+            help="Also print the plans without the indexes of migration 0040. The tables are locked "
+            "until the command ends, so don't use it on a database that is in use.",
+        )
+        parser.add_argument(
+            "--analyze",
+            action="store_true",
+            help="Run the queries and show the real timings (PostgreSQL only)",
+        )
+
+    def handle(self, *args, **options):
+        with transaction.atomic():
+            self.explain_queries(options)
+            transaction.set_rollback(True)
+
+    def explain_queries(self, options):
+        if options["subjects"]:
+            user, _ = User.objects.get_or_create(username="synthetic")
+            experiment = generate_experiment(
+                user,
+                options["subjects"],
+                options["blocks"],
+                options["trials"],
+                seed=options["seed"],
+            )
+            with connection.cursor() as cursor:
+                # Statistics of the new rows for the query planner
+                cursor.execute("ANALYZE")
+        elif options["experiment"]:
+            experiment = Experiment.objects.filter(pk=options["experiment"]).first()
+        else:
+            experiment = (
+                Experiment.objects.annotate(num_trials=Count("blocks__trials"))
+                .order_by("-num_trials")
+                .first()
+            )
+        if experiment is None:
+            raise CommandError("There is no experiment to explain the queries with")
+        starting_date_useful_data = experiment.created_at
+        if experiment.published:
+            starting_date_useful_data = experiment.published_timestamp
+        trials = Trial.objects.filter(
+            block__experiment=experiment, started_at__gt=starting_date_useful_data
+        )
+        subject = Subject.objects.filter(trials__block__experiment=experiment).first()
+        chunk_trial_ids = list(
+            trials.order_by("id").values_list("id", flat=True)[:EXPORT_TRIALS_PER_CHUNK]
+        )
+        useful_trials = Q(blocks__trials__started_at__gt=F("published_timestamp"))
+
+        queries = {
+            # Trials of raw_data, ordered by their first keypress
+            "raw_data trials": trials.annotate(
+                first_keypress_at=Coalesce(
+                    Min("keypresses__timestamp"), "packed_first_keypress_at"
+                )
+            )
+            .order_by("first_keypress_at", "block_id", "id")
+            .values_list("id", "block_id", "subject_id", "correct", "partial_correct"),
+            # Keypresses of a chunk of trials in raw_data
+            "raw_data keypresses": Keypress.objects.filter(trial_id__in=chunk_trial_ids)
+            .order_by()
+            .values_list("trial_id", "timestamp", "value"),
+            # Keypresses of every trial in process_data
+            "process_data keypresses": Keypress.objects.filter(
+                trial__block__experiment=experiment
+            )
+            .order_by()
+            .values_list("trial_id", "timestamp"),
+            "subjects starting timestamps": Subject.objects.filter(
+                trials__block__experiment=experiment,
+                trials__started_at__gt=starting_date_useful_data,
+            )
+            .annotate(first_trial_started_at=Min("trials__started_at"))
+            .values_list("code", "first_trial_started_at"),
+            "num_responses": Subject.objects.filter(
+                trials__block__experiment=experiment,
+                trials__started_at__gt=starting_date_useful_data,
+            ).distinct(),
+            "has_done_experiment": experiment.blocks.filter(trials__subject=subject),
+            "experiment view trials": Trial.objects.filter(
+                block__experiment=experiment, subject=subject
+            ).order_by("started_at"),
+            "cloud_process_data watermarks": Experiment.objects.filter(
+                published=True
+            ).annotate(
+                last_trial_id=Max("blocks__trials__id", filter=useful_trials),
+                num_trials=Count("blocks__trials", filter=useful_trials),
+            ),
+            "block order": Block.objects.filter(
+                experiment=experiment, trials__started_at__gt=starting_date_useful_data
+            )
+            .annotate(
+                first_timestamp=Min(
+                    Coalesce(
+                        "trials__keypresses__timestamp",
+                        "trials__packed_first_keypress_at",
+                    )
+                )
+            )
+            .order_by("first_timestamp", "id")
+            .values_list("id", flat=True),
+        }
+        explain_options = {"analyze": True} if options["analyze"] else {}
+        self.stdout.write(
+            f"Experiment {experiment.code}: {trials.count()} trials, "
+            f"{Keypress.objects.filter(trial__in=trials).count()} keypresses"
+        )
+        if options["compare"]:
+            savepoint = transaction.savepoint()
+            with connection.cursor() as cursor:
+                for index in QUERY_INDEXES:
+                    cursor.execute(f"DROP INDEX {connection.ops.quote_name(index)}")
+            self.stdout.write(
+                self.style.MIGRATE_HEADING("\nWithout the indexes of migration 0040")
+            )
+            self.explain(queries, explain_options)
+            transaction.savepoint_rollback(savepoint)
+            self.stdout.write(
+                self.style.MIGRATE_HEADING("\nWith the indexes of migration 0040")
+            )
+        self.explain(queries, explain_options)
+
+    def explain(self, queries, explain_options):
+        for name, query in queries.items():
+            self.stdout.write(self.style.MIGRATE_HEADING(f"\n{name}"))
+            self.stdout.write(query.explain(**explain_options))
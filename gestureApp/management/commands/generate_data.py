@@ -0,0 +1,43 @@
+from django.core.management.base import BaseCommand
+
+from gestureApp.models import Keypress, Trial, User
+from gestureApp.synthetic_data import generate_experiment
+
+
+class Command(BaseCommand):
+    help = """Generates a published study with synthetic subjects, in the database given by DATABASE_URL.
+    The study has one group and one experiment, with the given number of subjects, blocks and trials per block."""
+
+    def add_arguments(self, parser):
+        parser.add_argument("--subjects", type=int, default=20)
+        parser.add_argument("--blocks", type=int, default=4)
+        parser.add_argument("--trials", type=int, default=20, help="Trials per block")
+        parser.add_argument("--sequence-length", type=int, default=5)
+        parser.add_argument(
+            "--username",
+            default="synthetic",
+            help="Researcher that creates the study. Created if it doesn't exist.",
+        )
+        parser.add_argument(
+            "--seed", type=int, help="Seed to generate the same data again"
+        )
+
+    def handle(self, *args, **options):
+        user, created = User.objects.get_or_create(username=options["username"])
+        if created:
+            user.set_unusable_password()
+            user.save()
+        experiment = generate_experiment(
+            user,
+            options["subjects"],
+            options["blocks"],
+            options["trials"],
+            sequence_length=options["sequence_length"],
+            seed=options["seed"],
+        )
+        trials = Trial.objects.filter(block__experiment=experiment)
+        self.stdout.write(
+            f"Experiment {experiment.code} of study {experiment.study_id}: "
+            f"{options['subjects']} subjects, {trials.count()} trials, "
+            f"{Keypress.objects.filter(trial__in=trials).count()} keypress rows"
+        )
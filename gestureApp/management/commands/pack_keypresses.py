@@ -0,0 +1,148 @@
+from collections import defaultdict
+from datetime import timedelta
+
+from django.conf import settings
+from django.core.management.base import BaseCommand
+from django.db import transaction
+
+import numpy as np
+
+from gestureApp import processing
+from gestureApp.models import Keypress, Trial
+
+# Number of trials converted in each transaction
+BATCH_SIZE = 1000
+
+
+def pack_trials(trials):
+    """Moves the Keypress rows of the given trials into the trials themselves, a batch of trials at a time.
+    Every batch is committed on its own.
+
+    Args:
+        trials (QuerySet): trials whose keypresses are packed
+
+    Returns:
+        int: number of trials packed
+    """
+    trial_ids = list(
+        Keypress.objects.filter(trial__in=trials)
+        .order_by("trial_id")
+        .values_list("trial_id", flat=True)
+        .distinct()
+    )
+    for start in range(0, len(trial_ids), BATCH_SIZE):
+        batch = trial_ids[start : start + BATCH_SIZE]
+        with transaction.atomic():
+            started_at = dict(
+                Trial.objects.filter(id__in=batch).values_list("id", "started_at")
+            )
+            keypresses = defaultdict(list)
+            for trial_id, value, timestamp in (
+                Keypress.objects.filter(trial_id__in=batch)
+                .order_by("trial_id", "timestamp", "id")
+                .values_list("trial_id", "value", "timestamp")
+            ):
+                keypresses[trial_id].append((value, timestamp))
+            packed_trials = []
+            for trial_id, trial_keypresses in keypresses.items():
+                trial_started_at = processing.to_microseconds(started_at[trial_id])
+                packed_trials.append(
+                    Trial(
+                        id=trial_id,
+                        packed_keypresses=processing.pack_keypresses(
+                            [
+                                processing.to_microseconds(timestamp) - trial_started_at
+                                for _, timestamp in trial_keypresses
+                            ],
+                            [value for value, _ in trial_keypresses],
+                        ),
+                        packed_first_keypress_at=trial_keypresses[0][1],
+                    )
+                )
+            Trial.objects.bulk_update(
+                packed_trials, ["packed_keypresses", "packed_first_keypress_at"]
+            )
+            Keypress.objects.filter(trial_id__in=batch).delete()
+    return len(trial_ids)
+
+
+def unpack_trials(trials):
+    """Moves the packed keypresses of the given trials back into Keypress rows, a batch of trials at a time.
+    Every batch is committed on its own.
+
+    Args:
+        trials (QuerySet): trials whose keypresses are unpacked
+
+    Returns:
+        int: number of trials unpacked
+    """
+    trial_ids = list(
+        trials.filter(packed_keypresses__isnull=False)
+        .order_by("id")
+        .values_list("id", flat=True)
+    )
+    for start in range(0, len(trial_ids), BATCH_SIZE):
+        batch = trial_ids[start : start + BATCH_SIZE]
+        with transaction.atomic():
+            ids, started_at, packed = zip(
+                *Trial.objects.filter(id__in=batch).values_list(
+                    "id", "started_at", "packed_keypresses"
+                )
+            )
+            counts, offsets, values = processing.unpack_keypresses(packed)
+            timestamps = (
+                np.repeat([processing.to_microseconds(t) for t in started_at], counts)
+                + offsets
+            )
+            Keypress.objects.bulk_create(
+                [
+                    Keypress(
+                        trial_id=trial_id,
+                        value=value,
+                        timestamp=processing.EPOCH + timedelta(microseconds=timestamp),
+                    )
+                    for trial_id, value, timestamp in zip(
+                        np.repeat(ids, counts).tolist(),
+                        values.tolist(),
+                        timestamps.tolist(),
+                    )
+                ],
+                batch_size=BATCH_SIZE,
+            )
+            Trial.objects.filter(id__in=batch).update(
+                packed_keypresses=None, packed_first_keypress_at=None
+            )
+    return len(trial_ids)
+
+
+class Command(BaseCommand):
+    help = """Packs the Keypress rows of existing trials into the trials themselves, the way new trials are saved
+    when the PACKED_KEYPRESSES setting is enabled. With --unpack, moves the packed keypresses back into Keypress rows.
+    Trials are converted in batches of 1000, each one in its own transaction."""
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            "experiments",
+            nargs="*",
+            help="Codes of the experiments to convert. Defaults to all experiments.",
+        )
+        parser.add_argument(
+            "--unpack",
+            action="store_true",
+            help="Move the packed keypresses back into Keypress rows",
+        )
+
+    def handle(self, *args, **options):
+        trials = Trial.objects.all()
+        if options["experiments"]:
+            trials = trials.filter(block__experiment__in=options["experiments"])
+        if options["unpack"]:
+            self.stdout.write(f"{unpack_trials(trials)} trials unpacked")
+        else:
+            self.stdout.write(f"{pack_trials(trials)} trials packed")
+        if options["unpack"] == settings.PACKED_KEYPRESSES:
+            self.stdout.write(
+                self.style.WARNING(
+                    f"PACKED_KEYPRESSES is {settings.PACKED_KEYPRESSES}, so new trials are not saved this way"
+                )
+            )
@@ -0,0 +1,26 @@
+from django.core.management.base import BaseCommand
+
+from gestureApp.models import Experiment
+from gestureApp.views import experiments_changed
+
+
+class Command(BaseCommand):
+    help = "Rebuilds the participation of every subject in the experiments from their trials"
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            "experiments",
+            nargs="*",
+            help="Codes of the experiments to rebuild. Defaults to all experiments.",
+        )
+
+    def handle(self, *args, **options):
+        experiments = Experiment.objects.all()
+        if options["experiments"]:
+            experiments = experiments.filter(code__in=options["experiments"])
+        for experiment in experiments:
+            experiment.rebuild_participations()
+            experiments_changed(experiment.creator_id)
+            self.stdout.write(
+                f"{experiment.code}: {experiment.participations.count()} participations"
+            )
@@ -0,0 +1,25 @@
+# Generated by Django 4.0.4 on 2026-10-18 06:58
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('gestureApp', '0039_alter_endsurvey_subject'),
+    ]
+
+    operations = [
+        migrations.AddIndex(
+            model_name='keypress',
+            index=models.Index(fields=['trial', 'timestamp'], name='keypress_trial_time_idx'),
+        ),
+        migrations.AddIndex(
+            model_name='trial',
+            index=models.Index(fields=['block', 'subject', 'started_at'], name='trial_block_subject_start_idx'),
+        ),
+        migrations.AddIndex(
+            model_name='trial',
+            index=models.Index(fields=['subject', 'started_at'], name='trial_subject_start_idx'),
+        ),
+    ]
@@ -0,0 +1,23 @@
+# Generated by Django 4.0.4 on 2026-10-18 07:01
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('gestureApp', '0040_trial_keypress_indexes'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='trial',
+            name='packed_first_keypress_at',
+            field=models.DateTimeField(blank=True, null=True),
+        ),
+        migrations.AddField(
+            model_name='trial',
+            name='packed_keypresses',
+            field=models.BinaryField(blank=True, null=True),
+        ),
+    ]
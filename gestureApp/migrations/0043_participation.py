@@ -0,0 +1,62 @@
+# Generated by Django 4.0.4 on 2026-10-18 07:03
+
+from django.db import migrations, models
+import django.db.models.deletion
+
+
+def fill_participations(apps, schema_editor):
+    """Creates the participation of every subject in every experiment, from their trials"""
+    Trial = apps.get_model("gestureApp", "Trial")
+    Participation = apps.get_model("gestureApp", "Participation")
+    trial_times = (
+        Trial.objects.values("block__experiment_id", "subject_id")
+        .annotate(
+            first_trial_at=models.Min("started_at"),
+            last_trial_at=models.Max("started_at"),
+        )
+        .values_list(
+            "block__experiment_id", "subject_id", "first_trial_at", "last_trial_at"
+        )
+        .order_by()
+    )
+    Participation.objects.bulk_create(
+        (
+            Participation(
+                experiment_id=experiment,
+                subject_id=subject,
+                first_trial_at=first_trial_at,
+                last_trial_at=last_trial_at,
+            )
+            for experiment, subject, first_trial_at, last_trial_at in trial_times
+        ),
+        batch_size=1000,
+    )
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('gestureApp', '0041_trial_packed_keypresses'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='Participation',
+            fields=[
+                ('id', models.AutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('first_trial_at', models.DateTimeField()),
+                ('last_trial_at', models.DateTimeField()),
+                ('experiment', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='participations', to='gestureApp.experiment')),
+                ('subject', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='participations', to='gestureApp.subject')),
+            ],
+        ),
+        migrations.AddIndex(
+            model_name='participation',
+            index=models.Index(fields=['experiment', 'last_trial_at'], name='participation_last_trial_idx'),
+        ),
+        migrations.AddConstraint(
+            model_name='participation',
+            constraint=models.UniqueConstraint(fields=('experiment', 'subject'), name='unique_participation'),
+        ),
+        migrations.RunPython(fill_participations, migrations.RunPython.noop),
+    ]
@@ -0,0 +1,61 @@
+# Generated by Django 4.0.4 on 2026-10-18 07:10
+
+from django.db import migrations, models
+import django.db.models.deletion
+
+
+def fill_group_assignments(apps, schema_editor):
+    """Assigns every subject to the group of the first experiment they did in each study, and counts the participants of each group"""
+    Participation = apps.get_model("gestureApp", "Participation")
+    GroupAssignment = apps.get_model("gestureApp", "GroupAssignment")
+    Group = apps.get_model("gestureApp", "Group")
+    assignments = {}
+    for study, group, subject in Participation.objects.order_by(
+        "first_trial_at", "id"
+    ).values_list("experiment__study_id", "experiment__group_id", "subject_id"):
+        assignments.setdefault((study, subject), group)
+    GroupAssignment.objects.bulk_create(
+        (
+            GroupAssignment(study_id=study, subject_id=subject, group_id=group)
+            for (study, subject), group in assignments.items()
+        ),
+        batch_size=1000,
+    )
+    for group in (
+        GroupAssignment.objects.values("group_id")
+        .annotate(num_participants=models.Count("id"))
+        .order_by()
+    ):
+        Group.objects.filter(pk=group["group_id"]).update(
+            num_participants=group["num_participants"]
+        )
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('gestureApp', '0043_participation'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='group',
+            name='num_participants',
+            field=models.PositiveIntegerField(default=0),
+        ),
+        migrations.CreateModel(
+            name='GroupAssignment',
+            fields=[
+                ('id', models.AutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('created_at', models.DateTimeField(auto_now_add=True)),
+                ('group', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='assignments', to='gestureApp.group')),
+                ('study', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='assignments', to='gestureApp.study')),
+                ('subject', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='group_assignments', to='gestureApp.subject')),
+            ],
+        ),
+        migrations.AddConstraint(
+            model_name='groupassignment',
+            constraint=models.UniqueConstraint(fields=('study', 'subject'), name='unique_group_assignment'),
+        ),
+        migrations.RunPython(fill_group_assignments, migrations.RunPython.noop),
+    ]
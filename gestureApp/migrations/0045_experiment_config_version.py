@@ -0,0 +1,18 @@
+# Generated by Django 4.0.4 on 2026-10-18 07:11
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('gestureApp', '0044_group_assignment'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='experiment',
+            name='config_version',
+            field=models.PositiveIntegerField(default=1),
+        ),
+    ]
@@ -0,0 +1,29 @@
+# Generated by Django 4.0.4 on 2026-10-18 07:28
+
+from django.db import migrations, models
+import django.db.models.deletion
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('gestureApp', '0045_experiment_config_version'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='TrialMetrics',
+            fields=[
+                ('trial', models.OneToOneField(on_delete=django.db.models.deletion.CASCADE, primary_key=True, related_name='metrics', serialize=False, to='gestureApp.trial')),
+                ('version', models.PositiveSmallIntegerField()),
+                ('trial_index', models.PositiveIntegerField()),
+                ('accumulated_correct_trials', models.PositiveIntegerField()),
+                ('num_keypresses', models.PositiveIntegerField()),
+                ('execution_time_ms', models.FloatField(null=True)),
+                ('inter_key_interval_mean_ms', models.FloatField(null=True)),
+                ('inter_key_interval_std_ms', models.FloatField(null=True)),
+                ('tapping_speed_mean', models.FloatField(null=True)),
+                ('tapping_speed_extra_keypress', models.FloatField(null=True)),
+            ],
+        ),
+    ]
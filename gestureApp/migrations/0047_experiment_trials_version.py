@@ -0,0 +1,18 @@
+# Generated by Django 4.0.4 on 2026-10-18 07:37
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('gestureApp', '0046_trial_metrics'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='experiment',
+            name='trials_version',
+            field=models.PositiveIntegerField(default=1),
+        ),
+    ]
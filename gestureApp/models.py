@@ -1,12 +1,20 @@
-from django.db import models, IntegrityError
+from django.db import models, transaction, IntegrityError
 import random, string
 from django.utils import timezone
 from django.contrib.auth.models import AbstractUser
 from django.core.exceptions import ValidationError
 from model_clone import CloneMixin
-from django.db.models import F
+from django.db.models import Count, F, Max, Min, Q
 from collections import defaultdict
 
+# Counts the responses of each experiment when annotating experiments, the same way as Experiment.num_responses.
+# If the experiment is published, only subjects that did it after the publish date are counted. Else, all subjects are counted
+EXPERIMENT_RESPONSES = Count(
+    "participations",
+    filter=Q(published=False)
+    | Q(participations__last_trial_at__gt=F("published_timestamp")),
+)
+
 
 class User(AbstractUser):
     """Main user of the application. Refers to the researcher, not the participant"""
@@ -91,72 +99,109 @@ class Study(models.Model):
             else:
                 success = True
 
+    def assign_subject(self, subject):
+        """Assigns a subject to a group of this study, unless they already have one.
+        The enabled group with the fewest participants is chosen (randomly among ties), so that the groups stay balanced.
+
+        Args:
+            subject (Subject): subject to assign
+
+        Returns:
+            str: code of the group of the subject, or None if the study has no enabled groups
+        """
+        with transaction.atomic():
+            # Locking the groups makes concurrent assignments to this study wait for each other,
+            #   so that each one sees the counts updated by the previous one
+            groups = list(
+                self.groups.select_for_update()
+                .filter(enabled=True)
+                .values_list("code", "num_participants")
+            )
+            if not groups:
+                return None
+            fewest_participants = min(num for _, num in groups)
+            group_code = random.choice(
+                [code for code, num in groups if num == fewest_participants]
+            )
+            return GroupAssignment.assign(self.code, subject, group_code)
+
     def to_dict(self):
         """Helper method to convert study to a dict to be readable from an HTML template
 
         Returns:
             dict: study dict with all the necessary fields
         """
-        # Get all experiments from this study
-        experiments = list(self.experiments.order_by("created_at").values())
-        # Get all groups
-        groups = list(self.groups.values())
-        # get all subjects, and get specific data from them
-        subjects = list(
-            Subject.objects.filter(trials__block__experiment__in=self.experiments.all())
-            .annotate(exp_code=F("trials__block__experiment__code"))
-            .annotate(done_at=F("trials__started_at"))
-            .annotate(published=F("trials__block__experiment__published"))
-            .annotate(published_at=F("trials__block__experiment__published_timestamp"))
+        return Study.to_dicts(Study.objects.filter(code=self.code))[0]
+
+    @classmethod
+    def to_dicts(cls, studies):
+        """Converts multiple studies to dicts, in the same format as to_dict.
+        Uses three queries (studies, groups and experiments with their responses), whatever the number of studies.
+
+        Args:
+            studies (QuerySet): studies to convert
+
+        Returns:
+            list: study dicts, in the same order as the studies
+        """
+        studies = list(studies.select_related("creator"))
+        study_codes = [study.code for study in studies]
+        # Get all groups of the studies
+        study_groups = defaultdict(list)
+        for g in Group.objects.filter(study__in=study_codes).values():
+            study_groups[g["study_id"]].append(g)
+        # Get all experiments of the studies, counting their responses in the same query
+        study_experiments = defaultdict(list)
+        for e in (
+            Experiment.objects.filter(study__in=study_codes)
+            .annotate(responses=EXPERIMENT_RESPONSES)
+            .order_by("created_at")
             .values()
-        )
-        # If the study is published, get all subjects that did the experiment after the publish date
-        # Else, get all subjects
-        exp_subjects = defaultdict(set)
-        for s in subjects:
-            # Factor in the published or unpublished status of the experiment
-            if (s["published"] and s["done_at"] > s["published_at"]) or (
-                not s["published"]
-            ):
-                exp_subjects[s["exp_code"]].add(s["code"])
-
-        groups_names = {}
-        for g in groups:
-            groups_names[g["code"]] = g["name"]
-            g.pop("study_id")
-            g["study"] = {"code": self.code, "name": self.name}
-        creator = self.creator.username
-
-        for e in experiments:
-            # Replace group id by a group dict
-            group_id = e["group_id"]
-            e["group"] = {"code": group_id, "name": groups_names[group_id]}
-            # Replace study id by a study object
-            e.pop("study_id")
-            e["study"] = {"code": self.code, "name": self.name}
-            # Replace creator by creator username
-            e.pop("creator_id")
-            e["creator"] = creator
-
-            # Responses
-            e["responses"] = len(exp_subjects[e["code"]])
-
-        for g in groups:
-            g["experiments"] = [e for e in experiments if e["group_id"] == g["code"]]
-
-        # Final study dictionary
-        study_dict = {
-            "code": self.code,
-            "name": self.name,
-            "created_at": self.created_at,
-            "published": self.published,
-            "creator": creator,
-            "description": self.description,
-            "enabled": self.enabled,
-            "experiments": experiments,
-            "groups": groups,
-        }
-        return study_dict
+        ):
+            study_experiments[e["study_id"]].append(e)
+
+        study_dicts = []
+        for study in studies:
+            groups = study_groups[study.code]
+            experiments = study_experiments[study.code]
+            groups_names = {}
+            for g in groups:
+                groups_names[g["code"]] = g["name"]
+                g.pop("study_id")
+                g["study"] = {"code": study.code, "name": study.name}
+            creator = study.creator.username
+
+            for e in experiments:
+                # Replace group id by a group dict
+                group_id = e["group_id"]
+                e["group"] = {"code": group_id, "name": groups_names[group_id]}
+                # Replace study id by a study object
+                e.pop("study_id")
+                e["study"] = {"code": study.code, "name": study.name}
+                # Replace creator by creator username
+                e.pop("creator_id")
+                e["creator"] = creator
+
+            for g in groups:
+                g["experiments"] = [
+                    e for e in experiments if e["group_id"] == g["code"]
+                ]
+
+            # Final study dictionary
+            study_dicts.append(
+                {
+                    "code": study.code,
+                    "name": study.name,
+                    "created_at": study.created_at,
+                    "published": study.published,
+                    "creator": creator,
+                    "description": study.description,
+                    "enabled": study.enabled,
+                    "experiments": experiments,
+                    "groups": groups,
+                }
+            )
+        return study_dicts
 
 
 class Group(models.Model):
@@ -172,6 +217,8 @@ class Group(models.Model):
 
     # Group property
     enabled = models.BooleanField(default=True)
+    # Number of subjects assigned to this group, kept up to date by GroupAssignment.assign
+    num_participants = models.PositiveIntegerField(default=0)
 
     def save(self, *args, **kwargs):
         if not self.code:
@@ -236,6 +283,12 @@ class Experiment(CloneMixin, models.Model):
     published = models.BooleanField(default=False)
     published_timestamp = models.DateTimeField(blank=True, null=True, default=None)
     enabled = models.BooleanField(default=True)
+    # Version of the configuration shown to participants. Changes every time the experiment is edited,
+    #   published, enabled or disabled, so that cached configurations of older versions are not used
+    config_version = models.PositiveIntegerField(default=1)
+    # Version of the trials of the experiment. Changes every time a subject's trials are saved, so that cached
+    #   summaries of the data (see views.learning_curve) are calculated again
+    trials_version = models.PositiveIntegerField(default=1)
 
     # TODO: maybe get all of the practice info into a type object or something
     with_practice_trials = models.BooleanField(default=True)
@@ -296,34 +349,112 @@ class Experiment(CloneMixin, models.Model):
     def __str__(self):
         return self.code + " | " + self.name
 
+    def config_changed(self):
+        """Moves the experiment to a new configuration version. Must be called after any change to it that
+        participants could see, once the change is saved."""
+        Experiment.objects.filter(pk=self.pk).update(
+            config_version=F("config_version") + 1
+        )
+
+    def trials_changed(self):
+        """Moves the experiment to a new trials version. Must be called once the transaction that saves
+        new trials is committed, both to keep the experiment row unlocked while it runs and so that summaries
+        calculated with the new version include the new trials.
+        """
+        Experiment.objects.filter(pk=self.pk).update(
+            trials_version=F("trials_version") + 1
+        )
+
     def num_responses(self):
         """Return the number of people that have performed the experiment"""
-
+        participations = self.participations.all()
         # If the experiment is published, return the number of people that have responded to the experiment since its publishing timestamp
         if self.published:
-            return (
-                Subject.objects.filter(
-                    trials__block__experiment=self,
-                    trials__started_at__gt=self.published_timestamp,
-                )
-                .distinct()
-                .count()
-            )
-        else:
-            # Else, return all subjects who have done the experiment
-            return (
-                Subject.objects.filter(trials__block__experiment=self)
-                .distinct()
-                .count()
+            participations = participations.filter(
+                last_trial_at__gt=self.published_timestamp
             )
+        # Else, return all subjects who have done the experiment
+        return participations.count()
 
     def has_done_experiment(self, subject):
         """Returns whether the subject has performed this experiment or not"""
-        return self.blocks.filter(trials__subject=subject).exists()
+        return self.participations.filter(subject=subject).exists()
 
-    def to_dict(self):
+    def record_participation(self, subject, started_at):
+        """Updates the participation of a subject in this experiment with new trials.
+        Should be called in the same transaction that saves the trials.
+
+        Args:
+            subject (Subject): subject that performed the trials
+            started_at (list): starting time of each new trial
+        """
+        if not started_at:
+            return
+        participations = Participation.objects.select_for_update()
+        participation, created = participations.get_or_create(
+            experiment=self,
+            subject=subject,
+            defaults={
+                "first_trial_at": min(started_at),
+                "last_trial_at": max(started_at),
+            },
+        )
+        if not created:
+            participation.first_trial_at = min(
+                participation.first_trial_at, *started_at
+            )
+            participation.last_trial_at = max(participation.last_trial_at, *started_at)
+            participation.save(update_fields=["first_trial_at", "last_trial_at"])
+        else:
+            # Subjects that enter an experiment directly also belong to its group from now on
+            GroupAssignment.assign(self.study_id, subject, self.group_id)
+
+    def rebuild_participations(self):
+        """Calculates the participation of every subject in this experiment again, from their trials"""
+        trial_times = (
+            Trial.objects.filter(block__experiment=self)
+            .values("subject_id")
+            .annotate(first_trial_at=Min("started_at"), last_trial_at=Max("started_at"))
+            .values_list("subject_id", "first_trial_at", "last_trial_at")
+        )
+        with transaction.atomic():
+            self.participations.all().delete()
+            Participation.objects.bulk_create(
+                [
+                    Participation(
+                        experiment=self,
+                        subject_id=subject,
+                        first_trial_at=first_trial_at,
+                        last_trial_at=last_trial_at,
+                    )
+                    for subject, first_trial_at, last_trial_at in trial_times
+                ],
+                batch_size=1000,
+            )
+
+    def subjects_starting_timestamps(self, since):
+        """Returns the timestamp at which each subject started their first trial of this experiment, in a single query
+
+        Args:
+            since (datetime): only trials started after this timestamp are considered
+
+        Returns:
+            dict: starting timestamp with the subject code as key
+        """
+        return dict(
+            Subject.objects.filter(
+                trials__block__experiment=self, trials__started_at__gt=since
+            )
+            .annotate(first_trial_started_at=Min("trials__started_at"))
+            .values_list("code", "first_trial_started_at")
+        )
+
+    def to_dict(self, with_responses=True):
         """Helper method to transform experiment to dictionary
 
+        Args:
+            with_responses (bool, optional): whether to include the number of responses. Defaults to True.
+
         Returns:
             dict: experiment dictionary
         """
@@ -331,7 +462,7 @@ class Experiment(CloneMixin, models.Model):
         study_name = self.study.name
         group = {"code": self.group.code, "name": self.group.name}
 
-        return {
+        experiment_dict = {
             "code": self.code,
             "study": {"code": study_code, "name": study_name},
             "group": group,
@@ -353,8 +484,10 @@ class Experiment(CloneMixin, models.Model):
             "requirements": self.requirements,
             "instructions": self.instructions,
             "enabled": self.enabled,
-            "responses": self.num_responses(),
         }
+        if with_responses:
+            experiment_dict["responses"] = self.num_responses()
+        return experiment_dict
 
 
 class Block(CloneMixin, models.Model):
@@ -405,6 +538,19 @@ class Block(CloneMixin, models.Model):
 class Trial(models.Model):
     """Represents a trial completed by a subject in the database database"""
 
+    class Meta:
+        indexes = [
+            # Trials of the blocks of an experiment after a date, and trials of a subject in a block
+            models.Index(
+                fields=["block", "subject", "started_at"],
+                name="trial_block_subject_start_idx",
+            ),
+            # Trials of a subject, ordered by starting time
+            models.Index(
+                fields=["subject", "started_at"], name="trial_subject_start_idx"
+            ),
+        ]
+
     # If the corresponding block is deleted, all associated trials should be deleted as well
     block = models.ForeignKey(Block, on_delete=models.CASCADE, related_name="trials")
     # Prevent deletion if the corresponding subject is deleted
@@ -417,6 +563,11 @@ class Trial(models.Model):
     correct = models.BooleanField()
     # If the block ended before the user could input more keypresses, but the keypresses were correct until that point
     partial_correct = models.BooleanField()
+    # Keypresses of the trial, when they are saved packed in the trial instead of as Keypress rows (PACKED_KEYPRESSES setting).
+    #   See processing.pack_keypresses for the format.
+    packed_keypresses = models.BinaryField(null=True, blank=True)
+    # Timestamp of the first packed keypress, so that trials can still be ordered by it in the database
+    packed_first_keypress_at = models.DateTimeField(null=True, blank=True)
 
     def __str__(self):
         return str(timezone.localtime(self.started_at))
@@ -427,6 +578,10 @@ class Keypress(models.Model):
 
     class Meta:
         ordering = ["timestamp"]
+        indexes = [
+            # Keypresses of a trial, ordered by timestamp
+            models.Index(fields=["trial", "timestamp"], name="keypress_trial_time_idx")
+        ]
 
     # Delete keypresses if the trial is deleted
     trial = models.ForeignKey(
@@ -440,6 +595,112 @@ class Keypress(models.Model):
         return self.value + ", " + str(self.timestamp)
 
 
+class TrialMetrics(models.Model):
+    """Metrics of a trial, calculated when the trial is saved so that the processed data can be read with a single
+    query instead of being calculated from the keypresses. See trial_metrics.trial_metrics."""
+
+    trial = models.OneToOneField(
+        Trial, on_delete=models.CASCADE, primary_key=True, related_name="metrics"
+    )
+    # Version of the calculation, to know which metrics have to be calculated again when it changes
+    version = models.PositiveSmallIntegerField()
+    # Position (starting at 1) of the trial among the trials of the subject in its block, by starting time
+    trial_index = models.PositiveIntegerField()
+    # Correct trials of the subject in the block until this one, included
+    accumulated_correct_trials = models.PositiveIntegerField()
+    num_keypresses = models.PositiveIntegerField()
+    # Metrics that can't be calculated for a trial (e.g. incorrect trials) are null
+    execution_time_ms = models.FloatField(null=True)
+    inter_key_interval_mean_ms = models.FloatField(null=True)
+    inter_key_interval_std_ms = models.FloatField(null=True)
+    tapping_speed_mean = models.FloatField(null=True)
+    tapping_speed_extra_keypress = models.FloatField(null=True)
+
+    def __str__(self):
+        return str(self.trial_id)
+
+
+class Participation(models.Model):
+    """Represents the participation of a subject in an experiment. It is saved together with the trials of the subject,
+    so that responses can be counted without going through all the trials."""
+
+    class Meta:
+        constraints = [
+            models.UniqueConstraint(
+                fields=["experiment", "subject"], name="unique_participation"
+            )
+        ]
+        indexes = [
+            # Subjects that responded to an experiment after a date
+            models.Index(
+                fields=["experiment", "last_trial_at"],
+                name="participation_last_trial_idx",
+            )
+        ]
+
+    experiment = models.ForeignKey(
+        Experiment, on_delete=models.CASCADE, related_name="participations"
+    )
+    subject = models.ForeignKey(
+        Subject, on_delete=models.CASCADE, related_name="participations"
+    )
+    # Starting time of the first and last trials of the subject in the experiment
+    first_trial_at = models.DateTimeField()
+    last_trial_at = models.DateTimeField()
+
+    def __str__(self):
+        return f"{self.subject_id} | {self.experiment_id}"
+
+
+class GroupAssignment(models.Model):
+    """Represents the group a subject belongs to in a study. Subjects coming back to a study are sent to the
+    experiments of the same group."""
+
+    class Meta:
+        constraints = [
+            models.UniqueConstraint(
+                fields=["study", "subject"], name="unique_group_assignment"
+            )
+        ]
+
+    study = models.ForeignKey(
+        Study, on_delete=models.CASCADE, related_name="assignments"
+    )
+    group = models.ForeignKey(
+        Group, on_delete=models.CASCADE, related_name="assignments"
+    )
+    subject = models.ForeignKey(
+        Subject, on_delete=models.CASCADE, related_name="group_assignments"
+    )
+    created_at = models.DateTimeField(auto_now_add=True)
+
+    @classmethod
+    def assign(cls, study_id, subject, group_id):
+        """Assigns a subject to a group of a study, unless they already belong to a group of that study.
+        Keeps the number of participants of the group up to date.
+
+        Args:
+            study_id (str): code of the study
+            subject (Subject): subject to assign
+            group_id (str): code of the group
+
+        Returns:
+            str: code of the group the subject belongs to
+        """
+        with transaction.atomic():
+            assignment, created = cls.objects.get_or_create(
+                study_id=study_id, subject=subject, defaults={"group_id": group_id}
+            )
+            if created:
+                Group.objects.filter(pk=group_id).update(
+                    num_participants=F("num_participants") + 1
+                )
+        return assignment.group_id
+
+    def __str__(self):
+        return f"{self.subject_id} | {self.group_id}"
+
+
 class EndSurvey(models.Model):
     """Represents the full end survey in the database"""
 
@@ -0,0 +1,627 @@
+"""Vectorized helpers used to process the experiments data.
+
+Data is handled as NumPy arrays with one element per trial or per keypress. Timestamps are
+stored as int64 microseconds since the epoch, so that differences between them are exact.
+"""
+
+from datetime import datetime, timedelta, timezone
+from itertools import islice
+
+import numpy as np
+
+EPOCH = datetime(1970, 1, 1, tzinfo=timezone.utc)
+ONE_MICROSECOND = timedelta(microseconds=1)
+# Marks a missing timestamp in the int64 timestamp arrays
+MISSING_TIMESTAMP = np.iinfo(np.int64).min
+# Bytes used by each packed keypress: an int64 offset and a UTF-32 character
+PACKED_KEYPRESS_SIZE = 12
+
+
+def to_microseconds(timestamp):
+    """Converts an aware datetime into microseconds since the epoch
+
+    Args:
+        timestamp (datetime): timestamp to convert. Can be None.
+
+    Returns:
+        int: microseconds since the epoch, or MISSING_TIMESTAMP if there was no timestamp
+    """
+    if timestamp is None:
+        return MISSING_TIMESTAMP
+    return (timestamp - EPOCH) // ONE_MICROSECOND
+
+
+def rows_to_columns(rows, dtypes, chunk_size=10000):
+    """Reads an iterable of row tuples into one NumPy array per column.
+    Rows are converted a chunk at a time, so that the full list of rows never has to be in memory.
+
+    Args:
+        rows (iterable): tuples with one value per column
+        dtypes (list): NumPy dtype of each column. Columns with the "timestamp" dtype should contain
+            datetimes, and are converted to int64 microseconds since the epoch.
+        chunk_size (int): number of rows converted at a time
+
+    Returns:
+        list: one array per column
+    """
+    rows = iter(rows)
+    chunks = [[] for _ in dtypes]
+    while True:
+        chunk = list(islice(rows, chunk_size))
+        if not chunk:
+            break
+        for index, (column, dtype) in enumerate(zip(zip(*chunk), dtypes)):
+            if dtype == "timestamp":
+                column = np.fromiter(
+                    (to_microseconds(value) for value in column),
+                    dtype=np.int64,
+                    count=len(column),
+                )
+            else:
+                column = np.array(column, dtype=dtype)
+            chunks[index].append(column)
+    return [
+        (
+            np.concatenate(column_chunks)
+            if column_chunks
+            else np.array([], dtype=np.int64 if dtype == "timestamp" else dtype)
+        )
+        for column_chunks, dtype in zip(chunks, dtypes)
+    ]
+
+
+def factorize(values):
+    """Replaces every value by an integer code, so that values can be compared and sorted cheaply
+
+    Args:
+        values (np.ndarray): values to encode
+
+    Returns:
+        np.ndarray: int64 code of each value
+    """
+    return np.unique(values, return_inverse=True)[1].reshape(-1).astype(np.int64)
+
+
+def first_appearance_codes(values):
+    """Numbers the distinct values from 1 onwards, in the order in which they first appear
+
+    Args:
+        values (np.ndarray): values to number
+
+    Returns:
+        np.ndarray: number of each value
+    """
+    if len(values) == 0:
+        return np.array([], dtype=np.int64)
+    _, first_index, inverse = np.unique(values, return_index=True, return_inverse=True)
+    numbers = np.empty(len(first_index), dtype=np.int64)
+    numbers[np.argsort(first_index, kind="stable")] = np.arange(1, len(first_index) + 1)
+    return numbers[inverse.reshape(-1)]
+
+
+def _group_starts(order, keys):
+    """Marks the elements that start a new group, once sorted by the given order
+
+    Args:
+        order (np.ndarray): order in which the elements are sorted
+        keys (list): arrays that define the groups
+
+    Returns:
+        np.ndarray: True for the first element of each group, in the sorted order
+    """
+    is_start = np.zeros(len(order), dtype=bool)
+    is_start[:1] = True
+    for key in keys:
+        sorted_key = key[order]
+        is_start[1:] |= sorted_key[1:] != sorted_key[:-1]
+    return is_start
+
+
+def rank_within_groups(*keys):
+    """Position (starting at 1) of every element inside its group, keeping the order of the elements.
+    Groups are the combinations of the given keys.
+
+    Returns:
+        np.ndarray: rank of each element
+    """
+    return cumsum_within_groups(np.ones(len(keys[0]), dtype=np.int64), *keys)
+
+
+def cumsum_within_groups(values, *keys):
+    """Accumulated sum of the values inside every group, keeping the order of the elements.
+    Groups are the combinations of the given keys.
+
+    Args:
+        values (np.ndarray): integer or boolean values to accumulate
+
+    Returns:
+        np.ndarray: accumulated value for each element
+    """
+    result = np.empty(len(values), dtype=np.int64)
+    if len(values) == 0:
+        return result
+    # lexsort is stable, so elements keep their order inside each group
+    order = np.lexsort(keys[::-1])
+    is_start = _group_starts(order, keys)
+    sorted_values = values[order].astype(np.int64)
+    sorted_cumsum = np.cumsum(sorted_values)
+    # Position where the group of each element starts
+    group_start = np.maximum.accumulate(np.where(is_start, np.arange(len(order)), 0))
+    result[order] = (
+        sorted_cumsum - sorted_cumsum[group_start] + sorted_values[group_start]
+    )
+    return result
+
+
+def previous_in_group(started_at, finished_at, *keys):
+    """Finds the element that comes right before each element in the same group.
+    Elements are sorted by their starting time, and the previous one is only returned if
+    it finished before the current one started.
+
+    Args:
+        started_at (np.ndarray): starting timestamps
+        finished_at (np.ndarray): finishing timestamps
+        keys: arrays that define the groups
+
+    Returns:
+        np.ndarray: index of the previous element, or -1 if there is none
+    """
+    previous = np.full(len(started_at), -1, dtype=np.int64)
+    if len(started_at) == 0:
+        return previous
+    order = np.lexsort((started_at,) + keys[::-1])
+    # Shift the sorted elements by one, and keep only the ones in the same group
+    candidates = np.r_[-1, order[:-1]]
+    valid = ~_group_starts(order, keys) & (finished_at[candidates] <= started_at[order])
+    previous[order[valid]] = candidates[valid]
+    return previous
+
+
+def next_in_group(started_at, finished_at, *keys):
+    """Finds the element that comes right after each element in the same group. The opposite of
+    previous_in_group: the next one is only returned if it started after the current one finished.
+
+    Args:
+        started_at (np.ndarray): starting timestamps
+        finished_at (np.ndarray): finishing timestamps
+        keys: arrays that define the groups
+
+    Returns:
+        np.ndarray: index of the next element, or -1 if there is none
+    """
+    following = np.full(len(started_at), -1, dtype=np.int64)
+    if len(started_at) == 0:
+        return following
+    order = np.lexsort((started_at,) + keys[::-1])
+    # Shift the sorted elements by one in the other direction, and keep only the ones in the same group
+    candidates = np.r_[order[1:], -1]
+    valid = np.r_[~_group_starts(order, keys)[1:], False]
+    valid[valid] = started_at[candidates[valid]] >= finished_at[order[valid]]
+    following[order[valid]] = candidates[valid]
+    return following
+
+
+def group_extremes(values, groups, num_groups, selected):
+    """Minimum and maximum of the selected values of every group
+
+    Args:
+        values (np.ndarray): int64 values
+        groups (np.ndarray): group (from 0 to num_groups - 1) of each value
+        num_groups (int): number of groups
+        selected (np.ndarray): whether each value is taken into account
+
+    Returns:
+        tuple: minimum and maximum of each group. Groups without selected values get MISSING_TIMESTAMP.
+    """
+    minimum = np.full(num_groups, np.iinfo(np.int64).max, dtype=np.int64)
+    maximum = np.full(num_groups, MISSING_TIMESTAMP, dtype=np.int64)
+    np.minimum.at(minimum, groups[selected], values[selected])
+    np.maximum.at(maximum, groups[selected], values[selected])
+    minimum[minimum == np.iinfo(np.int64).max] = MISSING_TIMESTAMP
+    return minimum, maximum
+
+
+def group_means(values, groups, num_groups):
+    """Mean of the values of every group, leaving out NaN values
+
+    Args:
+        values (np.ndarray): float values
+        groups (np.ndarray): group (from 0 to num_groups - 1) of each value
+        num_groups (int): number of groups
+
+    Returns:
+        np.ndarray: mean of each group, or NaN for groups without values
+    """
+    valid = ~np.isnan(values)
+    counts = np.bincount(groups[valid], minlength=num_groups)
+    sums = np.bincount(groups[valid], weights=values[valid], minlength=num_groups)
+    with np.errstate(invalid="ignore"):
+        return sums / counts
+
+
+def group_quantiles(values, groups, num_groups, quantiles):
+    """Quantiles of the values of every group, leaving out NaN values. Quantiles are interpolated
+    linearly between the closest values, like the default method of np.quantile.
+
+    Args:
+        values (np.ndarray): float values
+        groups (np.ndarray): group (from 0 to num_groups - 1) of each value
+        num_groups (int): number of groups
+        quantiles (list): quantiles to calculate, between 0 and 1
+
+    Returns:
+        np.ndarray: one row per quantile, with the quantile of each group or NaN for groups without values
+    """
+    valid = ~np.isnan(values)
+    values = values[valid]
+    groups = groups[valid]
+    # Values sorted inside each group, with the groups one after the other
+    order = np.lexsort((values, groups))
+    values = values[order]
+    counts = np.bincount(groups, minlength=num_groups)
+    starts = np.cumsum(counts) - counts
+    has_values = counts > 0
+    starts = starts[has_values]
+    last = counts[has_values] - 1
+    result = np.full((len(quantiles), num_groups), np.nan)
+    for i, quantile in enumerate(quantiles):
+        position = quantile * last
+        below = np.floor(position).astype(np.int64)
+        above = np.minimum(below + 1, last)
+        fraction = position - below
+        result[i, has_values] = values[starts + below] + fraction * (
+            values[starts + above] - values[starts + below]
+        )
+    return result
+
+
+def welford_update(count, mean, m2, groups, values):
+    """Adds a chunk of values to the running count, mean and sum of squared deviations of every group, so that
+    the statistics of a stream of values can be calculated in constant memory. The chunk is summarized first,
+    and then combined with the running statistics with the parallel version of Welford's algorithm.
+
+    Args:
+        count (np.ndarray): number of values of each group so far
+        mean (np.ndarray): mean of each group so far
+        m2 (np.ndarray): sum of the squared deviations from the mean of each group so far
+        groups (np.ndarray): group (from 0 to len(count) - 1) of each new value
+        values (np.ndarray): new float values. NaN values are left out.
+
+    Returns:
+        tuple: updated count, mean and m2 of each group. The sample variance is m2 / (count - 1).
+    """
+    valid = ~np.isnan(values)
+    groups = groups[valid]
+    values = values[valid]
+    num_groups = len(count)
+    chunk_count = np.bincount(groups, minlength=num_groups)
+    with np.errstate(invalid="ignore"):
+        chunk_mean = (
+            np.bincount(groups, weights=values, minlength=num_groups) / chunk_count
+        )
+    chunk_m2 = np.bincount(
+        groups, weights=(values - chunk_mean[groups]) ** 2, minlength=num_groups
+    )
+    has_values = chunk_count > 0
+    new_count = count + chunk_count
+    delta = np.where(has_values, chunk_mean - mean, 0)
+    with np.errstate(invalid="ignore"):
+        weight = np.where(has_values, chunk_count / new_count, 0)
+    new_mean = mean + delta * weight
+    new_m2 = m2 + np.where(has_values, chunk_m2, 0) + delta**2 * count * weight
+    return new_count, new_mean, new_m2
+
+
+def keypress_speeds(trial_index, timestamps, num_trials):
+    """Calculates the tapping speed between every pair of consecutive keypresses of each trial, and summarizes it
+    per trial. Keypresses with the same timestamp don't have a speed.
+
+    Args:
+        trial_index (np.ndarray): index of the trial each keypress belongs to
+        timestamps (np.ndarray): timestamp of each keypress, in microseconds
+        num_trials (int): number of trials
+
+    Returns:
+        tuple: number of keypresses, timestamp of the first keypress (MISSING_TIMESTAMP if there are none),
+            and mean and sample standard deviation of the speeds (keypresses per second) of each trial.
+            Trials without speeds get NaN.
+    """
+    order = np.lexsort((timestamps, trial_index))
+    trial_index = trial_index[order]
+    timestamps = timestamps[order]
+    counts = np.bincount(trial_index, minlength=num_trials)
+    first = np.full(num_trials, MISSING_TIMESTAMP, dtype=np.int64)
+    has_keypresses = counts > 0
+    first[has_keypresses] = timestamps[(np.cumsum(counts) - counts)[has_keypresses]]
+
+    elapsed = np.diff(timestamps) / 1e6
+    valid = (trial_index[1:] == trial_index[:-1]) & (elapsed > 0)
+    speed_trials = trial_index[1:][valid]
+    speeds = 1 / elapsed[valid]
+    num_speeds = np.bincount(speed_trials, minlength=num_trials)
+    with np.errstate(divide="ignore", invalid="ignore"):
+        mean = (
+            np.bincount(speed_trials, weights=speeds, minlength=num_trials) / num_speeds
+        )
+        squares = np.bincount(
+            speed_trials,
+            weights=(speeds - mean[speed_trials]) ** 2,
+            minlength=num_trials,
+        )
+        std = np.sqrt(squares / (num_speeds - 1))
+    std[num_speeds < 2] = np.nan
+    return counts, first, mean, std
+
+
+def keypress_intervals_ms(
+    trial_index, timestamps, num_trials, min_ms_between_keypresses
+):
+    """Summarizes the milliseconds between consecutive keypresses of each trial. Intervals shorter than
+    the minimum possible are replaced by the minimum, like in tapping_metrics.
+
+    Args:
+        trial_index (np.ndarray): index of the trial each keypress belongs to
+        timestamps (np.ndarray): timestamp of each keypress, in microseconds
+        num_trials (int): number of trials
+        min_ms_between_keypresses (int): minimum possible time between two keypresses
+
+    Returns:
+        tuple: number of keypresses, and mean and sample standard deviation of the intervals of each trial.
+            Trials without enough intervals get NaN.
+    """
+    order = np.lexsort((timestamps, trial_index))
+    trial_index = trial_index[order]
+    intervals = np.maximum(
+        np.diff(timestamps[order]) / 1e6 * 1000, min_ms_between_keypresses
+    )
+    same_trial = trial_index[1:] == trial_index[:-1]
+    interval_trials = trial_index[1:][same_trial]
+    intervals = intervals[same_trial]
+    num_intervals = np.bincount(interval_trials, minlength=num_trials)
+    with np.errstate(divide="ignore", invalid="ignore"):
+        mean = (
+            np.bincount(interval_trials, weights=intervals, minlength=num_trials)
+            / num_intervals
+        )
+        squares = np.bincount(
+            interval_trials,
+            weights=(intervals - mean[interval_trials]) ** 2,
+            minlength=num_trials,
+        )
+        std = np.sqrt(squares / (num_intervals - 1))
+    std[num_intervals < 2] = np.nan
+    return np.bincount(trial_index, minlength=num_trials), mean, std
+
+
+def block_gains(speeds, subjects, blocks):
+    """Micro-online and micro-offline gains of every block (see Bönstrup et al., 2019). The micro-online gain
+    is the change in tapping speed from the first to the last trial of a block, during practice. The
+    micro-offline gain is the change from the last trial of the previous block of the same subject to the first
+    trial of the block, over the rest between them.
+
+    Args:
+        speeds (np.ndarray): tapping speed of each trial, NaN if it doesn't have one. Trials must be sorted by
+            subject, block and trial, with the blocks of each subject in the order they were done.
+        subjects (np.ndarray): subject (as an integer code) of each trial
+        blocks (np.ndarray): block of each trial
+
+    Returns:
+        tuple: micro-online and micro-offline gain of the block of each trial, NaN if they can't be calculated
+    """
+    online = np.full(len(speeds), np.nan)
+    offline = np.full(len(speeds), np.nan)
+    if len(speeds) == 0:
+        return online, offline
+    block_starts = _group_starts(np.arange(len(speeds)), [subjects, blocks])
+    trial_block = np.cumsum(block_starts) - 1
+    num_blocks = trial_block[-1] + 1
+    with_speed = np.flatnonzero(~np.isnan(speeds))
+    speed_blocks = trial_block[with_speed]
+    # Blocks are in order, so the first and last trials with a speed of each block are found
+    #   as the first appearance of the block going forwards and backwards
+    blocks_with_speed, first_index = np.unique(speed_blocks, return_index=True)
+    last_index = (
+        len(speed_blocks) - 1 - np.unique(speed_blocks[::-1], return_index=True)[1]
+    )
+    first_speed = np.full(num_blocks, np.nan)
+    last_speed = np.full(num_blocks, np.nan)
+    first_speed[blocks_with_speed] = speeds[with_speed[first_index]]
+    last_speed[blocks_with_speed] = speeds[with_speed[last_index]]
+    block_online = last_speed - first_speed
+    block_offline = np.full(num_blocks, np.nan)
+    block_subjects = subjects[block_starts]
+    same_subject = block_subjects[1:] == block_subjects[:-1]
+    block_offline[1:][same_subject] = (first_speed[1:] - last_speed[:-1])[same_subject]
+    return block_online[trial_block], block_offline[trial_block]
+
+
+def segment_means(values, starts, lengths):
+    """Mean of values[start:start + length] for every segment.
+    Segments of the same length are reduced together as rows of a matrix, which sums them exactly
+    as np.mean would. Segments without elements get NaN.
+
+    Args:
+        values (np.ndarray): float values
+        starts (np.ndarray): start of each segment
+        lengths (np.ndarray): number of elements of each segment
+
+    Returns:
+        np.ndarray: mean of each segment
+    """
+    means = np.full(len(starts), np.nan)
+    for length in np.unique(lengths[lengths > 0]):
+        selected = np.flatnonzero(lengths == length)
+        segments = values[starts[selected, None] + np.arange(length)]
+        means[selected] = segments.sum(axis=1) / length
+    return means
+
+
+def tapping_metrics(
+    trial_index, timestamps, previous, correct, min_ms_between_keypresses
+):
+    """Calculates the execution time and tapping speeds of every trial.
+    Only correct trials with keypresses get values; the rest are NaN.
+
+    Args:
+        trial_index (np.ndarray): index of the trial each keypress belongs to
+        timestamps (np.ndarray): timestamp of each keypress, in microseconds
+        previous (np.ndarray): index of the trial before each trial in the same block, or -1
+        correct (np.ndarray): whether each trial was correct
+        min_ms_between_keypresses (int): minimum possible time between two keypresses. Shorter
+            times come from errors capturing the keypresses, and are replaced by this value.
+
+    Returns:
+        tuple: execution time in milliseconds, tapping speed, and tapping speed that also considers
+            the time between the last keypress of the previous trial and the first of the current one
+    """
+    num_trials = len(correct)
+    order = np.lexsort((timestamps, trial_index))
+    trial_index = trial_index[order]
+    timestamps = timestamps[order]
+    counts = np.bincount(trial_index, minlength=num_trials)
+    starts = np.cumsum(counts) - counts
+    has_keypresses = counts > 0
+    first = np.zeros(num_trials, dtype=np.int64)
+    last = np.zeros(num_trials, dtype=np.int64)
+    first[has_keypresses] = timestamps[starts[has_keypresses]]
+    last[has_keypresses] = timestamps[
+        starts[has_keypresses] + counts[has_keypresses] - 1
+    ]
+
+    # Elapsed time in seconds before each keypress. The first keypress of every trial holds the
+    # time since the last keypress of the previous trial instead.
+    elapsed = np.full(len(timestamps), np.nan)
+    elapsed[1:] = np.diff(timestamps) / 1e6
+    min_elapsed = min_ms_between_keypresses / 1000
+    elapsed = np.where(elapsed < min_elapsed, min_elapsed, elapsed)
+    with_extra = has_keypresses & (previous >= 0)
+    with_extra[with_extra] = has_keypresses[previous[with_extra]]
+    elapsed[starts[has_keypresses]] = np.nan
+    elapsed[starts[with_extra]] = (first[with_extra] - last[previous[with_extra]]) / 1e6
+
+    lengths = np.maximum(counts - 1, 0)
+    mean_elapsed = segment_means(elapsed, starts + 1, lengths)
+    mean_elapsed_extra = segment_means(
+        elapsed,
+        np.where(with_extra, starts, starts + 1),
+        np.where(with_extra, counts, lengths),
+    )
+
+    valid = correct & has_keypresses
+    with np.errstate(divide="ignore"):
+        tapping_speed = np.where(valid, 1 / mean_elapsed, np.nan)
+        tapping_speed_extra = np.where(valid, 1 / mean_elapsed_extra, np.nan)
+    execution_time_ms = np.where(valid, (last - first) / 1e6 * 1000, np.nan)
+    return execution_time_ms, tapping_speed, tapping_speed_extra
+
+
+def keypress_diffs_ms(timestamps, subjects, min_ms_between_keypresses):
+    """Milliseconds between each keypress and the one before it, when both come from the same subject.
+    Differences shorter than the minimum possible are replaced by the minimum.
+
+    Args:
+        timestamps (np.ndarray): keypress timestamps in microseconds. Can contain MISSING_TIMESTAMP.
+        subjects (np.ndarray): subject (as an integer code) of each keypress
+        min_ms_between_keypresses (int): minimum possible time between two keypresses
+
+    Returns:
+        tuple: difference in milliseconds (NaN when there is none), and whether it was replaced by the minimum
+    """
+    diffs = np.full(len(timestamps), np.nan)
+    present = timestamps != MISSING_TIMESTAMP
+    valid = np.zeros(len(timestamps), dtype=bool)
+    valid[1:] = present[1:] & present[:-1] & (subjects[1:] == subjects[:-1])
+    # Same operations as timedelta.total_seconds() * 1000, so the values are identical
+    diffs[valid] = np.diff(timestamps)[valid[1:]] / 1e6 * 1000
+    clamped = valid & (diffs < min_ms_between_keypresses)
+    return diffs, clamped
+
+
+def keypresses_match_sequence(sequences, sequence_index, positions, values):
+    """Checks whether each keypress is the expected character of its sequence
+
+    Args:
+        sequences (list): distinct sequences
+        sequence_index (np.ndarray): index in sequences of the sequence of each keypress
+        positions (np.ndarray): position of each keypress inside its trial, starting at 0
+        values (np.ndarray): value of each keypress, or an empty string if there is none
+
+    Returns:
+        np.ndarray: whether each keypress matched the character at its position of the sequence
+    """
+    max_length = max((len(sequence) for sequence in sequences), default=0)
+    # One row per sequence. The extra column is empty, and is used for positions past the end of a sequence.
+    characters = np.full((len(sequences), max_length + 1), "", dtype="U1")
+    for row, sequence in enumerate(sequences):
+        characters[row, : len(sequence)] = list(sequence)
+    expected = characters[sequence_index, np.minimum(positions, max_length)]
+    return (expected != "") & (expected == values)
+
+
+def format_timestamps(timestamps):
+    """Formats timestamps as YYYY-MM-DD HH:MM:SS.ffffff strings, in UTC
+
+    Args:
+        timestamps (np.ndarray): timestamps in microseconds. Can contain MISSING_TIMESTAMP.
+
+    Returns:
+        list: formatted timestamps, with None for the missing ones
+    """
+    formatted = np.char.replace(
+        np.datetime_as_string(timestamps.astype("datetime64[us]"), unit="us"), "T", " "
+    ).astype(object)
+    formatted[timestamps == MISSING_TIMESTAMP] = None
+    return formatted.tolist()
+
+
+def nan_to_none(values):
+    """Converts an array into a list, replacing NaN by None
+
+    Args:
+        values (np.ndarray): float array
+
+    Returns:
+        list: Python values
+    """
+    return [None if np.isnan(value) else value for value in values.tolist()]
+
+
+def pack_keypresses(offsets, values):
+    """Packs the keypresses of a trial into bytes: the little-endian int64 offsets of all keypresses,
+    followed by their values as UTF-32 characters (the layout of a NumPy "<U1" array, where an empty
+    value is a null character).
+
+    Args:
+        offsets (list): microseconds between the start of the trial and each keypress
+        values (list): value of each keypress, as a single character
+
+    Returns:
+        bytes: packed keypresses
+    """
+    return (
+        np.asarray(offsets, dtype="<i8").tobytes()
+        + np.asarray(values, dtype="<U1").tobytes()
+    )
+
+
+def unpack_keypresses(packed):
+    """Unpacks the keypresses of several trials, packed with pack_keypresses
+
+    Args:
+        packed (list): packed keypresses of each trial
+
+    Returns:
+        tuple: number of keypresses of each trial, and the offset and value of every keypress,
+            one trial after the other
+    """
+    counts = np.fromiter(
+        (len(trial) // PACKED_KEYPRESS_SIZE for trial in packed),
+        dtype=np.int64,
+        count=len(packed),
+    )
+    offsets = [np.array([], dtype=np.int64)]
+    values = [np.array([], dtype="U1")]
+    for trial, count in zip(packed, counts.tolist()):
+        offsets.append(np.frombuffer(trial, dtype="<i8", count=count))
+        values.append(np.frombuffer(trial, dtype="<U1", offset=8 * count))
+    return counts, np.concatenate(offsets).astype(np.int64), np.concatenate(values)
@@ -0,0 +1,70 @@
+"""Routing of the participants of a study to their next experiment.
+
+The first time a subject enters a study they are assigned to one of its groups (see Study.assign_subject), and
+every time they come back they are sent to the experiments of that group in order. For now, experiments are
+ordered by the date they were created at.
+"""
+
+from django.db.models import Exists, OuterRef, Subquery
+
+from .models import Experiment, GroupAssignment, Participation
+
+
+def _pending_experiments(group, subject):
+    """Enabled and published experiments of a group that the subject hasn't done yet, in the order they should be done
+
+    Args:
+        group: group code, or a reference to it in an outer query
+        subject (Subject): subject doing the experiments
+
+    Returns:
+        QuerySet: pending experiments
+    """
+    done = Participation.objects.filter(experiment=OuterRef("pk"), subject=subject)
+    return (
+        Experiment.objects.filter(group=group, enabled=True, published=True)
+        .filter(~Exists(done))
+        .order_by("created_at")
+    )
+
+
+def next_experiment(group, subject):
+    """Finds the next experiment of a group that a subject should do, in a single query
+
+    Args:
+        group (Group or str): group of the experiments, or its code
+        subject (Subject): subject doing the experiments
+
+    Returns:
+        str: code of the experiment, or None if the subject has done all of them
+    """
+    return _pending_experiments(group, subject).values_list("code", flat=True).first()
+
+
+def route_subject(study, subject):
+    """Finds the next experiment of a study that a subject should do.
+    For subjects that already belong to a group of the study, the group and its next experiment are found in a
+    single query. Subjects entering the study for the first time are assigned to a group first.
+
+    Args:
+        study (Study): study the subject entered
+        subject (Subject): subject doing the experiments
+
+    Returns:
+        str: code of the experiment, or None if there are no experiments left for the subject
+    """
+    next_experiment_code = Subquery(
+        _pending_experiments(OuterRef("group_id"), subject).values("code")[:1]
+    )
+    assignment = (
+        GroupAssignment.objects.filter(study=study, subject=subject)
+        .annotate(next_experiment_code=next_experiment_code)
+        .values_list("group_id", "next_experiment_code")
+        .first()
+    )
+    if assignment is not None:
+        return assignment[1]
+    group_code = study.assign_subject(subject)
+    if group_code is None:
+        return None
+    return next_experiment(group_code, subject)
@@ -0,0 +1,284 @@
+"""Backends that store the experiment files (consent forms and videos) and the processed data files.
+
+The backend is chosen with the FILE_STORAGE_BACKEND setting, and a single instance is shared by the
+whole process (see get_storage). Files are identified by names like "raw_data/ABCD.csv", and can
+have a dictionary of string metadata.
+"""
+
+from collections import namedtuple
+from functools import lru_cache
+import json
+import os
+import shutil
+import tempfile
+import threading
+
+from django.conf import settings
+from django.utils.module_loading import import_string
+
+from google.cloud import storage
+
+from .instrumentation import storage_call
+
+# Information about a stored file. The generation identifies the version of the file in Cloud Storage, so that
+#   every read of the file gets the same version, and is None in the other backends.
+StoredFile = namedtuple(
+    "StoredFile", ["name", "size", "metadata", "generation"], defaults=[None]
+)
+# Size in bytes of each piece of a large file uploaded to Cloud Storage. Must be a multiple of 256 KB.
+UPLOAD_CHUNK_SIZE = 8 * 1024 * 1024
+
+
+@lru_cache(maxsize=None)
+def get_storage():
+    """Returns the storage backend given by the FILE_STORAGE_BACKEND setting.
+    The backend is created the first time, and then reused by the rest of the requests of the process.
+    """
+    return import_string(settings.FILE_STORAGE_BACKEND)()
+
+
+class StorageBackend:
+    """Interface implemented by every storage backend"""
+
+    def get(self, name):
+        """Gets the information of a stored file
+
+        Args:
+            name (str): name of the file
+
+        Returns:
+            StoredFile: information of the file, or None if it doesn't exist
+        """
+        raise NotImplementedError
+
+    def read_chunks(self, stored_file, chunk_size):
+        """Generator that reads a stored file in chunks of bytes
+
+        Args:
+            stored_file (StoredFile): file to read
+            chunk_size (int): size in bytes of each chunk
+        """
+        raise NotImplementedError
+
+    def download_to_file(self, name, file):
+        """Writes the contents of a stored file into a binary file object
+
+        Args:
+            name (str): name of the file
+            file (file): binary file to write to
+        """
+        raise NotImplementedError
+
+    def upload_file(self, name, file, content_type, metadata=None):
+        """Stores the contents of a binary file object, replacing the file if it already exists
+
+        Args:
+            name (str): name of the file
+            file (file): binary file to read from, starting at its current position
+            content_type (str): type of the content (e.g. "text/csv")
+            metadata (dict, optional): string metadata to save with the file
+        """
+        raise NotImplementedError
+
+    def list(self, prefix):
+        """Names of the stored files that start with the given prefix
+
+        Args:
+            prefix (str): start of the names
+        """
+        raise NotImplementedError
+
+    def delete(self, name):
+        """Deletes a stored file
+
+        Args:
+            name (str): name of the file
+        """
+        raise NotImplementedError
+
+    def copy(self, source, destination):
+        """Copies a stored file, replacing the destination if it already exists
+
+        Args:
+            source (str): name of the file to copy
+            destination (str): name of the copy
+        """
+        raise NotImplementedError
+
+
+class GoogleCloudStorage(StorageBackend):
+    """Stores the files in the Google Cloud Storage bucket given by the FILE_STORAGE_BUCKET setting.
+    Every call to Cloud Storage is measured by the request instrumentation (see gestureApp.instrumentation).
+    """
+
+    def __init__(self):
+        self.bucket = storage.Client().bucket(settings.FILE_STORAGE_BUCKET)
+
+    def get(self, name):
+        with storage_call():
+            blob = self.bucket.get_blob(name)
+        if blob is None:
+            return None
+        return StoredFile(name, blob.size, blob.metadata or {}, blob.generation)
+
+    def read_chunks(self, stored_file, chunk_size):
+        # Every range is read from the generation given by get. If the file is replaced in the meantime, the
+        #   read fails instead of mixing the bytes of both versions.
+        blob = self.bucket.blob(stored_file.name, generation=stored_file.generation)
+        for start in range(0, stored_file.size, chunk_size):
+            end = min(start + chunk_size, stored_file.size) - 1
+            # Checksums are computed over the full file, so they can't be validated for a range
+            with storage_call():
+                chunk = blob.download_as_bytes(start=start, end=end, checksum=None)
+            yield chunk
+
+    def download_to_file(self, name, file):
+        with storage_call():
+            self.bucket.blob(name).download_to_file(file)
+
+    def upload_file(self, name, file, content_type, metadata=None):
+        # Size of the rest of the file
+        start = file.tell()
+        size = file.seek(0, os.SEEK_END) - start
+        file.seek(start)
+        # Large files are sent with a resumable upload, reading one chunk of the file at a time, so
+        #   they never have to fit in memory. Small ones are sent in a single multipart request.
+        chunk_size = UPLOAD_CHUNK_SIZE if size > UPLOAD_CHUNK_SIZE else None
+        blob = self.bucket.blob(name, chunk_size=chunk_size)
+        blob.metadata = metadata
+        with storage_call():
+            blob.upload_from_file(file, size=size, content_type=content_type)
+
+    def list(self, prefix):
+        with storage_call():
+            return [blob.name for blob in self.bucket.list_blobs(prefix=prefix)]
+
+    def delete(self, name):
+        with storage_call():
+            self.bucket.blob(name).delete()
+
+    def copy(self, source, destination):
+        with storage_call():
+            self.bucket.copy_blob(self.bucket.blob(source), self.bucket, destination)
+
+
+class LocalFileSystemStorage(StorageBackend):
+    """Stores the files in the local directory given by the FILE_STORAGE_ROOT setting.
+    The metadata of each file is saved as json in a separate ".metadata" directory.
+    """
+
+    METADATA_DIRECTORY = ".metadata"
+
+    def __init__(self):
+        self.root = settings.FILE_STORAGE_ROOT
+
+    def _path(self, name):
+        return os.path.join(self.root, *name.split("/"))
+
+    def _metadata_path(self, name):
+        return os.path.join(self.root, self.METADATA_DIRECTORY, *name.split("/"))
+
+    def _write(self, path, file):
+        """Writes the file into a temporary file first, so that readers never see a partial file"""
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        with tempfile.NamedTemporaryFile(
+            dir=os.path.dirname(path), delete=False
+        ) as temporary_file:
+            shutil.copyfileobj(file, temporary_file)
+        os.replace(temporary_file.name, path)
+
+    def get(self, name):
+        path = self._path(name)
+        if not os.path.isfile(path):
+            return None
+        metadata = {}
+        if os.path.isfile(self._metadata_path(name)):
+            with open(self._metadata_path(name)) as f:
+                metadata = json.load(f)
+        return StoredFile(name, os.path.getsize(path), metadata)
+
+    def read_chunks(self, stored_file, chunk_size):
+        with open(self._path(stored_file.name), "rb") as f:
+            yield from iter(lambda: f.read(chunk_size), b"")
+
+    def download_to_file(self, name, file):
+        with open(self._path(name), "rb") as f:
+            shutil.copyfileobj(f, file)
+
+    def upload_file(self, name, file, content_type, metadata=None):
+        self._write(self._path(name), file)
+        metadata_path = self._metadata_path(name)
+        if metadata:
+            os.makedirs(os.path.dirname(metadata_path), exist_ok=True)
+            with open(metadata_path, "w") as f:
+                json.dump(metadata, f)
+        elif os.path.isfile(metadata_path):
+            os.remove(metadata_path)
+
+    def list(self, prefix):
+        names = []
+        for directory, directories, files in os.walk(self.root):
+            if directory == self.root and self.METADATA_DIRECTORY in directories:
+                directories.remove(self.METADATA_DIRECTORY)
+            relative_directory = os.path.relpath(directory, self.root)
+            for file_name in files:
+                path = os.path.normpath(os.path.join(relative_directory, file_name))
+                name = "/".join(path.split(os.sep))
+                if name.startswith(prefix):
+                    names.append(name)
+        return sorted(names)
+
+    def delete(self, name):
+        os.remove(self._path(name))
+        if os.path.isfile(self._metadata_path(name)):
+            os.remove(self._metadata_path(name))
+
+    def copy(self, source, destination):
+        with open(self._path(source), "rb") as f:
+            self._write(self._path(destination), f)
+        if os.path.isfile(self._metadata_path(source)):
+            with open(self._metadata_path(source), "rb") as f:
+                self._write(self._metadata_path(destination), f)
+
+
+class InMemoryStorage(StorageBackend):
+    """Keeps the files in memory. Useful for tests and benchmarks, as nothing leaves the process."""
+
+    def __init__(self):
+        self.files = {}
+        self.lock = threading.Lock()
+
+    def get(self, name):
+        with self.lock:
+            if name not in self.files:
+                return None
+            content, metadata = self.files[name]
+        return StoredFile(name, len(content), dict(metadata))
+
+    def read_chunks(self, stored_file, chunk_size):
+        with self.lock:
+            content = self.files[stored_file.name][0]
+        for start in range(0, len(content), chunk_size):
+            yield content[start : start + chunk_size]
+
+    def download_to_file(self, name, file):
+        with self.lock:
+            content = self.files[name][0]
+        file.write(content)
+
+    def upload_file(self, name, file, content_type, metadata=None):
+        content = file.read()
+        with self.lock:
+            self.files[name] = (content, dict(metadata or {}))
+
+    def list(self, prefix):
+        with self.lock:
+            return sorted(name for name in self.files if name.startswith(prefix))
+
+    def delete(self, name):
+        with self.lock:
+            del self.files[name]
+
+    def copy(self, source, destination):
+        with self.lock:
+            self.files[destination] = self.files[source]
@@ -0,0 +1,286 @@
+"""Generation of synthetic experiment data, to measure the performance of the app at realistic sizes.
+
+Subjects perform every block of an experiment, pressing the keys of the block sequence with log-normal times
+between keypresses that get shorter as they practice. They sometimes press a wrong key, press a key twice by
+accident, or run out of time before finishing a trial.
+"""
+
+from datetime import timedelta
+import json
+import random
+import string
+
+from django.conf import settings
+from django.db import transaction
+from django.utils import timezone
+
+import numpy as np
+
+from . import processing
+from .models import (
+    Block,
+    EndSurvey,
+    Experiment,
+    Group,
+    GroupAssignment,
+    Keypress,
+    Study,
+    Subject,
+    Trial,
+)
+from .trial_metrics import rebuild_trial_metrics
+
+# Number of rows sent to the database per INSERT
+BATCH_SIZE = 1000
+# Number of subjects saved in each transaction
+SUBJECTS_PER_TRANSACTION = 50
+# Median time in milliseconds from the start of a trial to the first keypress
+REACTION_TIME_MS = 450
+# Median time in milliseconds between consecutive keypresses, before any practice, and its log-normal spread
+INTER_KEY_MS = 300
+INTER_KEY_SIGMA = 0.4
+# Fraction of the time between keypresses that is lost with practice, and how fast (per block)
+PRACTICE_GAIN = 0.4
+PRACTICE_RATE = 0.5
+# Spread of the speed of the subjects around the median
+SUBJECT_SPEED_SIGMA = 0.25
+# Probabilities of pressing a wrong key and of pressing a key twice by accident
+ERROR_PROBABILITY = 0.04
+DOUBLE_PRESS_PROBABILITY = 0.02
+# Probability that a subject fills the end survey
+SURVEY_PROBABILITY = 0.8
+# Days over which the subjects start the experiment, after it is published
+DAYS_OF_RESPONSES = 30
+
+
+def _from_microseconds(timestamp):
+    """Converts microseconds since the epoch into an aware datetime"""
+    return processing.EPOCH + timedelta(microseconds=int(timestamp))
+
+
+def subject_trials(blocks, started_at, rng):
+    """Generates the trials of a subject that performs the blocks of an experiment in order
+
+    Args:
+        blocks (list): blocks of the experiment
+        started_at (int): microseconds since the epoch at which the subject starts the experiment
+        rng (numpy.random.Generator): source of randomness
+
+    Yields:
+        tuple: block, starting and finishing time (microseconds since the epoch), correct, partial_correct
+            and keypresses of each trial. Keypresses are (value, microseconds since the epoch) tuples.
+    """
+    t = started_at
+    subject_speed = rng.lognormal(0, SUBJECT_SPEED_SIGMA)
+    for block_index, block in enumerate(blocks):
+        practice = 1 - PRACTICE_GAIN * (1 - np.exp(-PRACTICE_RATE * block_index))
+        inter_key_ms = INTER_KEY_MS * subject_speed * practice
+        for _ in range(block.num_trials):
+            timestamp = t + rng.lognormal(np.log(REACTION_TIME_MS), 0.3) * 1000
+            deadline = t + block.max_time_per_trial * 1_000_000
+            keypresses = []
+            correct = True
+            for key in block.sequence:
+                if keypresses:
+                    timestamp += (
+                        rng.lognormal(np.log(inter_key_ms), INTER_KEY_SIGMA) * 1000
+                    )
+                if timestamp > deadline:
+                    correct = False
+                    break
+                value = key
+                if rng.random() < ERROR_PROBABILITY:
+                    value = str((int(key) + rng.integers(1, 10)) % 10)
+                    correct = False
+                keypresses.append((value, int(timestamp)))
+                if rng.random() < DOUBLE_PRESS_PROBABILITY:
+                    # Pressed again a few milliseconds later
+                    timestamp += rng.uniform(1, 9) * 1000
+                    keypresses.append((value, int(timestamp)))
+            finished_at = int(min(timestamp + rng.uniform(5, 50) * 1000, deadline))
+            # Partially correct if the keys pressed before running out of time were right
+            partial_correct = correct or all(
+                value == key for (value, _), key in zip(keypresses, block.sequence)
+            )
+            yield block, int(t), finished_at, correct, partial_correct, keypresses
+            # Feedback between trials
+            t = finished_at + rng.uniform(0.3, 1) * 1_000_000
+        t += block.resting_time * 1_000_000
+
+
+def subject_performance(experiment, seed=None):
+    """Body of a create_trials request with the performance of a new synthetic subject in an experiment
+
+    Args:
+        experiment (Experiment): experiment performed
+        seed (int, optional): seed of the random generator
+
+    Returns:
+        dict: request body, like the one sent by the experiment page
+    """
+    rng = np.random.default_rng(seed)
+    blocks = list(experiment.blocks.order_by("id"))
+    experiment_trials = [[] for _ in blocks]
+    block_index = {block.id: i for i, block in enumerate(blocks)}
+    started_at = processing.to_microseconds(timezone.now())
+    for trial in subject_trials(blocks, started_at, rng):
+        block, trial_started_at, finished_at, correct, partial_correct, keypresses = (
+            trial
+        )
+        experiment_trials[block_index[block.id]].append(
+            {
+                "started_at": trial_started_at / 1000,
+                "finished_at": finished_at / 1000,
+                "correct": correct,
+                "partial_correct": partial_correct,
+                "keypresses": [
+                    {"value": value, "timestamp": timestamp / 1000}
+                    for value, timestamp in keypresses
+                ],
+            }
+        )
+    return {
+        "experiment": experiment.code,
+        "subject_code": "",
+        "timezone_offset_sec": 0,
+        "experiment_trials": json.dumps(experiment_trials),
+    }
+
+
+def _trial(
+    subject, block, started_at, finished_at, correct, partial_correct, keypresses
+):
+    """Builds a trial and its keypresses, saving the keypresses the way set by the PACKED_KEYPRESSES setting"""
+    trial = Trial(
+        block=block,
+        subject=subject,
+        started_at=_from_microseconds(started_at),
+        finished_at=_from_microseconds(finished_at),
+        correct=correct,
+        partial_correct=partial_correct,
+    )
+    if settings.PACKED_KEYPRESSES:
+        trial.packed_keypresses = processing.pack_keypresses(
+            [timestamp - started_at for _, timestamp in keypresses],
+            [value for value, _ in keypresses],
+        )
+        if keypresses:
+            trial.packed_first_keypress_at = _from_microseconds(keypresses[0][1])
+        return trial, []
+    return trial, [
+        Keypress(trial=trial, value=value, timestamp=_from_microseconds(timestamp))
+        for value, timestamp in keypresses
+    ]
+
+
+def _end_survey(experiment, subject, rng):
+    """Builds the end survey of a subject, with random answers"""
+    return EndSurvey(
+        experiment=experiment,
+        subject=subject,
+        age=int(rng.integers(18, 70)),
+        gender=str(rng.choice(["female", "male", "other"])),
+        comp_type=str(rng.choice(["laptop", "desktop"])),
+        comments="",
+        medical_condition=rng.random() < 0.1,
+        hours_of_sleep=int(rng.integers(4, 10)),
+        excercise_regularly=rng.random() < 0.5,
+        keypress_experiment_before=rng.random() < 0.2,
+        followed_instructions=rng.random() < 0.95,
+        hand_used="right",
+        dominant_hand=str(rng.choice(["right", "left"], p=[0.9, 0.1])),
+        level_education=str(rng.choice(["high_school", "bachelor", "master", "phd"])),
+    )
+
+
+def generate_experiment(
+    user, num_subjects, num_blocks, trials_per_block, sequence_length=5, seed=None
+):
+    """Creates a published study with a single group and experiment, performed by synthetic subjects
+
+    Args:
+        user (User): creator of the study
+        num_subjects (int): number of subjects that performed the experiment
+        num_blocks (int): number of blocks of the experiment
+        trials_per_block (int): number of trials of each block
+        sequence_length (int, optional): number of keys of the sequence of each block. Defaults to 5.
+        seed (int, optional): seed of the random generators, to generate the same data again
+
+    Returns:
+        Experiment: the generated experiment
+    """
+    rng = np.random.default_rng(seed)
+    sequences = random.Random(seed)
+    published_at = timezone.now() - timedelta(days=DAYS_OF_RESPONSES + 1)
+    with transaction.atomic():
+        study = Study.objects.create(
+            name=f"Synthetic study ({num_subjects} subjects)",
+            creator=user,
+            published=True,
+            published_timestamp=published_at,
+        )
+        group = Group.objects.create(name="Synthetic group", study=study, creator=user)
+        experiment = Experiment.objects.create(
+            name=f"Synthetic experiment ({num_subjects}x{num_blocks}x{trials_per_block})",
+            study=study,
+            group=group,
+            creator=user,
+            requirements="",
+            published=True,
+            published_timestamp=published_at,
+        )
+        blocks = [
+            Block.objects.create(
+                experiment=experiment,
+                sequence="".join(
+                    sequences.choices(string.digits[1:], k=sequence_length)
+                ),
+                seq_length=sequence_length,
+                type=Block.BlockTypes.NUM_TRIALS,
+                num_trials=trials_per_block,
+            )
+            for _ in range(num_blocks)
+        ]
+
+    published_at = processing.to_microseconds(published_at)
+    for start in range(0, num_subjects, SUBJECTS_PER_TRANSACTION):
+        num_batch_subjects = min(SUBJECTS_PER_TRANSACTION, num_subjects - start)
+        # Subject codes are random like the ones from Subject.save, even with a seed, so that
+        #   the same data can be generated more than once in a database
+        subjects = [
+            Subject(
+                code="".join(random.choices(string.ascii_letters + string.digits, k=16))
+            )
+            for _ in range(num_batch_subjects)
+        ]
+        trials = []
+        keypresses = []
+        surveys = []
+        for subject in subjects:
+            days = rng.uniform(0, DAYS_OF_RESPONSES)
+            subject_started_at = published_at + days * 24 * 60 * 60 * 1_000_000
+            for trial_data in subject_trials(blocks, subject_started_at, rng):
+                trial, trial_keypresses = _trial(subject, *trial_data)
+                trials.append(trial)
+                keypresses.extend(trial_keypresses)
+            if rng.random() < SURVEY_PROBABILITY:
+                surveys.append(_end_survey(experiment, subject, rng))
+        with transaction.atomic():
+            Subject.objects.bulk_create(subjects, batch_size=BATCH_SIZE)
+            Trial.objects.bulk_create(trials, batch_size=BATCH_SIZE)
+            # The keypresses take the ids of their trials once these are saved
+            Keypress.objects.bulk_create(keypresses, batch_size=BATCH_SIZE)
+            EndSurvey.objects.bulk_create(surveys, batch_size=BATCH_SIZE)
+            GroupAssignment.objects.bulk_create(
+                [
+                    GroupAssignment(study=study, group=group, subject=subject)
+                    for subject in subjects
+                ],
+                batch_size=BATCH_SIZE,
+            )
+
+    experiment.rebuild_participations()
+    # Saved by create_trials for real subjects
+    rebuild_trial_metrics(experiment)
+    Group.objects.filter(pk=group.pk).update(num_participants=num_subjects)
+    return experiment
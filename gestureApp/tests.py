@@ -1,3 +1,1041 @@
-from django.test import TestCase
+import csv
+from datetime import datetime, timedelta
+import io
+import json
+import os
+import random
+import zipfile
 
-# Create your tests here.
+from django.core.cache import cache
+from django.core.management import call_command
+from django.db import IntegrityError, connection
+from django.test import TestCase, TransactionTestCase, override_settings
+from django.test.utils import CaptureQueriesContext
+from django.urls import reverse
+from django.utils import timezone
+
+import numpy as np
+
+from . import columnar, instrumentation, processing
+from .analytics import process_study_analytics
+from .models import (
+    Block,
+    Experiment,
+    Group,
+    GroupAssignment,
+    Keypress,
+    Participation,
+    Study,
+    Subject,
+    Trial,
+    TrialMetrics,
+    User,
+)
+from .routing import route_subject
+from .storage_backends import InMemoryStorage, get_storage
+from .synthetic_data import generate_experiment, subject_performance
+from .trial_metrics import load_keypresses, rebuild_trial_metrics, trial_metrics
+from .views import (
+    EXPORT_COLUMNS,
+    SURVEY_COLUMNS,
+    _stored_process_data_columns,
+    csv_lines,
+    learning_curve,
+    process_bonstrup,
+    process_data,
+    raw_data,
+    raw_data_chunks,
+    survey_rows,
+)
+
+# Expected outputs of the golden tests
+TEST_DATA_DIR = os.path.join(os.path.dirname(__file__), "test_data")
+
+
+class StudyToDictsTests(TestCase):
+    """Tests for Study.to_dicts, which loads the studies of the profile page"""
+
+    def setUp(self):
+        self.user = User.objects.create(username="researcher")
+        self.subjects = [Subject.objects.create() for _ in range(3)]
+
+    def create_study(self, num_groups, published_timestamp=None):
+        """Creates a study with one experiment per group, and a response from every subject to each experiment"""
+        study = Study.objects.create(name="study", creator=self.user)
+        now = timezone.now()
+        for i in range(num_groups):
+            group = Group.objects.create(
+                name=f"group {i}", study=study, creator=self.user
+            )
+            experiment = Experiment.objects.create(
+                name=f"experiment {i}",
+                study=study,
+                group=group,
+                creator=self.user,
+                requirements="",
+                published=published_timestamp is not None,
+                published_timestamp=published_timestamp,
+            )
+            for days, subject in enumerate(self.subjects):
+                Participation.objects.create(
+                    experiment=experiment,
+                    subject=subject,
+                    first_trial_at=now - timedelta(days=days),
+                    last_trial_at=now - timedelta(days=days),
+                )
+        return study
+
+    def test_number_of_queries_does_not_depend_on_number_of_studies(self):
+        self.create_study(1)
+        with self.assertNumQueries(3):
+            Study.to_dicts(self.user.studies.all())
+        for _ in range(5):
+            self.create_study(3)
+        with self.assertNumQueries(3):
+            study_dicts = Study.to_dicts(self.user.studies.all())
+        self.assertEqual(len(study_dicts), 6)
+        self.assertEqual(sum(len(s["experiments"]) for s in study_dicts), 1 + 5 * 3)
+
+    def test_responses(self):
+        unpublished = self.create_study(2)
+        # Only the first two subjects responded after publishing
+        published = self.create_study(
+            1, published_timestamp=timezone.now() - timedelta(days=1, hours=12)
+        )
+        study_dicts = {s["code"]: s for s in Study.to_dicts(self.user.studies.all())}
+        self.assertEqual(
+            [e["responses"] for e in study_dicts[unpublished.code]["experiments"]],
+            [3, 3],
+        )
+        self.assertEqual(
+            [e["responses"] for e in study_dicts[published.code]["experiments"]],
+            [2],
+        )
+        # Experiments are listed in their groups
+        for g in study_dicts[unpublished.code]["groups"]:
+            self.assertEqual(len(g["experiments"]), 1)
+            self.assertEqual(g["experiments"][0]["group"]["code"], g["code"])
+
+
+class UserExperimentsTests(TestCase):
+    """Tests for the user_experiments API"""
+
+    def setUp(self):
+        self.user = User.objects.create(username="researcher")
+        study = Study.objects.create(name="study", creator=self.user)
+        group = Group.objects.create(name="group", study=study, creator=self.user)
+        self.experiment = Experiment.objects.create(
+            name="experiment",
+            study=study,
+            group=group,
+            creator=self.user,
+            requirements="",
+        )
+        Participation.objects.create(
+            experiment=self.experiment,
+            subject=Subject.objects.create(),
+            first_trial_at=timezone.now(),
+            last_trial_at=timezone.now(),
+        )
+        self.client.force_login(self.user)
+
+    def test_etag(self):
+        url = reverse("gestureApp:user_experiments")
+        response = self.client.get(url)
+        self.assertEqual(response.json()["experiments"][0]["responses"], 1)
+        # Polling again with the ETag doesn't query the experiments
+        with self.assertNumQueries(2):
+            response = self.client.get(url, HTTP_IF_NONE_MATCH=response["ETag"])
+        self.assertEqual(response.status_code, 304)
+        # After a change, the experiments are sent again
+        self.client.get(
+            reverse("gestureApp:experiment_disable", args=[self.experiment.code])
+        )
+        response = self.client.get(url, HTTP_IF_NONE_MATCH=response["ETag"])
+        self.assertEqual(response.status_code, 200)
+        self.assertFalse(response.json()["experiments"][0]["enabled"])
+
+
+class RoutingTests(TestCase):
+    """Tests for the routing of subjects to the experiments of a study"""
+
+    def setUp(self):
+        self.user = User.objects.create(username="researcher")
+        self.study = Study.objects.create(
+            name="study", creator=self.user, published=True
+        )
+        self.groups = [
+            Group.objects.create(name=f"group {i}", study=self.study, creator=self.user)
+            for i in range(3)
+        ]
+        self.experiments = {
+            group.code: [
+                Experiment.objects.create(
+                    name=f"experiment {i}",
+                    study=self.study,
+                    group=group,
+                    creator=self.user,
+                    requirements="",
+                    published=True,
+                )
+                for i in range(2)
+            ]
+            for group in self.groups
+        }
+
+    def test_new_subjects_are_balanced(self):
+        for _ in range(9):
+            route_subject(self.study, Subject.objects.create())
+        self.assertEqual(
+            [group.num_participants for group in Group.objects.all()], [3, 3, 3]
+        )
+        self.assertEqual(GroupAssignment.objects.count(), 9)
+
+    def test_returning_subject(self):
+        subject = Subject.objects.create()
+        first_experiment = route_subject(self.study, subject)
+        group = GroupAssignment.objects.get(subject=subject).group
+        experiments = self.experiments[group.code]
+        self.assertEqual(first_experiment, experiments[0].code)
+        experiments[0].record_participation(subject, [timezone.now()])
+        # The group and the next experiment are found with a single query
+        with self.assertNumQueries(1):
+            self.assertEqual(route_subject(self.study, subject), experiments[1].code)
+        experiments[1].record_participation(subject, [timezone.now()])
+        self.assertIsNone(route_subject(self.study, subject))
+        self.assertEqual(Group.objects.get(pk=group.pk).num_participants, 1)
+
+
+# The experiment page is rendered without collecting the static files first
+@override_settings(
+    STATICFILES_STORAGE="django.contrib.staticfiles.storage.StaticFilesStorage"
+)
+class ExperimentConfigTests(TestCase):
+    """Tests for the cached configuration of the experiment view"""
+
+    def setUp(self):
+        cache.clear()
+        user = User.objects.create(username="researcher")
+        study = Study.objects.create(name="study", creator=user)
+        group = Group.objects.create(name="group", study=study, creator=user)
+        self.experiment = Experiment.objects.create(
+            name="experiment",
+            study=study,
+            group=group,
+            creator=user,
+            requirements="",
+            published=True,
+        )
+        self.url = reverse("gestureApp:experiment", args=[self.experiment.code])
+
+    def test_config_is_cached_until_changed(self):
+        response = self.client.get(self.url)
+        self.assertNotIn("responses", response.context["experiment"])
+        # Only the experiment is loaded when the configuration is cached
+        with self.assertNumQueries(1):
+            self.client.get(self.url)
+        Experiment.objects.filter(pk=self.experiment.pk).update(name="renamed")
+        self.experiment.config_changed()
+        response = self.client.get(self.url)
+        self.assertEqual(response.context["experiment"]["name"], "renamed")
+
+
+class SyntheticDataTests(TestCase):
+    """Tests for the synthetic data used by the benchmarks"""
+
+    def test_generate_experiment(self):
+        user = User.objects.create(username="researcher")
+        experiment = generate_experiment(user, 3, 2, 4, seed=0)
+        trials = Trial.objects.filter(block__experiment=experiment)
+        self.assertEqual(trials.count(), 3 * 2 * 4)
+        self.assertEqual(experiment.num_responses(), 3)
+        self.assertEqual(
+            [len(row) for row in process_data(user, experiment.code)], [10] * 24
+        )
+
+
+class CreateTrialsTests(TestCase):
+    """Tests for the submission of the trials of a subject"""
+
+    def setUp(self):
+        self.user = User.objects.create(username="researcher")
+        self.experiment = generate_experiment(self.user, 1, 2, 4, seed=0)
+
+    def submit(self, body):
+        return self.client.post(
+            reverse("gestureApp:create_trials"), body, content_type="application/json"
+        )
+
+    def test_new_subject(self):
+        with CaptureQueriesContext(connection) as queries:
+            response = self.submit(subject_performance(self.experiment, seed=1))
+        subject = Subject.objects.get(pk=response.json()["subject_code"])
+        self.assertEqual(subject.trials.count(), 2 * 4)
+        self.experiment.refresh_from_db()
+        self.assertEqual(self.experiment.trials_version, 2)
+        # The version is changed once the trials are committed, without locking the experiment while they are saved
+        statements = [query["sql"] for query in queries.captured_queries]
+        version_update = next(
+            i
+            for i, sql in enumerate(statements)
+            if sql.startswith("UPDATE") and "trials_version" in sql
+        )
+        open_savepoints = sum(
+            sql.startswith("SAVEPOINT") - sql.startswith("RELEASE SAVEPOINT")
+            for sql in statements[:version_update]
+        )
+        self.assertEqual(open_savepoints, 0)
+
+    def test_metrics_of_the_submitted_trials(self):
+        def stored_and_calculated(subject_code):
+            trials = Trial.objects.filter(subject=subject_code)
+            fields = [field.attname for field in TrialMetrics._meta.fields]
+            stored = list(
+                TrialMetrics.objects.filter(trial__in=trials)
+                .order_by("trial_id")
+                .values_list(*fields)
+            )
+            calculated = sorted(
+                tuple(getattr(metrics, field) for field in fields)
+                for metrics in trial_metrics(trials)
+            )
+            return stored, calculated
+
+        response = self.submit(subject_performance(self.experiment, seed=1))
+        subject_code = response.json()["subject_code"]
+        stored, calculated = stored_and_calculated(subject_code)
+        self.assertEqual(len(stored), 2 * 4)
+        self.assertEqual(stored, calculated)
+        # The same subject again, in the same blocks
+        body = subject_performance(self.experiment, seed=2)
+        body["subject_code"] = subject_code
+        self.submit(body)
+        stored, calculated = stored_and_calculated(subject_code)
+        self.assertEqual(len(stored), 2 * 2 * 4)
+        self.assertEqual(stored, calculated)
+
+    def test_failed_submission_leaves_no_subject(self):
+        body = subject_performance(self.experiment, seed=1)
+        experiment_trials = json.loads(body["experiment_trials"])
+        experiment_trials[1][0]["correct"] = None
+        body["experiment_trials"] = json.dumps(experiment_trials)
+        num_subjects = Subject.objects.count()
+        with self.assertRaises(IntegrityError):
+            self.submit(body)
+        self.assertEqual(Subject.objects.count(), num_subjects)
+
+    def test_fewer_blocks(self):
+        body = subject_performance(self.experiment, seed=1)
+        body["experiment_trials"] = json.dumps(
+            json.loads(body["experiment_trials"])[:1]
+        )
+        response = self.submit(body)
+        subject = Subject.objects.get(pk=response.json()["subject_code"])
+        first_block = self.experiment.blocks.order_by("id").first()
+        self.assertEqual(subject.trials.count(), 4)
+        self.assertEqual(subject.trials.filter(block=first_block).count(), 4)
+
+    def test_more_blocks(self):
+        body = subject_performance(self.experiment, seed=1)
+        experiment_trials = json.loads(body["experiment_trials"])
+        body["experiment_trials"] = json.dumps(
+            experiment_trials + experiment_trials[:1]
+        )
+        num_subjects = Subject.objects.count()
+        num_trials = Trial.objects.count()
+        response = self.submit(body)
+        self.assertEqual(response.status_code, 400)
+        self.assertEqual(Subject.objects.count(), num_subjects)
+        self.assertEqual(Trial.objects.count(), num_trials)
+
+
+class ExportColumnsTests(TestCase):
+    """Tests for the columns of the data files"""
+
+    def setUp(self):
+        self.user = User.objects.create(username="researcher")
+        self.client.force_login(self.user)
+
+    def test_columns_of_the_rows(self):
+        experiment = generate_experiment(self.user, 2, 2, 2, seed=0)
+        for name, rows in [
+            ("raw_data", list(raw_data(self.user, experiment.code))),
+            ("processed_data", process_data(self.user, experiment.code)),
+            ("bonstrup_processed", process_bonstrup(self.user, experiment.code)),
+        ]:
+            self.assertEqual(list(rows[0]), EXPORT_COLUMNS[name])
+        self.assertEqual(list(next(survey_rows(experiment))), SURVEY_COLUMNS)
+
+    def test_header_without_rows(self):
+        experiment = generate_experiment(self.user, 0, 2, 2, seed=0)
+        Experiment.objects.filter(pk=experiment.pk).update(published=False)
+        for name in EXPORT_COLUMNS:
+            response = self.client.get(
+                reverse(f"gestureApp:download_{name}"), {"code": experiment.code}
+            )
+            self.assertEqual(
+                b"".join(response.streaming_content).decode(),
+                ",".join(EXPORT_COLUMNS[name]) + "\r\n",
+            )
+        response = self.client.get(
+            reverse("gestureApp:download_survey", args=[experiment.code])
+        )
+        self.assertEqual(
+            b"".join(response.streaming_content).decode(),
+            ",".join(SURVEY_COLUMNS) + "\r\n",
+        )
+
+
+class GoldenOutputTests(TestCase):
+    """Compares the exports with the output of the original implementation for the same data,
+    saved in the test_data folder"""
+
+    def setUp(self):
+        self.user = User.objects.create(username="researcher")
+        study = Study.objects.create(name="study", creator=self.user)
+        group = Group.objects.create(name="group", study=study, creator=self.user)
+        self.experiment = Experiment.objects.create(
+            code="GOLD",
+            name="experiment",
+            creator=self.user,
+            study=study,
+            group=group,
+            published=True,
+            published_timestamp=timezone.make_aware(datetime(2022, 3, 1)),
+        )
+        blocks = [
+            Block.objects.create(
+                experiment=self.experiment,
+                sequence=sequence,
+                seq_length=len(sequence),
+                type=Block.BlockTypes.NUM_TRIALS,
+                num_trials=4,
+            )
+            for sequence in ["41324", "23142"]
+        ]
+        rng = random.Random(0)
+        started_at = timezone.make_aware(datetime(2022, 3, 2, 9))
+        for subject_index in range(3):
+            subject = Subject.objects.create(code=f"GOLDENSUBJECT{subject_index:03}")
+            for block in blocks:
+                for trial_index in range(block.num_trials):
+                    values = block.sequence
+                    kind = rng.random()
+                    if subject_index == 1 and block == blocks[0] and trial_index == 2:
+                        # Timed out without any keypress
+                        values = ""
+                    elif kind < 0.2:
+                        # Wrong key
+                        position = rng.randrange(len(values))
+                        values = values[:position] + "9" + values[position + 1 :]
+                    elif kind < 0.35:
+                        # Timed out
+                        values = values[: rng.randrange(1, len(values))]
+                    timestamp = started_at + timedelta(
+                        milliseconds=rng.randrange(300, 700)
+                    )
+                    keypresses = []
+                    for value in values:
+                        keypresses.append(Keypress(value=value, timestamp=timestamp))
+                        # Some intervals are shorter than MIN_MS_BETW_KEYPRESSES
+                        timestamp += timedelta(
+                            milliseconds=(
+                                rng.randrange(150, 450)
+                                if rng.random() < 0.9
+                                else rng.randrange(1, 8)
+                            ),
+                            microseconds=rng.randrange(1000),
+                        )
+                    if len(values) < len(block.sequence):
+                        finished_at = started_at + timedelta(
+                            seconds=block.max_time_per_trial
+                        )
+                    else:
+                        finished_at = timestamp
+                    trial = Trial.objects.create(
+                        block=block,
+                        subject=subject,
+                        started_at=started_at,
+                        finished_at=finished_at,
+                        correct=values == block.sequence,
+                        partial_correct=values != ""
+                        and block.sequence.startswith(values),
+                    )
+                    for keypress in keypresses:
+                        keypress.trial = trial
+                    Keypress.objects.bulk_create(keypresses)
+                    started_at = finished_at + timedelta(seconds=1)
+                started_at += timedelta(seconds=block.resting_time)
+            started_at += timedelta(minutes=30)
+
+    def assertMatchesGolden(self, rows, file_name):
+        """Compares the rows with the csv file of test_data with the same name, up to the
+        rounding of the numbers"""
+
+        def normalized(lines):
+            reader = csv.DictReader(lines)
+            rows = []
+            for row in reader:
+                for key, value in row.items():
+                    try:
+                        row[key] = f"{float(value):.9g}"
+                    except ValueError:
+                        pass
+                rows.append(row)
+            return reader.fieldnames, rows
+
+        with open(os.path.join(TEST_DATA_DIR, file_name), newline="") as f:
+            expected = normalized(f)
+        self.assertEqual(normalized(io.StringIO("".join(csv_lines(rows)))), expected)
+
+    def test_process_data(self):
+        self.assertMatchesGolden(
+            process_data(self.user, self.experiment.code), "process_data.csv"
+        )
+        # Same output when it is read from the stored trial metrics
+        rebuild_trial_metrics(self.experiment)
+        self.assertMatchesGolden(
+            process_data(self.user, self.experiment.code), "process_data.csv"
+        )
+
+    def test_raw_data(self):
+        self.assertMatchesGolden(
+            raw_data(self.user, self.experiment.code), "raw_data.csv"
+        )
+        # Same output when the keypresses are packed in their trials
+        call_command("pack_keypresses", stdout=io.StringIO())
+        self.assertMatchesGolden(
+            raw_data(self.user, self.experiment.code), "raw_data.csv"
+        )
+
+    def test_raw_data_with_double_press(self):
+        # The original implementation raised an IndexError for the keypresses past the end of the sequence
+        block = self.experiment.blocks.get(sequence="41324")
+        subject = Subject.objects.get(code="GOLDENSUBJECT000")
+        started_at = timezone.make_aware(datetime(2022, 3, 3, 9))
+        trial = Trial.objects.create(
+            block=block,
+            subject=subject,
+            started_at=started_at,
+            finished_at=started_at + timedelta(seconds=3),
+            correct=False,
+            partial_correct=False,
+        )
+        Keypress.objects.bulk_create(
+            Keypress(
+                trial=trial,
+                value=value,
+                timestamp=started_at + timedelta(milliseconds=400 * (index + 1)),
+            )
+            for index, value in enumerate("413224")
+        )
+        rows = [
+            row
+            for row in raw_data(self.user, self.experiment.code)
+            if row["subject_code"] == subject.code
+            and row["block_id"] == 1
+            and row["trial_id"] == 5
+        ]
+        self.assertEqual([row["keypress_value"] for row in rows], list("413224"))
+        # Keypresses are compared with the character at their position, and there is none past the end
+        self.assertEqual(
+            [row["was_keypress_correct"] for row in rows], [True] * 4 + [False] * 2
+        )
+
+
+class ColumnarTests(TestCase):
+    """Tests for the columnar versions of the data files"""
+
+    def setUp(self):
+        self.user = User.objects.create(username="researcher")
+        self.experiment = generate_experiment(self.user, 2, 2, 3, seed=0)
+
+    def test_same_values_as_csv(self):
+        rows = list(raw_data(self.user, self.experiment.code))
+        for file_format in columnar.available_formats():
+            f = io.BytesIO()
+            writer = columnar.ColumnarWriter(f, file_format)
+            for columns, _ in raw_data_chunks(self.user, self.experiment.code):
+                writer.write(columns)
+            writer.close()
+            f.seek(0)
+            columns = columnar.concatenate(list(columnar.read_batches(f, file_format)))
+            self.assertEqual(list(columns), list(rows[0]))
+            self.assertEqual(columns["keypress_timestamp"].dtype, "int64")
+            self.assertEqual(
+                processing.format_timestamps(columns["keypress_timestamp"]),
+                [row["keypress_timestamp"] for row in rows],
+            )
+            self.assertEqual(
+                columns["subject_code"].tolist(), [row["subject_code"] for row in rows]
+            )
+
+    def test_merge_subject_batches(self):
+        started_at = {
+            subject: timezone.now() + timedelta(minutes=minutes)
+            for subject, minutes in [("a", 0), ("b", 2), ("c", 1), ("d", 2), ("e", 3)]
+        }
+        stored = {"subject_code": np.array(["a", "b"], dtype=object)}
+        new = {"subject_code": np.array(["c", "d", "e"], dtype=object)}
+        merged = columnar.concatenate(
+            list(columnar.merge_subject_batches([stored], new, started_at))
+        )
+        # Like in the csv files, new subjects go after stored subjects that started at the same time
+        self.assertEqual(merged["subject_code"].tolist(), ["a", "c", "b", "d", "e"])
+
+
+class BonstrupTests(TestCase):
+    """Tests for the Bönstrup data"""
+
+    def test_next_in_group(self):
+        started_at = np.array([0, 10, 20, 5, 30])
+        finished_at = np.array([8, 18, 28, 9, 38])
+        subjects = np.array([0, 0, 0, 1, 0])
+        self.assertEqual(
+            processing.next_in_group(started_at, finished_at, subjects).tolist(),
+            [1, 2, 4, -1, -1],
+        )
+
+    def test_block_gains(self):
+        speeds = np.array([1.0, np.nan, 2.0, 2.5, 3.0, 1.0, 2.0])
+        subjects = np.array([0, 0, 0, 0, 0, 1, 1])
+        blocks = np.array([1, 1, 1, 2, 2, 1, 1])
+        online, offline = processing.block_gains(speeds, subjects, blocks)
+        np.testing.assert_array_equal(online, [1, 1, 1, 0.5, 0.5, 1, 1])
+        np.testing.assert_array_equal(
+            offline, [np.nan, np.nan, np.nan, 0.5, 0.5, np.nan, np.nan]
+        )
+
+    def test_process_bonstrup(self):
+        user = User.objects.create(username="researcher")
+        experiment = generate_experiment(user, 3, 2, 4, seed=0)
+        rows = process_bonstrup(user, experiment.code)
+        self.assertEqual(len(rows), 3 * 2 * 4)
+        for row in rows:
+            if row["partial_correct_trial"] and row["num_keypresses"] > 1:
+                self.assertGreater(row["execution_time_ms"], 0)
+                self.assertGreater(row["tapping_speed_mean_aggregated"], 0)
+        # The gains are the same for every trial of a block
+        self.assertEqual(
+            len(
+                {
+                    (row["subject_code"], row["block_id"], row["micro_online_gain"])
+                    for row in rows
+                }
+            ),
+            3 * 2,
+        )
+
+    @override_settings(
+        FILE_STORAGE_BACKEND="gestureApp.storage_backends.InMemoryStorage"
+    )
+    def test_download_only_processes_its_file(self):
+        get_storage.cache_clear()
+        self.addCleanup(get_storage.cache_clear)
+        user = User.objects.create(username="researcher")
+        experiment = generate_experiment(user, 2, 2, 2, seed=0)
+        self.client.force_login(user)
+        response = self.client.get(
+            reverse("gestureApp:download_bonstrup_processed"), {"code": experiment.code}
+        )
+        lines = b"".join(response.streaming_content).decode().splitlines()
+        self.assertEqual(lines[0], ",".join(EXPORT_COLUMNS["bonstrup_processed"]))
+        self.assertEqual(len(lines), 1 + 2 * 2 * 2)
+        self.assertEqual(
+            {name.split("/")[0] for name in get_storage().list("")},
+            {"bonstrup_processed"},
+        )
+
+
+class TrialMetricsTests(TestCase):
+    """Tests for the stored trial metrics"""
+
+    def setUp(self):
+        self.user = User.objects.create(username="researcher")
+        self.experiment = generate_experiment(self.user, 3, 2, 4, seed=0)
+
+    def test_keypress_intervals_ms(self):
+        trial_index = np.array([1, 0, 0, 0, 2])
+        timestamps = np.array([5000, 20000, 0, 10000, 7000])
+        counts, mean, std = processing.keypress_intervals_ms(
+            trial_index, timestamps, 3, 9
+        )
+        self.assertEqual(counts.tolist(), [3, 1, 1])
+        self.assertEqual(mean[0], 10)
+        self.assertEqual(std[0], 0)
+        self.assertTrue(np.isnan(mean[1]) and np.isnan(std[2]))
+
+    def test_same_rows_as_calculated(self):
+        starting_date = self.experiment.published_timestamp
+        self.assertIsNotNone(
+            _stored_process_data_columns(self.experiment, starting_date)
+        )
+        stored = process_data(self.user, self.experiment.code)
+        TrialMetrics.objects.all().delete()
+        self.assertIsNone(_stored_process_data_columns(self.experiment, starting_date))
+        calculated = process_data(self.user, self.experiment.code)
+        self.assertEqual(len(stored), 3 * 2 * 4)
+        for stored_row, calculated_row in zip(stored, calculated):
+            self.assertEqual(
+                {name: value for name, value in stored_row.items() if value == value},
+                {
+                    name: value
+                    for name, value in calculated_row.items()
+                    if value == value
+                },
+            )
+
+    def test_outdated_metrics_are_calculated_again(self):
+        trial = Trial.objects.filter(block__experiment=self.experiment).first()
+        TrialMetrics.objects.filter(trial=trial).update(version=0)
+        self.assertIsNone(
+            _stored_process_data_columns(
+                self.experiment, self.experiment.published_timestamp
+            )
+        )
+        self.assertEqual(rebuild_trial_metrics(self.experiment), 1)
+        self.assertEqual(rebuild_trial_metrics(self.experiment), 0)
+
+    def test_trials_left_out_of_a_block(self):
+        # Starting after the first trial, its block is numbered again from the second one
+        second_trial = (
+            Trial.objects.filter(block__experiment=self.experiment)
+            .order_by("started_at")[1]
+            .started_at
+        )
+        self.assertIsNone(_stored_process_data_columns(self.experiment, second_trial))
+
+
+class LearningCurveTests(TestCase):
+    """Tests for the learning curve summaries"""
+
+    def setUp(self):
+        cache.clear()
+        self.user = User.objects.create(username="researcher")
+        self.experiment = generate_experiment(self.user, 3, 2, 4, seed=0)
+        self.client.force_login(self.user)
+
+    def test_group_quantiles(self):
+        values = np.array([1.0, 5.0, np.nan, 2.0, 4.0, 3.0])
+        groups = np.array([0, 0, 0, 2, 2, 2])
+        quantiles = processing.group_quantiles(values, groups, 3, [0.25, 0.5])
+        np.testing.assert_array_equal(quantiles, [[2, np.nan, 2.5], [3, np.nan, 3]])
+        np.testing.assert_array_equal(
+            processing.group_means(values, groups, 3), [3, np.nan, 3]
+        )
+
+    def test_same_values_as_processed_data(self):
+        response = self.client.get(
+            reverse("gestureApp:experiment_learning_curve", args=[self.experiment.code])
+        )
+        subject = response.json()["experiments"][0]["subjects"][0]
+        block = subject["blocks"][0]
+        rows = [
+            row
+            for row in process_data(self.user, self.experiment.code)
+            if row["subject_code"] == subject["subject_code"] and row["block_id"] == 1
+        ]
+        execution_times = [row["execution_time_ms"] for row in rows]
+        self.assertEqual(block["num_trials"], len(rows))
+        self.assertEqual(
+            block["correct_trials"], sum(row["correct_trial"] for row in rows)
+        )
+        self.assertAlmostEqual(
+            block["execution_time_ms"]["median"],
+            np.nanmedian(np.array(execution_times, dtype=float)),
+        )
+
+    def test_cached_until_new_trials(self):
+        learning_curve(self.experiment)
+        with self.assertNumQueries(0):
+            learning_curve(self.experiment)
+        self.experiment.trials_changed()
+        self.experiment.refresh_from_db()
+        # Creator, experiment and processed data
+        with self.assertNumQueries(3):
+            learning_curve(self.experiment)
+
+    def test_group(self):
+        response = self.client.get(
+            reverse("gestureApp:group_learning_curve", args=[self.experiment.group_id])
+        )
+        experiments = response.json()["experiments"]
+        self.assertEqual([e["code"] for e in experiments], [self.experiment.code])
+        self.assertEqual(len(experiments[0]["subjects"]), 3)
+
+
+class StudyAnalyticsTests(TestCase):
+    """Tests for the group analytics of a study"""
+
+    def setUp(self):
+        self.user = User.objects.create(username="researcher")
+        self.experiment = generate_experiment(self.user, 3, 2, 4, seed=0)
+        self.study = self.experiment.study
+        self.client.force_login(self.user)
+
+    def test_welford_update(self):
+        values = np.array([1.0, 2.0, np.nan, 4.0, 8.0, 3.0])
+        groups = np.array([0, 0, 0, 0, 0, 2])
+        count, mean, m2 = np.zeros(3, dtype=np.int64), np.zeros(3), np.zeros(3)
+        for start in range(0, len(values), 2):
+            count, mean, m2 = processing.welford_update(
+                count, mean, m2, groups[start : start + 2], values[start : start + 2]
+            )
+        self.assertEqual(count.tolist(), [4, 0, 1])
+        np.testing.assert_allclose(mean, [3.75, 0, 3])
+        np.testing.assert_allclose(m2[0] / 3, np.var([1, 2, 4, 8], ddof=1))
+
+    def test_incremental_update(self):
+        file_storage = InMemoryStorage()
+        name = f"study_analytics/{self.study.code}.json"
+        self.assertEqual(
+            process_study_analytics(file_storage, self.study, False), "processed"
+        )
+        self.assertEqual(
+            process_study_analytics(file_storage, self.study, False), "skipped"
+        )
+        # Trials of a new subject are added to the stored statistics
+        later = Trial.objects.filter(block__experiment=self.experiment).last()
+        subject = Subject.objects.create()
+        for minutes in range(1, 4):
+            later.pk = None
+            later.subject = subject
+            later.started_at += timedelta(minutes=minutes)
+            later.save()
+        self.assertEqual(
+            process_study_analytics(file_storage, self.study, False), "updated"
+        )
+        updated = json.loads(file_storage.files[name][0])
+        process_study_analytics(file_storage, self.study, True)
+        rebuilt = json.loads(file_storage.files[name][0])
+        updated_block, rebuilt_block = [
+            analytics["groups"][0]["experiments"][0]["blocks"][-1]
+            for analytics in [updated, rebuilt]
+        ]
+        self.assertEqual(updated_block["correct"]["count"], 3 * 4 + 3)
+        for metric in ["correct", "execution_time_ms"]:
+            self.assertEqual(
+                updated_block[metric]["count"], rebuilt_block[metric]["count"]
+            )
+            self.assertAlmostEqual(
+                updated_block[metric]["mean"], rebuilt_block[metric]["mean"]
+            )
+
+    def test_unpublished_study(self):
+        Study.objects.filter(pk=self.study.pk).update(published=False)
+        response = self.client.get(
+            reverse("gestureApp:study_analytics", args=[self.study.code])
+        )
+        groups = response.json()["groups"]
+        blocks = groups[0]["experiments"][0]["blocks"]
+        self.assertEqual([block["block_id"] for block in blocks], [1, 2])
+        self.assertEqual(blocks[0]["correct"]["count"], 3 * 4)
+
+
+@override_settings(FILE_STORAGE_BACKEND="gestureApp.storage_backends.InMemoryStorage")
+class CloudProcessDataTests(TransactionTestCase):
+    """Tests for the scheduled processing of the stored files. Files are processed in worker threads."""
+
+    def setUp(self):
+        get_storage.cache_clear()
+        self.addCleanup(get_storage.cache_clear)
+        self.user = User.objects.create(username="researcher")
+        self.experiment = generate_experiment(self.user, 2, 2, 2, seed=0)
+
+    def process(self, **kwargs):
+        return self.client.get(reverse("gestureApp:cloud_process_data"), **kwargs)
+
+    def test_rebuild_only_from_cron(self):
+        statuses = {job["status"] for job in self.process().json()["jobs"]}
+        self.assertEqual(statuses, {"processed"})
+        self.assertEqual(self.process(data={"rebuild": "true"}).status_code, 403)
+        response = self.process(data={"rebuild": "true"}, HTTP_X_APPENGINE_CRON="true")
+        statuses = {job["status"] for job in response.json()["jobs"]}
+        self.assertEqual(statuses, {"processed"})
+        statuses = {job["status"] for job in self.process().json()["jobs"]}
+        self.assertEqual(statuses, {"skipped"})
+
+    def test_download_only_processes_its_file(self):
+        # Another published experiment, in another study
+        generate_experiment(self.user, 2, 2, 2, seed=1)
+        self.client.force_login(self.user)
+        for name in ["raw_data", "processed_data"]:
+            response = self.client.get(
+                reverse(f"gestureApp:download_{name}"), {"code": self.experiment.code}
+            )
+            self.assertGreater(
+                len(b"".join(response.streaming_content).splitlines()), 1
+            )
+        stored = {name.rsplit(".", 1)[0] for name in get_storage().list("")}
+        # Not the other files, the other experiment or the study analytics
+        self.assertEqual(
+            stored,
+            {
+                f"raw_data/{self.experiment.code}",
+                f"processed_data/{self.experiment.code}",
+            },
+        )
+
+
+@override_settings(FILE_STORAGE_BACKEND="gestureApp.storage_backends.InMemoryStorage")
+class StudyArchiveTests(TransactionTestCase):
+    """Tests for the ZIP export of a study. The files are prepared in worker threads, which
+    don't see the data of the transaction of a TestCase."""
+
+    def setUp(self):
+        # The storage backend is created once per process
+        get_storage.cache_clear()
+        self.addCleanup(get_storage.cache_clear)
+        self.user = User.objects.create(username="researcher")
+        self.experiment = generate_experiment(self.user, 3, 2, 4, seed=0)
+        self.client.force_login(self.user)
+
+    def download(self):
+        response = self.client.get(
+            reverse("gestureApp:study_download", args=[self.experiment.study_id])
+        )
+        self.assertEqual(response["Content-Type"], "application/zip")
+        return zipfile.ZipFile(io.BytesIO(b"".join(response.streaming_content)))
+
+    def test_archive(self):
+        archive = self.download()
+        folder = f"{self.experiment.group_id}/{self.experiment.code}"
+        self.assertEqual(
+            archive.namelist(),
+            [
+                f"{folder}/processed_data.csv",
+                f"{folder}/raw_data.csv",
+                f"{folder}/survey.csv",
+                "manifest.json",
+            ],
+        )
+        survey = self.client.get(
+            reverse("gestureApp:download_survey", args=[self.experiment.code])
+        )
+        self.assertEqual(
+            archive.read(f"{folder}/survey.csv"), b"".join(survey.streaming_content)
+        )
+        # The data files of published experiments are kept in the file storage, and reused
+        stored_file = get_storage().get(f"raw_data/{self.experiment.code}.csv")
+        self.assertEqual(
+            archive.read(f"{folder}/raw_data.csv"),
+            b"".join(get_storage().read_chunks(stored_file, stored_file.size)),
+        )
+        manifest = json.loads(archive.read("manifest.json"))
+        files = manifest["experiments"][0]["files"]
+        self.assertEqual(
+            [file["source"] for file in files], ["storage", "storage", "generated"]
+        )
+        self.assertEqual(
+            files[1]["size"], archive.getinfo(f"{folder}/raw_data.csv").file_size
+        )
+        self.assertEqual(
+            self.download().read(f"{folder}/processed_data.csv"),
+            archive.read(f"{folder}/processed_data.csv"),
+        )
+
+
+@override_settings(REQUEST_METRICS=True)
+class RequestMetricsTests(TestCase):
+    """Tests for the request instrumentation"""
+
+    def setUp(self):
+        instrumentation._view_samples.clear()
+        instrumentation._view_requests.clear()
+        self.user = User.objects.create(username="admin", is_staff=True)
+        self.client.force_login(self.user)
+
+    def test_view_percentiles(self):
+        self.client.get(reverse("gestureApp:user_experiments"))
+        response = self.client.get(reverse("gestureApp:request_metrics"))
+        metrics = response.json()["views"]["gestureApp:user_experiments"]
+        self.assertEqual(metrics["requests"], 1)
+        self.assertGreater(metrics["queries"]["p50"], 0)
+        self.assertEqual(set(metrics["latency_ms"]), {"p50", "p90", "p99", "max"})
+
+    def test_staff_only(self):
+        self.user.is_staff = False
+        self.user.save()
+        response = self.client.get(reverse("gestureApp:request_metrics"))
+        self.assertEqual(response.status_code, 302)
+
+
+class PackKeypressesTests(TestCase):
+    """Tests for the pack_keypresses command"""
+
+    def setUp(self):
+        user = User.objects.create(username="researcher")
+        study = Study.objects.create(name="study", creator=user)
+        group = Group.objects.create(name="group", study=study, creator=user)
+        self.experiment = Experiment.objects.create(
+            name="experiment", creator=user, study=study, group=group
+        )
+        block = Block.objects.create(
+            experiment=self.experiment,
+            sequence="1234",
+            seq_length=4,
+            type=Block.BlockTypes.NUM_TRIALS,
+            num_trials=3,
+        )
+        subject = Subject.objects.create()
+        started_at = timezone.now()
+        # A correct trial, a trial with a double press and a trial without keypresses
+        for index, values in enumerate(["1234", "12234", ""]):
+            trial = Trial.objects.create(
+                block=block,
+                subject=subject,
+                started_at=started_at + timedelta(seconds=10 * index),
+                finished_at=started_at + timedelta(seconds=10 * index + 5),
+                correct=values == "1234",
+                partial_correct=values == "1234",
+            )
+            Keypress.objects.bulk_create(
+                Keypress(
+                    trial=trial,
+                    value=value,
+                    timestamp=trial.started_at
+                    + timedelta(milliseconds=250 * (i + 1), microseconds=i),
+                )
+                for i, value in enumerate(values)
+            )
+        self.trials = Trial.objects.filter(block=block)
+
+    def keypresses(self):
+        """Returns the keypresses of the trials as read by the exports, sorted"""
+        trial_ids, timestamps, values = load_keypresses(self.trials)
+        return sorted(zip(trial_ids.tolist(), timestamps.tolist(), values.tolist()))
+
+    def test_pack_and_unpack(self):
+        keypresses = self.keypresses()
+        call_command("pack_keypresses", self.experiment.code, stdout=io.StringIO())
+        self.assertEqual(Keypress.objects.count(), 0)
+        self.assertEqual(self.trials.filter(packed_keypresses__isnull=False).count(), 2)
+        self.assertEqual(self.keypresses(), keypresses)
+        call_command("pack_keypresses", "--unpack", stdout=io.StringIO())
+        self.assertEqual(Keypress.objects.count(), len(keypresses))
+        self.assertFalse(self.trials.filter(packed_keypresses__isnull=False).exists())
+        self.assertEqual(self.keypresses(), keypresses)
+
+
+class ExplainQueriesTests(TestCase):
+    """Tests for the explain_queries command"""
+
+    def test_compare_with_synthetic_data(self):
+        output = io.StringIO()
+        call_command(
+            "explain_queries",
+            "--subjects=2",
+            "--blocks=1",
+            "--trials=2",
+            "--compare",
+            stdout=output,
+        )
+        self.assertIn("Without the indexes of migration 0040", output.getvalue())
+        self.assertIn("trial_block_subject_start_idx", output.getvalue())
+        # The synthetic data and the dropped indexes are rolled back
+        self.assertFalse(Experiment.objects.exists())
+        with connection.cursor() as cursor:
+            indexes = connection.introspection.get_constraints(
+                cursor, Trial._meta.db_table
+            )
+        self.assertIn("trial_subject_start_idx", indexes)
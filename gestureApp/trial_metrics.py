@@ -0,0 +1,299 @@
+"""Metrics of the trials that the processed data is made of, and the keypresses they are calculated from.
+
+The metrics are calculated when a subject submits an experiment and saved as TrialMetrics, so that the
+processed data can be read without the keypresses. They are calculated again by rebuild_trial_metrics when
+they are missing or outdated.
+"""
+
+from django.db import transaction
+
+import numpy as np
+
+from . import processing
+from .models import Keypress, Trial, TrialMetrics
+
+# Minimum time between keypresses. Shorter intervals are errors capturing the timestamps.
+MIN_MS_BETW_KEYPRESSES = 9
+# Version of the calculation of the trial metrics. Increase it whenever trial_metrics changes, and run the
+#   backfill_trial_metrics command, so that the stored metrics are calculated again.
+TRIAL_METRICS_VERSION = 1
+# Number of subjects whose trial metrics are calculated together by rebuild_trial_metrics
+TRIAL_METRICS_SUBJECTS_PER_BATCH = 100
+# Number of rows fetched at a time from the database cursor
+CHUNK_SIZE = 2000
+# Number of TrialMetrics sent to the database per INSERT
+BATCH_SIZE = 1000
+
+
+def load_keypresses(trials, with_values=True):
+    """Reads the keypresses of the given trials into NumPy columns.
+    Keypresses saved as Keypress rows and keypresses packed in their trial (see the PACKED_KEYPRESSES
+    setting) are both read, and are not in any particular order.
+
+    Args:
+        trials (QuerySet): trials whose keypresses are read
+        with_values (bool, optional): whether to read the value of the keypresses. Defaults to True.
+
+    Returns:
+        list: trial id and timestamp (in microseconds) of every keypress, and their value if requested
+    """
+    fields = ["trial_id", "timestamp", "value"][: 3 if with_values else 2]
+    dtypes = [np.int64, "timestamp", "U1"][: len(fields)]
+    # Keypresses are sorted later, so the default ordering is not needed
+    keypresses_query = (
+        Keypress.objects.filter(trial__in=trials).order_by().values_list(*fields)
+    )
+    columns = processing.rows_to_columns(
+        keypresses_query.iterator(chunk_size=CHUNK_SIZE),
+        dtypes,
+        chunk_size=CHUNK_SIZE,
+    )
+    packed_query = (
+        trials.filter(packed_keypresses__isnull=False)
+        .order_by()
+        .values_list("id", "started_at", "packed_keypresses")
+    )
+    packed_trials, packed_started_at, packed_keypresses = processing.rows_to_columns(
+        # Some databases return binary fields as memoryview, which NumPy would turn into arrays
+        (
+            (trial, started_at, bytes(packed))
+            for trial, started_at, packed in packed_query.iterator(
+                chunk_size=CHUNK_SIZE
+            )
+        ),
+        [np.int64, "timestamp", object],
+        chunk_size=CHUNK_SIZE,
+    )
+    if len(packed_trials) > 0:
+        counts, offsets, values = processing.unpack_keypresses(packed_keypresses)
+        packed_columns = [
+            np.repeat(packed_trials, counts),
+            np.repeat(packed_started_at, counts) + offsets,
+            values,
+        ]
+        columns = [
+            np.concatenate((column, packed_column))
+            for column, packed_column in zip(columns, packed_columns)
+        ]
+    return columns
+
+
+def trial_metrics(trials):
+    """Calculates the metrics of the given trials that the processed data is made of.
+    The metrics of a trial depend on the other trials of the same subject and block, so these should be included.
+
+    Args:
+        trials (QuerySet): trials whose metrics are calculated
+
+    Returns:
+        list: unsaved TrialMetrics of every trial
+    """
+    trials_query = trials.order_by("started_at", "id").values_list(
+        "id", "block_id", "subject_id", "correct", "started_at", "finished_at"
+    )
+    (
+        trial_ids,
+        trial_blocks,
+        trial_subjects,
+        trial_correct,
+        trial_started_at,
+        trial_finished_at,
+    ) = processing.rows_to_columns(
+        trials_query.iterator(chunk_size=CHUNK_SIZE),
+        [np.int64, np.int64, object, bool, "timestamp", "timestamp"],
+        chunk_size=CHUNK_SIZE,
+    )
+    if len(trial_ids) == 0:
+        return []
+    keypress_trials, keypress_timestamps = load_keypresses(trials, with_values=False)
+    trials_order = np.argsort(trial_ids)
+    keypress_trial_index = trials_order[
+        np.searchsorted(trial_ids, keypress_trials, sorter=trials_order)
+    ]
+    return _trial_metrics(
+        trial_ids,
+        trial_blocks,
+        processing.factorize(trial_subjects),
+        trial_correct,
+        trial_started_at,
+        trial_finished_at,
+        keypress_trial_index,
+        keypress_timestamps,
+    )
+
+
+def submitted_trial_metrics(trials, trial_keypresses):
+    """Calculates the metrics of the trials that a subject has just submitted, from their keypresses in memory.
+    Only valid for blocks in which the subject has no other trials, as the metrics of a trial depend on the
+    other trials of the same subject and block.
+
+    Args:
+        trials (list): saved trials of a single subject
+        trial_keypresses (list): (value, timestamp) tuples of the keypresses of each trial
+
+    Returns:
+        list: unsaved TrialMetrics of every trial
+    """
+    if not trials:
+        return []
+    # Sorted like the trials of trial_metrics
+    order = sorted(
+        range(len(trials)), key=lambda i: (trials[i].started_at, trials[i].id)
+    )
+    trials = [trials[i] for i in order]
+    trial_keypresses = [trial_keypresses[i] for i in order]
+    return _trial_metrics(
+        np.array([trial.id for trial in trials], dtype=np.int64),
+        np.array([trial.block_id for trial in trials], dtype=np.int64),
+        np.zeros(len(trials), dtype=np.int64),
+        np.array([trial.correct for trial in trials], dtype=bool),
+        np.array(
+            [processing.to_microseconds(trial.started_at) for trial in trials],
+            dtype=np.int64,
+        ),
+        np.array(
+            [processing.to_microseconds(trial.finished_at) for trial in trials],
+            dtype=np.int64,
+        ),
+        np.repeat(
+            np.arange(len(trials)), [len(keypresses) for keypresses in trial_keypresses]
+        ),
+        np.array(
+            [
+                processing.to_microseconds(timestamp)
+                for keypresses in trial_keypresses
+                for _, timestamp in keypresses
+            ],
+            dtype=np.int64,
+        ),
+    )
+
+
+def _trial_metrics(
+    trial_ids,
+    trial_blocks,
+    subject_index,
+    trial_correct,
+    trial_started_at,
+    trial_finished_at,
+    keypress_trial_index,
+    keypress_timestamps,
+):
+    """Calculates the metrics of trials given as columns, ordered by starting time. See trial_metrics.
+
+    Args:
+        trial_ids (np.ndarray): id of each trial
+        trial_blocks (np.ndarray): block id of each trial
+        subject_index (np.ndarray): integer code of the subject of each trial
+        trial_correct (np.ndarray): whether each trial was correct
+        trial_started_at (np.ndarray): starting timestamp of each trial, in microseconds
+        trial_finished_at (np.ndarray): finishing timestamp of each trial, in microseconds
+        keypress_trial_index (np.ndarray): position of the trial of each keypress
+        keypress_timestamps (np.ndarray): timestamp of each keypress, in microseconds
+
+    Returns:
+        list: unsaved TrialMetrics of every trial
+    """
+    previous_trial = processing.previous_in_group(
+        trial_started_at, trial_finished_at, subject_index, trial_blocks
+    )
+    (
+        execution_time_ms,
+        tapping_speed_mean,
+        tapping_speed_extra_keypress,
+    ) = processing.tapping_metrics(
+        keypress_trial_index,
+        keypress_timestamps,
+        previous_trial,
+        trial_correct,
+        MIN_MS_BETW_KEYPRESSES,
+    )
+    num_keypresses, interval_mean_ms, interval_std_ms = (
+        processing.keypress_intervals_ms(
+            keypress_trial_index,
+            keypress_timestamps,
+            len(trial_ids),
+            MIN_MS_BETW_KEYPRESSES,
+        )
+    )
+    trial_index = processing.rank_within_groups(trial_blocks, subject_index)
+    accumulated_correct_trials = processing.cumsum_within_groups(
+        trial_correct, trial_blocks, subject_index
+    )
+
+    def optional(values):
+        # NaN is saved as null
+        return [None if np.isnan(value) else value for value in values.tolist()]
+
+    return [
+        TrialMetrics(
+            trial_id=trial,
+            version=TRIAL_METRICS_VERSION,
+            trial_index=index,
+            accumulated_correct_trials=accumulated,
+            num_keypresses=keypresses,
+            execution_time_ms=execution_time,
+            inter_key_interval_mean_ms=interval_mean,
+            inter_key_interval_std_ms=interval_std,
+            tapping_speed_mean=tapping_speed,
+            tapping_speed_extra_keypress=tapping_speed_extra,
+        )
+        for (
+            trial,
+            index,
+            accumulated,
+            keypresses,
+            execution_time,
+            interval_mean,
+            interval_std,
+            tapping_speed,
+            tapping_speed_extra,
+        ) in zip(
+            trial_ids.tolist(),
+            trial_index.tolist(),
+            accumulated_correct_trials.tolist(),
+            num_keypresses.tolist(),
+            optional(execution_time_ms),
+            optional(interval_mean_ms),
+            optional(interval_std_ms),
+            optional(tapping_speed_mean),
+            optional(tapping_speed_extra_keypress),
+        )
+    ]
+
+
+def save_trial_metrics(trials):
+    """Calculates the metrics of the given trials and saves them, replacing their previous metrics
+
+    Args:
+        trials (QuerySet): trials whose metrics are saved, including every trial of their subjects in their blocks
+    """
+    metrics = trial_metrics(trials)
+    with transaction.atomic():
+        TrialMetrics.objects.filter(trial__in=trials).delete()
+        TrialMetrics.objects.bulk_create(metrics, batch_size=BATCH_SIZE)
+
+
+def rebuild_trial_metrics(experiment, outdated_only=True):
+    """Saves the metrics of the trials of an experiment, a batch of subjects at a time
+
+    Args:
+        experiment (Experiment): experiment whose trial metrics are saved
+        outdated_only (bool, optional): only calculate the metrics of subjects with trials that have no metrics,
+            or metrics of an older version. Defaults to True.
+
+    Returns:
+        int: number of subjects whose metrics were calculated
+    """
+    trials = Trial.objects.filter(block__experiment=experiment)
+    if outdated_only:
+        trials = trials.exclude(metrics__version=TRIAL_METRICS_VERSION)
+    subjects = list(trials.order_by().values_list("subject_id", flat=True).distinct())
+    for start in range(0, len(subjects), TRIAL_METRICS_SUBJECTS_PER_BATCH):
+        save_trial_metrics(
+            Trial.objects.filter(
+                block__experiment=experiment,
+                subject__in=subjects[start : start + TRIAL_METRICS_SUBJECTS_PER_BATCH],
+            )
+        )
+    return len(subjects)
@@ -44,6 +44,11 @@ urlpatterns = [
     path(
         "processed_data/", views.download_processed_data, name="download_processed_data"
     ),
+    path(
+        "bonstrup_processed/",
+        views.download_bonstrup_processed,
+        name="download_bonstrup_processed",
+    ),
     # API
     path("api/create_trials", views.create_trials, name="create_trials"),
     path("api/create_subject", views.create_subject, name="create_subject"),
@@ -51,6 +56,7 @@ urlpatterns = [
     path("api/current_user", views.current_user, name="current_user"),
     path("api/user_experiments", views.user_experiments, name="user_experiments"),
     path("api/user_studies", views.user_studies, name="user_studies"),
+    path("api/request_metrics", views.request_metrics, name="request_metrics"),
     re_path(
         r"^api/experiment/delete/(?P<pk>[A-Z0-9]{4})/$",
         views.delete_experiment,
@@ -121,6 +127,26 @@ urlpatterns = [
         views.download_survey,
         name="download_survey",
     ),
+    re_path(
+        r"^api/experiment/learning_curve/(?P<pk>[A-Z0-9]{4})/$",
+        views.experiment_learning_curve,
+        name="experiment_learning_curve",
+    ),
+    re_path(
+        r"^api/group/learning_curve/(?P<pk>[A-Z0-9]{4})/$",
+        views.group_learning_curve,
+        name="group_learning_curve",
+    ),
+    re_path(
+        r"^api/study/analytics/(?P<pk>[A-Z0-9]{4})/$",
+        views.download_study_analytics,
+        name="study_analytics",
+    ),
+    re_path(
+        r"^api/study/download/(?P<pk>[A-Z0-9]{4})/$",
+        views.download_study,
+        name="study_download",
+    ),
     path("api/group/new/", views.new_group, name="new_group",),
     path(
         "api/cloud_process_data", views.cloud_process_data, name="cloud_process_data",
@@ -1,57 +1,110 @@
+import contextlib
 import csv
+import io
 import json
 import random
 import string
 from datetime import datetime
 import logging
-import io
+import time
+import uuid
 
 logging.getLogger().setLevel(logging.INFO)
 from collections import defaultdict
+from concurrent.futures import ThreadPoolExecutor
+from functools import partial
 import tempfile
 
+from django.conf import settings
+from django.contrib.admin.views.decorators import staff_member_required
 from django.contrib.auth.decorators import login_required
 from django.contrib.auth import authenticate, login
+from django.core.cache import cache
 from django.core.exceptions import PermissionDenied
 from django.core.mail import send_mail
-from django.db.models import Count, F, Max, Min, Q
-from django.db import transaction
+from django.db.models import Count, F, Max, Min, Q, Window
+from django.db.models.functions import Coalesce, FirstValue
+from django.db import connection, transaction
 from django.forms import inlineformset_factory
 from django.forms.models import model_to_dict
 from django.http import (
+    FileResponse,
     HttpResponse,
+    HttpResponseForbidden,
     HttpResponseRedirect,
     JsonResponse,
     Http404,
+    StreamingHttpResponse,
 )
 from django.shortcuts import get_object_or_404, redirect, render
 from django.urls import reverse, reverse_lazy
 from django.utils import timezone
 from django.utils.decorators import method_decorator
 from django.utils.timezone import make_aware, now
+from django.views.decorators.cache import cache_control
+from django.views.decorators.http import condition
 from django.views.generic.detail import DetailView
 from django.views.generic.edit import CreateView, UpdateView
 
 from dateutil.tz import tzoffset
 
-from google.cloud import storage
 import numpy as np
 
+from . import analytics, archive, columnar, instrumentation, processing, routing
 from .forms import ExperimentCode, UserRegisterForm
+from .storage_backends import get_storage
 from .models import (
+    EXPERIMENT_RESPONSES,
     Block,
     Experiment,
     Keypress,
+    Participation,
     Subject,
     Trial,
+    TrialMetrics,
     User,
     EndSurvey,
     Study,
     Group,
 )
+from .trial_metrics import (
+    MIN_MS_BETW_KEYPRESSES,
+    TRIAL_METRICS_VERSION,
+    load_keypresses,
+    submitted_trial_metrics,
+    save_trial_metrics,
+)
 
-BUCKET_NAME = "motor-learning"
-MIN_MS_BETW_KEYPRESSES = 9
+# Number of rows sent to the database per INSERT when saving an experiment performance
+BULK_CREATE_BATCH_SIZE = 1000
+# Number of rows fetched at a time from the database cursor when exporting data
+EXPORT_CHUNK_SIZE = 2000
+# Number of trials whose keypresses are loaded together when generating the raw data
+EXPORT_TRIALS_PER_CHUNK = 500
+# Size in bytes of each piece of a stored file streamed back to the user
+DOWNLOAD_CHUNK_SIZE = 1024 * 1024
+# Number of experiment files processed at the same time by cloud_process_data
+CLOUD_PROCESS_WORKERS = 4
+# Number of times cloud_process_data tries to process an experiment file before giving up
+CLOUD_PROCESS_ATTEMPTS = 3
+# Seconds that a version of the experiments of a user is kept in the cache. Bounds the time a process with its
+#   own cache (like the default local memory cache) can keep answering user_experiments with a 304 after a change
+EXPERIMENTS_VERSION_TIMEOUT = 60
+# Seconds that the configuration of an experiment is kept in the cache
+EXPERIMENT_CONFIG_TIMEOUT = 24 * 60 * 60
+# Seconds that the learning curve of an experiment is kept in the cache. New trials replace it before that.
+LEARNING_CURVE_TIMEOUT = 24 * 60 * 60
+
+
+class QueryCounter:
+    """Database execution wrapper that counts the queries run while it is installed"""
+
+    def __init__(self):
+        self.count = 0
+
+    def __call__(self, execute, sql, params, many, context):
+        self.count += 1
+        return execute(sql, params, many, context)
 
 
 @method_decorator([login_required], name="dispatch")
@@ -69,9 +122,9 @@ class Profile(DetailView):
         context["experiments"] = self.request.user.experiments.all().order_by(
             "created_at"
         )
-        context["studies"] = [
-            s.to_dict() for s in self.request.user.studies.all().order_by("created_at")
-        ]
+        context["studies"] = Study.to_dicts(
+            self.request.user.studies.all().order_by("created_at")
+        )
         return context
 
 
@@ -140,36 +193,19 @@ def study(request, pk):
         )
 
     if experiment is None and group is None:
-        # Check if the user has performed an experiment in this study before. If they have, use that group
-        for g in study.groups.all():
-            for e in g.experiments.all():
-                if e.has_done_experiment(subject):
-                    group = g
-                    break
-            if group is not None:
-                break
-        if group is None:
-            # Randomly assign to group
-            group = study.groups.filter(enabled=True).order_by("?").first()
-    if experiment is None and group is not None:
-        # TODO: allow a custom experiment order
-        # For now, experiments are ordered by the date they were created at, and users
-        # will be redirected to those experiments in order as they enter the same study and/or group
-        # codes.
-        for e in group.experiments.filter(enabled=True, published=True).order_by(
-            "created_at"
-        ):
-            if not e.has_done_experiment(subject):
-                experiment = e
-                break
+        # Find the group of the subject in this study, assigning one if they are new, and their next experiment
+        exp_code = routing.route_subject(study, subject)
+    elif experiment is None:
+        # Users are redirected to the experiments of the group in order as they enter the same group code
+        exp_code = routing.next_experiment(group, subject)
 
     # Exclude disabled experiments
-    if experiment is None:
+    if exp_code is None:
         # No enabled experiments in this study
-        return Http404
+        raise Http404
 
     # Redirect user to appropriate experiment
-    return redirect(f"/experiment/{experiment.code}/?subj-code={subject_code}")
+    return redirect(f"/experiment/{exp_code}/?subj-code={subject_code}")
 
 
 def experiment(request, pk):
@@ -194,20 +230,38 @@ def experiment(request, pk):
             raise Exception("Subject already participated in experiment")
     if not experiment.published or not experiment.enabled:
         # If experiment not published or enabled, and the exp creator is different than the current user, don't allow access.
-        if experiment.creator != request.user:
+        if experiment.creator_id != request.user.id:
             raise Http404
     # Add experiment, blocks and subject code to the render, so it's accessible from Vue.
     return render(
         request,
         "gestureApp/experiment.html",
-        {
-            "experiment": experiment.to_dict(),
-            "blocks": list(experiment.blocks.order_by("id").values()),
-            "subject_code": subject_code,
-        },
+        {**experiment_config(experiment), "subject_code": subject_code},
     )
 
 
+def experiment_config(experiment):
+    """Configuration of an experiment that participants need to perform it: the experiment and its blocks.
+    It is cached for each configuration version of the experiment, so it's only built again after the
+    experiment changes (see Experiment.config_changed).
+
+    Args:
+        experiment (Experiment): experiment to get the configuration of
+
+    Returns:
+        dict: experiment dict (without the number of responses) and list of block dicts
+    """
+    key = f"experiment_config:{experiment.code}:{experiment.config_version}"
+    config = cache.get(key)
+    if config is None:
+        config = {
+            "experiment": experiment.to_dict(with_responses=False),
+            "blocks": list(experiment.blocks.order_by("id").values()),
+        }
+        cache.set(key, config, EXPERIMENT_CONFIG_TIMEOUT)
+    return config
+
+
 def create_trials(request):
     """Saves experiment performance to database given by the current user.
 
@@ -215,63 +269,147 @@ def create_trials(request):
         request: HTML request. Contains the full experiment performance data.
 
     """
-    # Experiment performance
-    data = json.loads(request.body)
-    exp_code = data.get("experiment")
-    experiment = get_object_or_404(Experiment, pk=exp_code)
-    subj_code = data.get("subject_code")
+    start_time = time.perf_counter()
+    query_counter = QueryCounter()
+    with connection.execute_wrapper(query_counter):
+        # Experiment performance
+        data = json.loads(request.body)
+        exp_code = data.get("experiment")
+        experiment = get_object_or_404(Experiment, pk=exp_code)
+        subj_code = data.get("subject_code")
+        experiment_trials = json.loads(data.get("experiment_trials"))
+        tz_offset = data.get("timezone_offset_sec")
+        user_timezone = tzoffset(None, tz_offset)
+
+        # Load the blocks once, in the same order they were shown to the subject
+        blocks = list(experiment.blocks.order_by("id"))
+        # Fewer blocks are allowed, as they were before: the trials of a partial submission are
+        #   saved in the first blocks of the experiment
+        if len(experiment_trials) > len(blocks):
+            logging.error(
+                f"[{exp_code}][create_trials] Received {len(experiment_trials)} blocks, "
+                f"but the experiment only has {len(blocks)}"
+            )
+            return JsonResponse(
+                {"error": "More blocks than the experiment has"}, status=400
+            )
 
-    # Create a new subject if none was specified
-    subject = None
-    if subj_code is not None and subj_code != "":
-        subject = get_object_or_404(Subject, pk=subj_code)
-    else:
-        subject = Subject.objects.create()
-    # Save the trials to database.
-    experiment_trials = json.loads(data.get("experiment_trials"))
-    tz_offset = data.get("timezone_offset_sec")
-    user_timezone = tzoffset(None, tz_offset)
-
-    # First, bulk create the trials
-    trials_to_save = []
-    trials_aux = []
-    for i, block in enumerate(experiment_trials):
-        for trial in block:
-            t = Trial(
-                block=experiment.blocks.order_by("id")[i],
-                subject=subject,
-                started_at=datetime.fromtimestamp(
-                    trial["started_at"] / 1000, user_timezone,
-                ),
-                correct=trial["correct"],
-                partial_correct=trial["partial_correct"],
-                finished_at=datetime.fromtimestamp(
-                    trial["finished_at"] / 1000, user_timezone,
-                ),
+        # Create a new subject if none was specified. It is saved together with its trials.
+        subject = None
+        new_subject = subj_code is None or subj_code == ""
+        if not new_subject:
+            subject = get_object_or_404(Subject, pk=subj_code)
+        else:
+            subject = Subject()
+
+        # First, build the trials
+        trials_to_save = []
+        trials_aux = []
+        num_keypresses = 0
+        for block_obj, block in zip(blocks, experiment_trials):
+            for trial in block:
+                t = Trial(
+                    block=block_obj,
+                    subject=subject,
+                    started_at=datetime.fromtimestamp(
+                        trial["started_at"] / 1000, user_timezone,
+                    ),
+                    correct=trial["correct"],
+                    partial_correct=trial["partial_correct"],
+                    finished_at=datetime.fromtimestamp(
+                        trial["finished_at"] / 1000, user_timezone,
+                    ),
+                )
+                # Keypresses of the trial. Don't count special characters
+                keypresses = [
+                    (
+                        keypress["value"],
+                        datetime.fromtimestamp(
+                            keypress["timestamp"] / 1000, user_timezone
+                        ),
+                    )
+                    for keypress in trial["keypresses"]
+                    if len(keypress["value"]) <= 1
+                ]
+                num_keypresses += len(keypresses)
+                if settings.PACKED_KEYPRESSES:
+                    # Save the keypresses in the trial itself
+                    started_at = processing.to_microseconds(t.started_at)
+                    t.packed_keypresses = processing.pack_keypresses(
+                        [
+                            processing.to_microseconds(timestamp) - started_at
+                            for _, timestamp in keypresses
+                        ],
+                        [value for value, _ in keypresses],
+                    )
+                    t.packed_first_keypress_at = min(
+                        (timestamp for _, timestamp in keypresses), default=None
+                    )
+                trials_to_save.append(t)
+                trials_aux.append(keypresses)
+
+        # Save trials and keypresses together, so that a failed submission does not leave a partial experiment
+        with transaction.atomic():
+            if new_subject:
+                # The trials take the code of the subject once it is saved
+                subject.save()
+                earlier_blocks = set()
+            else:
+                # Blocks where the subject already has trials. See below.
+                earlier_blocks = set(
+                    Trial.objects.filter(subject=subject, block__in=blocks)
+                    .order_by()
+                    .values_list("block_id", flat=True)
+                    .distinct()
+                )
+            # Creating bulk trials in database
+            trials_saved = Trial.objects.bulk_create(
+                trials_to_save, batch_size=BULK_CREATE_BATCH_SIZE
             )
-            trials_to_save.append(t)
-            trials_aux.append(trial)
-
-    # Creating bulk trials in database
-    trials_saved = Trial.objects.bulk_create(trials_to_save)
-    # Create bulk keypresses
-    keypresses_to_save = []
-    for trial_db, trial_dict in zip(trials_saved, trials_aux):
-        # t.save()
-        for keypress in trial_dict["keypresses"]:
-            value = keypress["value"]
-            # Don't count special characters
-            if len(value) > 1:
-                continue
-            timestamp = keypress["timestamp"]
-            keypress = Keypress(
-                trial=trial_db,
-                value=value,
-                timestamp=datetime.fromtimestamp(timestamp / 1000, user_timezone),
+            if not settings.PACKED_KEYPRESSES:
+                # Create bulk keypresses
+                keypresses_to_save = [
+                    Keypress(trial=trial_db, value=value, timestamp=timestamp)
+                    for trial_db, keypresses in zip(trials_saved, trials_aux)
+                    for value, timestamp in keypresses
+                ]
+                Keypress.objects.bulk_create(
+                    keypresses_to_save, batch_size=BULK_CREATE_BATCH_SIZE
+                )
+            # Keep track of the first and last trials of the subject in this experiment
+            experiment.record_participation(
+                subject, [trial.started_at for trial in trials_saved]
+            )
+            # The metrics of the new trials only depend on the other trials of the subject in the same block.
+            #   Without earlier trials, they are calculated from the keypresses in memory.
+            new_block_trials = [
+                (trial_db, keypresses)
+                for trial_db, keypresses in zip(trials_saved, trials_aux)
+                if trial_db.block_id not in earlier_blocks
+            ]
+            TrialMetrics.objects.bulk_create(
+                submitted_trial_metrics(
+                    [trial_db for trial_db, _ in new_block_trials],
+                    [keypresses for _, keypresses in new_block_trials],
+                ),
+                batch_size=BULK_CREATE_BATCH_SIZE,
             )
-            keypresses_to_save.append(keypress)
-    # Creating bulk keypresses
-    Keypress.objects.bulk_create(keypresses_to_save)
+            if earlier_blocks:
+                # The new trials can change the metrics of the earlier ones, so all of them are calculated again
+                save_trial_metrics(
+                    Trial.objects.filter(subject=subject, block__in=earlier_blocks)
+                )
+        # Outside the transaction, so that the row of the experiment is not locked while the trials are saved,
+        #   which would make the submissions of every subject of the experiment wait for each other
+        experiment.trials_changed()
+
+    experiments_changed(experiment.creator_id)
+
+    elapsed_ms = (time.perf_counter() - start_time) * 1000
+    logging.info(
+        f"[{exp_code}][create_trials] Saved {len(trials_saved)} trials and {num_keypresses} keypresses "
+        f"with {query_counter.count} queries in {elapsed_ms:.0f} ms"
+    )
 
     # Create response
     data = {"subject_code": subject.code}
@@ -279,7 +417,7 @@ def create_trials(request):
 
 
 def upload_files(request, pk):
-    """Uploads video and consent form to Google Cloud Storage for a given experiment identifier pk.json
+    """Uploads video and consent form to the file storage for a given experiment identifier pk.json
 
     Args:
         request: HTML request
@@ -287,35 +425,50 @@ def upload_files(request, pk):
 
     """
     if request.method == "POST":
-        cs_bucket = storage.Client().bucket(BUCKET_NAME)
-        # Upload consent form
-        handle_upload_file(
-            cs_bucket, request.FILES["consent"], pk, "consent.pdf", "application/pdf"
-        )
-        # Upload video
-        handle_upload_file(
-            cs_bucket,
-            request.FILES["video"],
-            pk,
-            f"video.{str(request.FILES['video']).split('.')[1]}",
-            "video/mp4",
-        )
+        file_storage = get_storage()
+        # Both files are uploaded at the same time
+        with ThreadPoolExecutor(max_workers=2) as executor:
+            uploads = [
+                # Upload consent form
+                executor.submit(
+                    handle_upload_file,
+                    file_storage,
+                    request.FILES["consent"],
+                    pk,
+                    "consent.pdf",
+                    "application/pdf",
+                ),
+                # Upload video
+                executor.submit(
+                    handle_upload_file,
+                    file_storage,
+                    request.FILES["video"],
+                    pk,
+                    f"video.{str(request.FILES['video']).split('.')[1]}",
+                    "video/mp4",
+                ),
+            ]
+            for upload in uploads:
+                upload.result()
         return HttpResponse("Successful")
 
 
-def handle_upload_file(cs_bucket, file, code, filename, content_type):
-    """Uploads specific file to Google Cloud Storage
+def handle_upload_file(file_storage, file, code, filename, content_type):
+    """Uploads specific file to the file storage.
+    The file is streamed to the storage in chunks. Django keeps large uploads in a temporary file
+    on disk (see FILE_UPLOAD_MAX_MEMORY_SIZE), so they are never fully loaded in memory.
 
     Args:
-        cs_bucket (cloud storage bucket): Cloud Storage Bucket
+        file_storage (StorageBackend): file storage backend
         file (file descriptor): file to upload
         code (str): experiment code
-        filename (str): filename to save it with at CS
+        filename (str): filename to save it with at the storage
         content_type (str): type of the content (pdf or video)
     """
-    # Upload file to cloud storage
-    blob = cs_bucket.blob(f"experiment_files/{code}/{filename}")
-    blob.upload_from_string(file.read(), content_type=content_type)
+    # Upload file to the storage
+    file_storage.upload_file(
+        f"experiment_files/{code}/{filename}", file, content_type=content_type
+    )
 
 
 # Requires login to create experiments
@@ -384,6 +537,7 @@ def create_experiment(request):
                 block_obj.full_clean()
                 block_obj.save()
 
+        experiments_changed(request.user.id)
         return JsonResponse({"code": experiment.code})
 
     return render(request, "gestureApp/experiment_form.html", {},)
@@ -451,10 +605,15 @@ def edit_experiment(request, pk):
             for block_dict in exp_info["blocks"]
             if block_dict["block_id"] is not None
         ]
+        deleted_blocks = False
         for block in experiment.blocks.all():
             # if block not in exp_info["blocks"], delete
             if block.id not in edit_blocks:
                 block.delete()
+                deleted_blocks = True
+        if deleted_blocks:
+            # The trials of the deleted blocks are gone, so the participations could have changed
+            experiment.rebuild_participations()
         for block in exp_info["blocks"]:
             sequence = block["sequence"]
             if block["is_random_sequence"]:
@@ -495,6 +654,8 @@ def edit_experiment(request, pk):
                     for _ in range(num_repetitions - 1):
                         block_obj.pk = None
                         block_obj.save()
+        experiment.config_changed()
+        experiments_changed(request.user.id)
         return HttpResponseRedirect(reverse("gestureApp:profile"))
 
 
@@ -547,837 +708,1551 @@ def edit_study(request, pk):
             creator=request.user,
             description=study_info["description"],
         )
+        # The study name is part of the configuration of its experiments
+        study.experiments.update(config_version=F("config_version") + 1)
         return HttpResponseRedirect(reverse("gestureApp:profile"))
 
 
-def raw_data(user, code):
+# Columns of each data file. They are written as the header of the csv files, even if these have no rows.
+EXPORT_COLUMNS = {
+    "raw_data": [
+        "experiment_code",
+        "subject_code",
+        "block_id",
+        "block_sequence",
+        "trial_id",
+        "was_trial_correct",
+        "was_partial_trial_correct",
+        "keypress_timestamp",
+        "keypress_value",
+        "was_keypress_correct",
+        "diff_between_keypresses_ms",
+    ],
+    "processed_data": [
+        "experiment_code",
+        "subject_code",
+        "block_id",
+        "block_sequence",
+        "trial_id",
+        "correct_trial",
+        "accumulated_correct_trials",
+        "execution_time_ms",
+        "tapping_speed_mean",
+        "tapping_speed_extra_keypress",
+    ],
+    "bonstrup_processed": [
+        "experiment_code",
+        "subject_code",
+        "block_id",
+        "block_sequence",
+        "trial_id",
+        "correct_trial",
+        "partial_correct_trial",
+        "accumulated_correct_trials",
+        "num_keypresses",
+        "execution_time_ms",
+        "tapping_speed_mean_individual",
+        "tapping_speed_std_dev_individual",
+        "tapping_speed_mean_aggregated",
+        "micro_online_gain",
+        "micro_offline_gain",
+    ],
+}
+
+
+def raw_data(user, code, subjects=None):
     """Method that extracts the raw data of the experiment given by 'code' and
-    returns a list that then can be converted into a csv file.
+    returns an iterator of rows that then can be converted into a csv file.
 
     Args:
         user (object): current user object
         code (str): experiment identifier
+        subjects (list, optional): only return the rows of these subject codes. Blocks and trials
+            are still numbered using every trial of the experiment. Defaults to all subjects.
+    """
+    return export_rows(raw_data_chunks(user, code, subjects))
+
+
+def raw_data_chunks(user, code, subjects=None):
+    """Extracts the raw data of the experiment given by 'code' in chunks of rows. See raw_data.
+
+    Returns:
+        iterator: tuples with the typed columns of each chunk (see columnar) and the same columns
+            as the values written to the csv file
     """
+    # Make sure that the user downloading it is the owner of the experiment
     experiment = get_object_or_404(Experiment, pk=code, creator=user)
     # If the experiment hasn't been published, get all responses
     starting_date_useful_data = experiment.created_at
     # If it has, then only get those after the publishing timestamp
     if experiment.published:
         starting_date_useful_data = experiment.published_timestamp
-    # Make sure that the user downloading it is the owner of the experiment
-    # Customized query so that we get the values we are searching for
-    qs = (
-        Experiment.objects.filter(
-            pk=code,
-            creator=user,
-            blocks__trials__started_at__gt=starting_date_useful_data,
+    # Trial information, ordered by the first keypress of each trial
+    trials_query = (
+        Trial.objects.filter(
+            block__experiment=experiment, started_at__gt=starting_date_useful_data
         )
-        .order_by("blocks__trials__keypresses__timestamp")
-        .values(
-            experiment_code=F("code"),
-            subject_code=F("blocks__trials__subject__code"),
-            block_id=F("blocks"),
-            block_sequence=F("blocks__sequence"),
-            trial_id=F("blocks__trials__id"),
-            was_trial_correct=F("blocks__trials__correct"),
-            was_partial_trial_correct=F("blocks__trials__partial_correct"),
-            keypress_timestamp=F("blocks__trials__keypresses__timestamp"),
-            keypress_value=F("blocks__trials__keypresses__value"),
+        .annotate(
+            first_keypress_at=Coalesce(
+                Min("keypresses__timestamp"), "packed_first_keypress_at"
+            )
         )
+        .order_by("first_keypress_at", "block_id", "id")
+        .values_list("id", "block_id", "subject_id", "correct", "partial_correct")
     )
-    queryset_list = list(qs)
-    # Get all subjects that performed the experiment
-    subjects = [
-        Subject.objects.get(pk=code)
-        for code in unique([value["subject_code"] for value in queryset_list])
-    ]
-    # Order subjects by the time when they started the first trial
-    subjects.sort(
-        key=lambda subj: subj.trials.order_by("started_at").first().started_at
+    trials = processing.rows_to_columns(
+        trials_query.iterator(chunk_size=EXPORT_CHUNK_SIZE),
+        [np.int64, np.int64, object, bool, bool],
+        chunk_size=EXPORT_CHUNK_SIZE,
     )
-    # Dictionary with the subject code as key and the date they started the experiment as value
-    subjects_starting_timestamp = {
-        subject.code: subject.trials.order_by("started_at").first().started_at
-        for subject in subjects
-    }
-    possible_blocks = unique([value["block_id"] for value in queryset_list])
-    new_block_codes = {block: index + 1 for index, block in enumerate(possible_blocks)}
+    trial_ids, trial_blocks, trial_subjects = trials[:3]
+    if len(trial_ids) == 0:
+        return iter([])
+    subject_index = processing.factorize(trial_subjects)
     # Trials are not fixed across different experiments or blocks (they have different IDs)
-    # If we are on the same experiment and block, start adding up
-    # for every combination of block-subject, we have a different count
-    # {(block, subject): [trial_1, trial_2, trial_3]}
-    aux_values = defaultdict(dict)
-    for values_dict in queryset_list:
-        trial_id_dict = aux_values[
-            (values_dict["block_id"], values_dict["subject_code"])
+    # Change the block and trial ids to a numbered code, to avoid the random codes
+    #   used by default in the database. Trials are numbered for every combination of block-subject.
+    new_block_ids = processing.first_appearance_codes(trial_blocks)
+    new_trial_ids = processing.rank_within_groups(trial_blocks, subject_index)
+    # Dictionary with the subject code as key and the date they started the experiment as value
+    subjects_starting_timestamp = experiment.subjects_starting_timestamps(
+        starting_date_useful_data
+    )
+    starting_timestamps = np.array(
+        [
+            processing.to_microseconds(subjects_starting_timestamp[subject])
+            for subject in trial_subjects
+        ],
+        dtype=np.int64,
+    )
+    # Order the trials by starting timestamp, block number and trial number
+    order = np.lexsort((new_trial_ids, new_block_ids, starting_timestamps))
+    if subjects is not None:
+        order = order[_subjects_mask(trial_subjects[order], subjects)]
+    block_sequences = dict(experiment.blocks.values_list("id", "sequence"))
+    return _raw_data_chunks(
+        experiment.code,
+        [column[order] for column in trials],
+        subject_index[order],
+        new_block_ids[order],
+        new_trial_ids[order],
+        block_sequences,
+    )
+
+
+def _raw_data_chunks(
+    exp_code, trials, subject_index, new_block_ids, new_trial_ids, block_sequences
+):
+    """Generator that yields the raw data of the given (ordered) trials, in chunks of rows.
+    Keypresses are read a few trials at a time through a server-side cursor, so memory use
+    does not depend on the number of keypresses in the experiment. Each chunk is processed
+    as NumPy columns.
+
+    Args:
+        exp_code (str): experiment identifier
+        trials (list): trial id, block id, subject code, correct and partial correct columns
+        subject_index (np.ndarray): integer code of the subject of each trial
+        new_block_ids (np.ndarray): block number of each trial
+        new_trial_ids (np.ndarray): trial number of each trial inside its block
+        block_sequences (dict): sequence of each block id
+    """
+    trial_ids, trial_blocks, trial_subjects, trial_correct, trial_partial_correct = (
+        trials
+    )
+    sequences = list(block_sequences.values())
+    sequence_index = dict(zip(block_sequences.keys(), range(len(sequences))))
+    trial_sequence_index = np.array(
+        [sequence_index[block] for block in trial_blocks.tolist()], dtype=np.int64
+    )
+    # Last keypress of the previous chunk, to calculate the difference with the first one of the next
+    previous_timestamp = np.array([processing.MISSING_TIMESTAMP], dtype=np.int64)
+    previous_subject = np.array([-1], dtype=np.int64)
+    for chunk_start in range(0, len(trial_ids), EXPORT_TRIALS_PER_CHUNK):
+        chunk = slice(chunk_start, chunk_start + EXPORT_TRIALS_PER_CHUNK)
+        chunk_trial_ids = trial_ids[chunk]
+        keypress_trials, keypress_timestamps, keypress_values = load_keypresses(
+            Trial.objects.filter(id__in=chunk_trial_ids.tolist())
+        )
+        # Position of the trial of each keypress in this chunk, and keypresses ordered by trial and timestamp
+        trials_order = np.argsort(chunk_trial_ids)
+        keypress_positions = trials_order[
+            np.searchsorted(chunk_trial_ids, keypress_trials, sorter=trials_order)
         ]
-        if values_dict["trial_id"] not in trial_id_dict:
-            trial_id_dict[values_dict["trial_id"]] = len(trial_id_dict.keys()) + 1
-    # Change the subject, block and trials ids to a numbered code, to avoid the random codes
-    #   used by default in the database
-    for values_dict in queryset_list:
-        values_dict["trial_id"] = aux_values[
-            (values_dict["block_id"], values_dict["subject_code"])
-        ][values_dict["trial_id"]]
-        values_dict["block_id"] = new_block_codes[values_dict["block_id"]]
-    # Order the list by starting timestamp, block number, trial number and then keypress timestamp
-    queryset_list.sort(
-        key=lambda value_dict: (
-            subjects_starting_timestamp[value_dict["subject_code"]],
-            value_dict["block_id"],
-            value_dict["trial_id"],
-            value_dict["keypress_timestamp"],
+        keypresses_order = np.lexsort((keypress_timestamps, keypress_positions))
+        counts = np.bincount(keypress_positions, minlength=len(chunk_trial_ids))
+
+        # One row per keypress. Trials without keypresses still get a row, with empty keypress values
+        rows_per_trial = np.maximum(counts, 1)
+        row_trials = np.repeat(np.arange(len(chunk_trial_ids)), rows_per_trial)
+        row_has_keypress = counts[row_trials] > 0
+        row_timestamps = np.full(len(row_trials), processing.MISSING_TIMESTAMP)
+        row_timestamps[row_has_keypress] = keypress_timestamps[keypresses_order]
+        row_values = np.full(len(row_trials), "", dtype="U1")
+        row_values[row_has_keypress] = keypress_values[keypresses_order]
+        # Position of the keypress inside its trial
+        trial_first_row = np.cumsum(rows_per_trial) - rows_per_trial
+        row_sequence_positions = (
+            np.arange(len(row_trials)) - trial_first_row[row_trials]
         )
+
+        row_subjects = subject_index[chunk][row_trials]
+        # Gets the difference between consecutive keypresses, only in the cases where the subject
+        #   of the consecutive keypresses are the same
+        diffs, clamped = processing.keypress_diffs_ms(
+            np.r_[previous_timestamp, row_timestamps],
+            np.r_[previous_subject, row_subjects],
+            MIN_MS_BETW_KEYPRESSES,
+        )
+        diffs, clamped = diffs[1:], clamped[1:]
+        previous_timestamp = row_timestamps[-1:]
+        previous_subject = row_subjects[-1:]
+        # Calculate whether or not the keypress input was correct, comparing it with the trial sequence
+        keypress_correct = processing.keypresses_match_sequence(
+            sequences,
+            trial_sequence_index[chunk][row_trials],
+            row_sequence_positions,
+            row_values,
+        )
+        row_values = row_values.astype(object)
+        row_values[~row_has_keypress] = None
+
+        columns = {
+            "experiment_code": np.full(len(row_trials), exp_code, dtype=object),
+            "subject_code": trial_subjects[chunk][row_trials],
+            "block_id": new_block_ids[chunk][row_trials],
+            "block_sequence": np.array(sequences, dtype=object)[
+                trial_sequence_index[chunk][row_trials]
+            ],
+            "trial_id": new_trial_ids[chunk][row_trials],
+            "was_trial_correct": trial_correct[chunk][row_trials],
+            "was_partial_trial_correct": trial_partial_correct[chunk][row_trials],
+            "keypress_timestamp": row_timestamps,
+            "keypress_value": row_values,
+            "was_keypress_correct": keypress_correct,
+            # If the difference between keypresses is lower than the minimum possible, set it to the minimum possible.
+            "diff_between_keypresses_ms": np.where(
+                clamped, MIN_MS_BETW_KEYPRESSES, diffs
+            ),
+        }
+        csv_columns = {name: _csv_values(values) for name, values in columns.items()}
+        csv_columns["keypress_timestamp"] = processing.format_timestamps(row_timestamps)
+        csv_diffs = np.array(processing.nan_to_none(diffs), dtype=object)
+        csv_diffs[clamped] = MIN_MS_BETW_KEYPRESSES
+        csv_columns["diff_between_keypresses_ms"] = csv_diffs.tolist()
+        yield columns, csv_columns
+
+
+def _csv_values(values):
+    """Converts a typed column into the values written to the csv files, with None for NaN"""
+    if values.dtype.kind == "f":
+        return processing.nan_to_none(values)
+    return values.tolist()
+
+
+def export_rows(chunks):
+    """Generator that turns the chunks of a data file into row dictionaries
+
+    Args:
+        chunks (iterable): typed columns and csv columns of each chunk, like the ones of raw_data_chunks
+    """
+    for _, csv_columns in chunks:
+        for values in zip(*csv_columns.values()):
+            yield dict(zip(csv_columns.keys(), values))
+
+
+class Echo:
+    """Pseudo-buffer that returns the written value instead of storing it. Allows streaming csv files."""
+
+    def write(self, value):
+        return value
+
+
+def csv_lines(rows, fieldnames=None):
+    """Generator that converts row dictionaries into csv lines.
+    The header is taken from the keys of the first row. If there are no rows, the header is made of
+    the given field names, and nothing is written without them.
+
+    Args:
+        rows (iterable): row dictionaries, all with the same keys
+        fieldnames (list, optional): header of the file when there are no rows
+    """
+    writer = None
+    for row in rows:
+        if writer is None:
+            writer = csv.DictWriter(Echo(), row.keys())
+            yield writer.writeheader()
+        yield writer.writerow(row)
+    if writer is None and fieldnames:
+        yield csv.DictWriter(Echo(), fieldnames).writeheader()
+
+
+def csv_response(rows, filename, fieldnames=None):
+    """Creates a response that streams the given rows as a csv file attachment
+
+    Args:
+        rows (iterable): row dictionaries
+        filename (str): name of the downloaded file
+        fieldnames (list, optional): header of the file when there are no rows
+    """
+    response = StreamingHttpResponse(
+        csv_lines(rows, fieldnames), content_type="text/csv"
     )
-    # Tuple containing all keypresses for each subject, ordered as before
-    keypresses = [
-        (v_dict["keypress_timestamp"], v_dict["subject_code"])
-        for v_dict in queryset_list
-    ]
-    # Gets the difference between consecutive keypresses, only in the cases where the subject
-    #   of the consecutive keypresses are the same
-    diff_keypresses_ms = [None] + [
-        (y[0] - x[0]).total_seconds() * 1000
-        if x[1] == y[1] and x[0] is not None and y[0] is not None
-        else None
-        for x, y in zip(keypresses, keypresses[1:])
-    ]
-    # Calculate whether or not the keypress input was correct
-    # We'll get all keypresses for each trial, and then compare them with the trial sequence
-    current_trial = -1
-    current_block = -1
-    current_subject = ""
-    current_trial_seq_idx = 0
-    for values_dict, diff in zip(queryset_list, diff_keypresses_ms):
-        # If the difference between keypresses is lower than the minimum possible, set it to the minimum possible.
-        diff_mod = None
-        if diff is not None:
-            if diff < MIN_MS_BETW_KEYPRESSES:
-                diff_mod = MIN_MS_BETW_KEYPRESSES
-            else:
-                diff_mod = diff
-        if (
-            current_trial == values_dict["trial_id"]
-            and current_block == values_dict["block_id"]
-            and current_subject == values_dict["subject_code"]
-        ):
-            # When on the same trial and block, increase the sequence index
-            current_trial_seq_idx += 1
-        else:
-            # When on a different trial or block, restart the counters
-            current_trial = values_dict["trial_id"]
-            current_block = values_dict["block_id"]
-            current_subject = values_dict["subject_code"]
-            current_trial_seq_idx = 0
-        # Was keypress correct?
-        if (
-            values_dict["block_sequence"][current_trial_seq_idx]
-            == values_dict["keypress_value"]
-        ):
-            # If the corresponding value of the sequence is equal to the keypress, show True, else False
-            values_dict["was_keypress_correct"] = True
-        else:
-            values_dict["was_keypress_correct"] = False
-        if values_dict["keypress_timestamp"] is not None:
-            values_dict["keypress_timestamp"] = values_dict[
-                "keypress_timestamp"
-            ].strftime("%Y-%m-%d %H:%M:%S.%f")
-        values_dict["diff_between_keypresses_ms"] = diff_mod
+    response["Content-Disposition"] = 'attachment; filename="{}"'.format(filename)
+    return response
+
+
+def export_response(chunks, filename, file_format, fieldnames=None):
+    """Creates a response with a data file attachment, in csv or in one of the columnar formats
+
+    Args:
+        chunks (iterable): typed columns and csv columns of each chunk, like the ones of raw_data_chunks
+        filename (str): name of the downloaded file, without extension
+        file_format (str): "csv", or one of columnar.available_formats()
+        fieldnames (list, optional): header of the csv file when there are no rows
+    """
+    if file_format == "csv":
+        return csv_response(export_rows(chunks), f"{filename}.csv", fieldnames)
+    # Columnar files can only be sent once they are finished, so they are written to a temporary file first
+    f = tempfile.TemporaryFile(mode="w+b")
+    writer = columnar.ColumnarWriter(f, file_format)
+    for columns, _ in chunks:
+        writer.write(columns)
+    writer.close()
+    f.seek(0)
+    return FileResponse(
+        f,
+        as_attachment=True,
+        filename=f"{filename}.{file_format}",
+        content_type=EXPORT_CONTENT_TYPES[file_format],
+    )
+
+
+def stored_file_response(stored_file, filename, content_type="text/csv"):
+    """Creates a response that streams a file from the file storage, reading it in chunks
+
+    Args:
+        stored_file (StoredFile): stored file
+        filename (str): name of the downloaded file
+        content_type (str, optional): content type of the file. Defaults to csv.
+    """
+    response = StreamingHttpResponse(
+        get_storage().read_chunks(stored_file, DOWNLOAD_CHUNK_SIZE),
+        content_type=content_type,
+    )
+    response["Content-Length"] = stored_file.size
+    response["Content-Disposition"] = 'attachment; filename="{}"'.format(filename)
+    return response
+
+
+def export_format(request):
+    """Format of the data file requested with the "format" parameter: csv (the default) or a columnar format
 
-    return queryset_list
+    Raises:
+        Http404: if the format is not available
+    """
+    file_format = request.GET.get("format", "csv")
+    if file_format != "csv" and file_format not in columnar.available_formats():
+        raise Http404(f"Format {file_format} is not available")
+    return file_format
 
 
 # Requires to be logged in to download the raw data
 @login_required
 def download_raw_data(request):
-    """Runs the full cloud process to calculate raw data if necessary, and then downloads the file from cloud storage."""
+    """Updates the stored raw data of the experiment if necessary (see process_stored_file), and then downloads the
+    file from the file storage. The file is downloaded in the format given by the "format" parameter (see export_format).
+    """
     form = ExperimentCode(request.GET)
     if form.is_valid():
         code = form.cleaned_data["code"]
+        file_format = export_format(request)
         experiment = Experiment.objects.get(pk=code)
+        filename = "raw_data_{}".format(code)
         # If the experiment is not published, just download the experiment data
         if not experiment.published:
-            output_dict = raw_data(experiment.creator, code)
-            f = io.StringIO()
-            if len(output_dict) > 0:
-                writer = csv.DictWriter(f, output_dict[0].keys())
-                writer.writeheader()
-            else:
-                writer = csv.DictWriter(f, ["experiment"])
-            writer.writerows(output_dict)
-            csv_content = f.getvalue()
-        else:
-            # Process the experiment if it hasn't been processed yet.
-            cloud_process_data(request)
-            cs_bucket = storage.Client().bucket(BUCKET_NAME)
-            blob = cs_bucket.blob(f"raw_data/{code}.csv")
-            if blob is None:
-                raise Http404("Experiment is not ready for downloading yet")
-            csv_content = blob.download_as_string()
-        # Output csv
-        response = HttpResponse(csv_content, content_type="text/csv")
-        response[
-            "Content-Disposition"
-        ] = 'attachment; filename="raw_data_{}.csv"'.format(code)
+            return export_response(
+                raw_data_chunks(experiment.creator, code),
+                filename,
+                file_format,
+                EXPORT_COLUMNS["raw_data"],
+            )
+        # Process the experiment if it hasn't been processed yet.
+        process_stored_file(experiment, "raw_data")
+        stored_file = get_storage().get(f"raw_data/{code}.{file_format}")
+        if stored_file is None:
+            raise Http404("Experiment is not ready for downloading yet")
+        return stored_file_response(
+            stored_file,
+            f"{filename}.{file_format}",
+            EXPORT_CONTENT_TYPES[file_format],
+        )
 
-        return response
+
+def _subjects_mask(trial_subjects, subjects):
+    """Marks the trials that belong to one of the given subjects
+
+    Args:
+        trial_subjects (np.ndarray): subject code of each trial
+        subjects (list): subject codes to keep
+
+    Returns:
+        np.ndarray: True for the trials of the given subjects
+    """
+    subjects = set(subjects)
+    return np.fromiter(
+        (subject in subjects for subject in trial_subjects),
+        dtype=bool,
+        count=len(trial_subjects),
+    )
 
 
-def process_data(user, exp_code):
+def _stored_process_data_columns(experiment, starting_date_useful_data):
+    """Reads the processed data of an experiment from the stored trial metrics, with a single query
+    that returns the rows already in the order of the processed data file.
+
+    Args:
+        experiment (Experiment): experiment to read
+        starting_date_useful_data (datetime): only trials started after this timestamp are included
+
+    Returns:
+        dict: columns of the processed data, or None if they have to be calculated from the keypresses because
+            some trial has no metrics of the current version, or because a subject has trials of a block both
+            before and after the starting date (their stored numbering includes the trials left out)
+    """
+    useful_trials = Trial.objects.filter(
+        block__experiment=experiment, started_at__gt=starting_date_useful_data
+    )
+    # Blocks are numbered in the order their first trial was started
+    first_in_block = {
+        "partition_by": [F("block_id")],
+        "order_by": [F("started_at").asc(), F("id").asc()],
+    }
+    trials_query = (
+        useful_trials.annotate(
+            subject_started_at=Window(
+                Min("started_at"), partition_by=[F("subject_id")]
+            ),
+            block_started_at=Window(FirstValue("started_at"), **first_in_block),
+            block_first_trial=Window(FirstValue("id"), **first_in_block),
+        )
+        .order_by(
+            "subject_started_at",
+            "block_started_at",
+            "block_first_trial",
+            "metrics__trial_index",
+            "started_at",
+            "id",
+        )
+        .values_list(
+            "subject_id",
+            "block_started_at",
+            "block_first_trial",
+            "block__sequence",
+            "metrics__trial_index",
+            "correct",
+            "metrics__accumulated_correct_trials",
+            "metrics__execution_time_ms",
+            "metrics__tapping_speed_mean",
+            "metrics__tapping_speed_extra_keypress",
+            "metrics__version",
+        )
+    )
+    rows = list(trials_query.iterator(chunk_size=EXPORT_CHUNK_SIZE))
+    if any(row[-1] != TRIAL_METRICS_VERSION for row in rows):
+        return None
+    (
+        subject_codes,
+        block_started_at,
+        block_first_trial,
+        block_sequences,
+        trial_index,
+        correct,
+        accumulated_correct_trials,
+        execution_time_ms,
+        tapping_speed_mean,
+        tapping_speed_extra_keypress,
+    ) = processing.rows_to_columns(
+        (row[:-1] for row in rows),
+        [
+            object,
+            "timestamp",
+            np.int64,
+            object,
+            np.int64,
+            bool,
+            np.int64,
+            float,
+            float,
+            float,
+        ],
+        chunk_size=EXPORT_CHUNK_SIZE,
+    )
+    # The stored numbering of the trials of a subject in a block only matches if none of them was left out
+    if not np.array_equal(
+        processing.rank_within_groups(
+            block_first_trial, processing.factorize(subject_codes)
+        ),
+        trial_index,
+    ):
+        return None
+    block_order = np.lexsort((block_first_trial, block_started_at))
+    block_ids = np.empty(len(block_order), dtype=np.int64)
+    block_ids[block_order] = processing.first_appearance_codes(
+        block_first_trial[block_order]
+    )
+    return {
+        "experiment_code": np.full(len(rows), experiment.code, dtype=object),
+        "subject_code": subject_codes,
+        "block_id": block_ids,
+        "block_sequence": block_sequences,
+        "trial_id": trial_index,
+        "correct_trial": correct,
+        "accumulated_correct_trials": accumulated_correct_trials,
+        "execution_time_ms": execution_time_ms,
+        "tapping_speed_mean": tapping_speed_mean,
+        "tapping_speed_extra_keypress": tapping_speed_extra_keypress,
+    }
+
+
+def process_data(user, exp_code, subjects=None):
     """Processes an experiment's data and returns a list with all the relevant information
 
     Args:
         user (object): current user object
         exp_code (str): experiment identifier
+        subjects (list, optional): only return the rows of these subject codes. Blocks are still
+            numbered using every trial of the experiment. Defaults to all subjects.
+    """
+    return list(export_rows(process_data_chunks(user, exp_code, subjects)))
+
+
+def process_data_chunks(user, exp_code, subjects=None):
+    """Processes an experiment's data like process_data, returning it as a single chunk of rows
+
+    Returns:
+        list: tuple with the typed columns of the chunk (see columnar) and the same columns as the
+            values written to the csv file, or no chunks if there is no data
     """
     code = exp_code
+    # Make sure that the user downloading it is the owner of the experiment
     experiment = get_object_or_404(Experiment, pk=code, creator=user)
     # If the experiment hasn't been published, get all responses
     starting_date_useful_data = experiment.created_at
     # If it has, then only get those after the publishing timestamp
     if experiment.published:
         starting_date_useful_data = experiment.published_timestamp
-    # Make sure that the user downloading it is the owner of the experiment
-    queryset = (
-        Experiment.objects.filter(
-            pk=code,
-            creator=user,
-            blocks__trials__started_at__gt=starting_date_useful_data,
-        )
-        .values(
-            "code",
-            "blocks",
-            "blocks__trials__subject",
-            "blocks__sequence",
-            "blocks__trials",
-            "blocks__trials__correct",
-            "blocks__trials__started_at",
-        )
-        .order_by("blocks__trials__started_at")
-        .distinct()
-    )
-    queryset = list(queryset)
-    # Dict containing an accumulated count of correct trials for every block and subject
-    acc_correct_trials = defaultdict(lambda: 0)
-    for values_dict in queryset:
-        # Changing the names of the keys to more readable ones
-        values_dict["experiment_code"] = values_dict.pop("code")
-        values_dict["subject_code"] = values_dict.pop("blocks__trials__subject")
-        values_dict["block_id"] = values_dict.pop("blocks")
-        values_dict["block_sequence"] = values_dict.pop("blocks__sequence")
-        values_dict["trial_id"] = values_dict.pop("blocks__trials")
-        values_dict["correct_trial"] = values_dict.pop("blocks__trials__correct")
-        values_dict.pop("blocks__trials__started_at")
-
-        if values_dict["correct_trial"]:
-            # The key is (block_id, subject_code)
-            acc_correct_trials[
-                (values_dict["block_id"], values_dict["subject_code"])
-            ] += 1
-        # Show the number of accumulated correct trials for each subject-block pair
-        values_dict["accumulated_correct_trials"] = acc_correct_trials[
-            (values_dict["block_id"], values_dict["subject_code"])
+    columns = _stored_process_data_columns(experiment, starting_date_useful_data)
+    if columns is not None:
+        if subjects is not None:
+            mask = _subjects_mask(columns["subject_code"], subjects)
+            columns = {name: values[mask] for name, values in columns.items()}
+        if len(columns["subject_code"]) == 0:
+            return []
+        return [
+            (columns, {name: _csv_values(values) for name, values in columns.items()})
         ]
-    # Trials ordered by keypresses timestamps
-    trials_timestamps_query = (
-        Trial.objects.filter(block__experiment__code=code)
-        .order_by("keypresses__timestamp")
-        .values(
-            "id",
-            "keypresses__id",
-            "keypresses__timestamp",
-            "block__id",
-            "started_at",
-            "finished_at",
-            "correct",
-            "subject__code",
+    # All trials in the experiment, ordered by starting time. Trials before the starting date are
+    # also needed, as they can be the trial before one of the useful trials.
+    trials_query = (
+        Trial.objects.filter(block__experiment=experiment)
+        .order_by("started_at", "id")
+        .values_list(
+            "id", "block_id", "subject_id", "correct", "started_at", "finished_at"
         )
     )
-    # From the trials, I need all the keypress timestamps ordered from low to high
-    # Just the timestamps of all keypresses per trial
-    trial_timestamps = defaultdict(list)
-    # All the other information per trial
-    trial_properties = defaultdict(dict)
-    for res in trials_timestamps_query:
-        trial_timestamps[res["id"]].append(res["keypresses__timestamp"])
-        if res["id"] not in trial_properties:
-            trial_properties[res["id"]]["trial_id"] = res["id"]
-            trial_properties[res["id"]]["block"] = res["block__id"]
-            trial_properties[res["id"]]["started_at"] = res["started_at"]
-            trial_properties[res["id"]]["finished_at"] = res["finished_at"]
-            trial_properties[res["id"]]["correct"] = res["correct"]
-            trial_properties[res["id"]]["subject_code"] = res["subject__code"]
-
-    for values_dict in queryset:
-        # Get last trial (closest final keypress to the starting keypress of this one)
-        this_trial_props = trial_properties[values_dict["trial_id"]]
-        previous_trials_this_block = [
-            trial_props
-            for trial_id, trial_props in trial_properties.items()
-            if trial_props["block"] == this_trial_props["block"]
-            and trial_id != values_dict["trial_id"]
-            and trial_props["subject_code"] == values_dict["subject_code"]
-            and trial_props["finished_at"] <= this_trial_props["started_at"]
-        ]
-        # Get the last trial if exists
-        last_trial = (
-            sorted(previous_trials_this_block, key=lambda prop: prop["finished_at"])[-1]
-            if len(previous_trials_this_block) > 0
-            else None
-        )
-        # List of timestamps for this trial, ordered from early to late
-        keypresses_timestamps = trial_timestamps[values_dict["trial_id"]]
-        if len(keypresses_timestamps) > 0 and this_trial_props["correct"]:
-            # Elapsed time between keypresses list
-            elapsed_list = []
-            # Elapsed list that includes the time between the last keypress of last trial and the first of this one
-            elapsed_list2 = []
-            for index, keypress_timestamp in enumerate(keypresses_timestamps):
-                # First keypress
-                if index == 0:
-                    # On trial that is not the first of a block
-                    if last_trial is not None:
-                        keypresses_last_trial = trial_timestamps[last_trial["trial_id"]]
-                        # if the last trial has at least a valid keypress
-                        if (
-                            len(keypresses_last_trial) > 0
-                            and keypresses_last_trial[-1] is not None
-                        ):
-                            elapsed_extra = (
-                                keypress_timestamp - keypresses_last_trial[-1]
-                            ).total_seconds()
-                            elapsed_list2.append(elapsed_extra)
-                    continue
-                # Elapsed time is in seconds
-                elapsed = (
-                    keypress_timestamp - keypresses_timestamps[index - 1]
-                ).total_seconds()
-                if elapsed < MIN_MS_BETW_KEYPRESSES / 1000:
-                    # Something failed while capturing the keypresses timestamp. We set the elapsed time to the minimum possible.
-                    elapsed = MIN_MS_BETW_KEYPRESSES / 1000
-                elapsed_list.append(elapsed)
-                elapsed_list2.append(elapsed)
-            # Mean and std deviation of tapping speed
-            mean_tap_speed = 1 / np.mean(elapsed_list)
-            extra_mean_tap_speed = 1 / np.mean(elapsed_list2)
-
-            # Execution time in milliseconds
-            execution_time_ms = (
-                keypresses_timestamps[-1] - keypresses_timestamps[0]
-            ).total_seconds() * 1000
-            values_dict["execution_time_ms"] = execution_time_ms
-            # Tapping data
-            values_dict["tapping_speed_mean"] = (
-                mean_tap_speed if not np.isnan(mean_tap_speed) else None
-            )
-            # Also considering the reaction speed of the first keypress of a trial
-            values_dict["tapping_speed_extra_keypress"] = (
-                extra_mean_tap_speed if not np.isnan(extra_mean_tap_speed) else None
-            )
-        else:
-            values_dict["execution_time_ms"] = None
-            # Tapping data
-            values_dict["tapping_speed_mean"] = None
-            values_dict["tapping_speed_extra_keypress"] = None
-    # Get all subjects
-    subjects = [
-        Subject.objects.get(pk=code)
-        for code in unique([value["subject_code"] for value in queryset])
+    (
+        trial_ids,
+        trial_blocks,
+        trial_subjects,
+        trial_correct,
+        trial_started_at,
+        trial_finished_at,
+    ) = processing.rows_to_columns(
+        trials_query.iterator(chunk_size=EXPORT_CHUNK_SIZE),
+        [np.int64, np.int64, object, bool, "timestamp", "timestamp"],
+        chunk_size=EXPORT_CHUNK_SIZE,
+    )
+    # Keypress timestamps, and the position of their trial in the trial arrays
+    keypress_trials_query = Trial.objects.filter(block__experiment=experiment)
+    if subjects is not None:
+        # Tapping metrics only depend on the trials of the same subject
+        keypress_trials_query = keypress_trials_query.filter(subject__in=subjects)
+    keypress_trials, keypress_timestamps = load_keypresses(
+        keypress_trials_query, with_values=False
+    )
+    trials_order = np.argsort(trial_ids)
+    keypress_trial_index = trials_order[
+        np.searchsorted(trial_ids, keypress_trials, sorter=trials_order)
     ]
-    # Sort subjects by time when the user started the first trial
-    subjects.sort(
-        key=lambda subj: subj.trials.order_by("started_at").first().started_at
+
+    # Last trial of the same subject and block before each trial
+    subject_index = processing.factorize(trial_subjects)
+    previous_trial = processing.previous_in_group(
+        trial_started_at, trial_finished_at, subject_index, trial_blocks
+    )
+    (
+        execution_time_ms,
+        tapping_speed_mean,
+        tapping_speed_extra_keypress,
+    ) = processing.tapping_metrics(
+        keypress_trial_index,
+        keypress_timestamps,
+        previous_trial,
+        trial_correct,
+        MIN_MS_BETW_KEYPRESSES,
+    )
+
+    # Only keep the trials after the starting date
+    useful = np.flatnonzero(
+        trial_started_at > processing.to_microseconds(starting_date_useful_data)
+    )
+    if len(useful) == 0:
+        return []
+    useful_subjects = trial_subjects[useful]
+    blocks = trial_blocks[useful]
+    subject_index = subject_index[useful]
+    # Accumulated count of correct trials for every block and subject
+    accumulated_correct_trials = processing.cumsum_within_groups(
+        trial_correct[useful], blocks, subject_index
     )
-    # Get the timestamp at which each user started the first trial.
-    subjects_starting_timestamp = {
-        subject.code: subject.trials.order_by("started_at").first().started_at
-        for subject in subjects
-    }
     ## Convert blocks and trials IDs into enumerated values, for easier interpretation.
-    possible_blocks = unique([value["block_id"] for value in queryset])
-    new_block_codes = {block: index + 1 for index, block in enumerate(possible_blocks)}
     # Trials are not fixed across different experiments or blocks.
     # If we are on the same experiment and block, start adding up
     # for every combination of block-subject, we have a different count
-    # {(block, subject): {trial_1: 1, trial_2:2, trial_3:3}}
-    aux_values = defaultdict(dict)
-    for values_dict in queryset:
-        # To get the new id
-        trial_id_dict = aux_values[
-            (values_dict["block_id"], values_dict["subject_code"])
-        ]
-        if values_dict["trial_id"] not in trial_id_dict:
-            trial_id_dict[values_dict["trial_id"]] = len(trial_id_dict.keys()) + 1
-    # Change the subject, block and trials ids to a numbered code
-    for values_dict in queryset:
-        values_dict["trial_id"] = aux_values[
-            (values_dict["block_id"], values_dict["subject_code"])
-        ][values_dict["trial_id"]]
-        values_dict["block_id"] = new_block_codes[values_dict["block_id"]]
-    # Order the list by starting timestamp, block and then subject
-    queryset.sort(
-        key=lambda value_dict: (
-            subjects_starting_timestamp[value_dict["subject_code"]],
-            value_dict["block_id"],
-            value_dict["trial_id"],
-        )
+    new_block_ids = processing.first_appearance_codes(blocks)
+    new_trial_ids = processing.rank_within_groups(blocks, subject_index)
+
+    # Get the timestamp at which each user started the first trial.
+    subjects_starting_timestamp = experiment.subjects_starting_timestamps(
+        starting_date_useful_data
     )
-    # Output csv
-    return queryset
+    # Order by starting timestamp of the subject, block and then trial
+    starting_timestamps = np.array(
+        [
+            processing.to_microseconds(subjects_starting_timestamp[subject])
+            for subject in useful_subjects
+        ],
+        dtype=np.int64,
+    )
+    order = np.lexsort((new_trial_ids, new_block_ids, starting_timestamps))
+    if subjects is not None:
+        order = order[_subjects_mask(useful_subjects[order], subjects)]
+    block_sequences = dict(experiment.blocks.values_list("id", "sequence"))
+
+    columns = {
+        "experiment_code": np.full(len(order), code, dtype=object),
+        "subject_code": useful_subjects[order],
+        "block_id": new_block_ids[order],
+        "block_sequence": np.array(
+            [block_sequences[block] for block in blocks[order].tolist()], dtype=object
+        ),
+        "trial_id": new_trial_ids[order],
+        "correct_trial": trial_correct[useful][order],
+        "accumulated_correct_trials": accumulated_correct_trials[order],
+        "execution_time_ms": execution_time_ms[useful][order],
+        "tapping_speed_mean": tapping_speed_mean[useful][order],
+        "tapping_speed_extra_keypress": tapping_speed_extra_keypress[useful][order],
+    }
+    if len(order) == 0:
+        return []
+    return [(columns, {name: _csv_values(values) for name, values in columns.items()})]
 
 
 @login_required
 def download_processed_data(request):
-    """Runs the full cloud process to calculate processed data if necessary, and then downloads the file from cloud storage."""
+    """Updates the stored processed data of the experiment if necessary (see process_stored_file), and then downloads
+    the file from the file storage. The file is downloaded in the format given by the "format" parameter
+    (see export_format).
+    """
     form = ExperimentCode(request.GET)
     if form.is_valid():
         code = form.cleaned_data["code"]
+        file_format = export_format(request)
         experiment = Experiment.objects.get(pk=code)
+        filename = "processed_experiment_{}".format(code)
         # If the experiment is not published, just download the experiment data
         if not experiment.published:
-            output_dict = process_data(experiment.creator, code)
-            f = io.StringIO()
-            if len(output_dict) > 0:
-                writer = csv.DictWriter(f, output_dict[0].keys())
-                writer.writeheader()
-            else:
-                writer = csv.DictWriter(f, ["experiment"])
-            writer.writerows(output_dict)
-            csv_content = f.getvalue()
-        else:
-            cloud_process_data(request)
-            code = form.cleaned_data["code"]
-            cs_bucket = storage.Client().bucket(BUCKET_NAME)
-            blob = cs_bucket.blob(f"processed_data/{code}.csv")
-            if blob is None:
-                raise Http404("Experiment is not ready for downloading yet")
-            csv_content = blob.download_as_string()
-        # Output csv
-        response = HttpResponse(csv_content, content_type="text/csv")
-        response[
-            "Content-Disposition"
-        ] = 'attachment; filename="processed_experiment_{}.csv"'.format(code)
+            return export_response(
+                process_data_chunks(experiment.creator, code),
+                filename,
+                file_format,
+                EXPORT_COLUMNS["processed_data"],
+            )
+        process_stored_file(experiment, "processed_data")
+        stored_file = get_storage().get(f"processed_data/{code}.{file_format}")
+        if stored_file is None:
+            raise Http404("Experiment is not ready for downloading yet")
+        return stored_file_response(
+            stored_file,
+            f"{filename}.{file_format}",
+            EXPORT_CONTENT_TYPES[file_format],
+        )
 
-        return response
 
+def learning_curve(experiment):
+    """Learning curve of an experiment (see analytics.summarize_learning_curve), calculated from its processed data.
+    It is cached for each trials and configuration version of the experiment, so it's only calculated
+    again after new trials are saved or the experiment changes.
 
-def cloud_process_data(request):
-    """Method to be run often that processes the experiment data available and generates the raw and processed data files
-    that can then be downloaded from Cloud Storage
-        _type_: _description_
+    Args:
+        experiment (Experiment): experiment to summarize
+
+    Returns:
+        dict: experiment code and name, and the blocks of every subject in the order of the processed data
     """
-    # For every published experiment, run the processing only if needed.
-    experiments = Experiment.objects.filter(published=True)
-    cs_bucket = storage.Client().bucket(BUCKET_NAME)
-    file_names = ["processed_data", "raw_data"]
-    methods = [process_data, raw_data]
-    for experiment in experiments:
-        num_responses = experiment.num_responses()
-        code = experiment.code
-        user = experiment.creator
-
-        for file_name, method in zip(file_names, methods):
-            # If the number of responses hasn't changed, the experiment is already processed.
-            # Check current files, to see if the num of responses is different
-            blob = cs_bucket.get_blob(f"{file_name}/{code}.csv")
-            if blob is not None and num_responses == int(
-                blob.metadata["num_responses"]
-            ):
-                # Already processed this data
-                logging.info(f"[{code}][{file_name}] Experiment already processed")
-                continue
+    key = f"learning_curve:{experiment.code}:{experiment.config_version}:{experiment.trials_version}"
+    summary = cache.get(key)
+    if summary is None:
+        chunks = process_data_chunks(experiment.creator, experiment.code)
+        summary = analytics.summarize_learning_curve(
+            experiment, chunks[0][0] if chunks else None
+        )
+        cache.set(key, summary, LEARNING_CURVE_TIMEOUT)
+    return summary
+
+
+@login_required
+def experiment_learning_curve(request, pk):
+    """API method to get the learning curve of an experiment of the current user (see learning_curve)"""
+    experiment = get_object_or_404(Experiment, pk=pk, creator=request.user)
+    return JsonResponse({"experiments": [learning_curve(experiment)]})
+
+
+@login_required
+def group_learning_curve(request, pk):
+    """API method to get the learning curves of all the experiments of a group of the current user"""
+    group = get_object_or_404(Group, pk=pk, creator=request.user)
+    experiments = group.experiments.filter(creator=request.user).order_by("created_at")
+    return JsonResponse(
+        {"experiments": [learning_curve(experiment) for experiment in experiments]}
+    )
+
+
+# Content type of the csv and columnar versions of the data files
+EXPORT_CONTENT_TYPES = {"csv": "text/csv", **columnar.CONTENT_TYPES}
+# Version of the processing done by raw_data and process_data. Increase it whenever their output changes,
+#   so that cloud_process_data generates the stored files again from scratch.
+PROCESSING_VERSION = "1"
+
+
+def _block_order(experiment, timestamp_field):
+    """Ids of the blocks of a published experiment with useful trials, ordered by the first time they
+    appear in the given timestamp field. Blocks are numbered in this order in the data files, so if
+    it changes the stored files have to be generated again.
+
+    Args:
+        experiment (Experiment): published experiment
+        timestamp_field (str or Expression): field, relative to the block, used to order the blocks
+    """
+    blocks = (
+        Block.objects.filter(
+            experiment=experiment,
+            trials__started_at__gt=experiment.published_timestamp,
+        )
+        .annotate(first_timestamp=Min(timestamp_field))
+        .order_by("first_timestamp", "id")
+        .values_list("id", flat=True)
+    )
+    return ",".join(str(block) for block in blocks)
+
+
+def _new_subjects(experiment, metadata):
+    """Finds the subjects whose trials are not in a stored data file yet, using the last trial id
+    and the number of trials saved in the file metadata.
+
+    Args:
+        experiment (Experiment): published experiment
+        metadata (dict): metadata of the stored file
+
+    Returns:
+        list: codes of the new subjects, or None if the file has to be generated again from scratch
+    """
+    if "last_trial_id" not in metadata or "num_trials" not in metadata:
+        return None
+    last_trial_id = int(metadata["last_trial_id"])
+    trials = Trial.objects.filter(
+        block__experiment=experiment,
+        started_at__gt=experiment.published_timestamp,
+    )
+    # Trials can be saved with a lower id than the last processed one, if their transaction finished later
+    if trials.filter(id__lte=last_trial_id).count() != int(metadata["num_trials"]):
+        return None
+    new_subjects = list(
+        trials.filter(id__gt=last_trial_id)
+        .values_list("subject_id", flat=True)
+        .distinct()
+    )
+    # The rows of subjects that already are in the file would have to be calculated again
+    if trials.filter(id__lte=last_trial_id, subject__in=new_subjects).exists():
+        return None
+    return new_subjects
+
 
+def _merge_subject_rows(file_storage, name, new_rows, subjects_starting_timestamp):
+    """Generator that merges the rows of new subjects into a csv file in the file storage, and yields the csv lines.
+    Rows stay ordered by the time each subject started the experiment.
+
+    Args:
+        file_storage (StorageBackend): file storage backend
+        name (str): name of the stored csv file
+        new_rows (iterable): row dictionaries of the new subjects, ordered by subject starting time
+        subjects_starting_timestamp (dict): timestamp at which every subject started the experiment
+    """
+    with tempfile.TemporaryFile(mode="w+b") as stored_file:
+        file_storage.download_to_file(name, stored_file)
+        stored_file.seek(0)
+        yield from _merge_csv_rows(
+            io.TextIOWrapper(stored_file, encoding="utf-8", newline=""),
+            new_rows,
+            subjects_starting_timestamp,
+        )
+
+
+def _merge_csv_rows(stored_file, new_rows, subjects_starting_timestamp):
+    """Generator that merges the rows of new subjects into a csv file. See _merge_subject_rows.
+
+    Args:
+        stored_file (file): csv file, opened in text mode
+        new_rows (iterable): row dictionaries of the new subjects, ordered by subject starting time
+        subjects_starting_timestamp (dict): timestamp at which every subject started the experiment
+    """
+    reader = csv.reader(stored_file)
+    header = next(reader, None)
+    if header is None:
+        # The stored file didn't have any rows
+        yield from csv_lines(new_rows)
+        return
+    writer = csv.writer(Echo())
+    yield writer.writerow(header)
+    subject_column = header.index("subject_code")
+    new_rows = iter(new_rows)
+    new_row = next(new_rows, None)
+    for row in reader:
+        started_at = subjects_starting_timestamp[row[subject_column]]
+        # Write the new subjects that started before the subject of this row
+        while (
+            new_row is not None
+            and subjects_starting_timestamp[new_row["subject_code"]] < started_at
+        ):
+            yield writer.writerow(new_row.values())
+            new_row = next(new_rows, None)
+        yield writer.writerow(row)
+    while new_row is not None:
+        yield writer.writerow(new_row.values())
+        new_row = next(new_rows, None)
+
+
+def _merge_columnar_file(
+    file_storage, name, writer, new_columns, subjects_starting_timestamp
+):
+    """Merges the columns of new subjects into a columnar file in the file storage, a batch of rows at a time.
+    Rows stay ordered by the time each subject started the experiment.
+
+    Args:
+        file_storage (StorageBackend): file storage backend
+        name (str): name of the stored columnar file
+        writer (ColumnarWriter): writer of the merged file, in the format of the stored file
+        new_columns (dict): columns of the new subjects, ordered by subject starting time
+        subjects_starting_timestamp (dict): timestamp at which every subject started the experiment
+    """
+    with tempfile.TemporaryFile(mode="w+b") as stored_file:
+        file_storage.download_to_file(name, stored_file)
+        stored_file.seek(0)
+        for columns in columnar.merge_subject_batches(
+            columnar.read_batches(stored_file, writer.file_format),
+            new_columns,
+            subjects_starting_timestamp,
+        ):
+            writer.write(columns)
+
+
+def _write_columns(chunks, writers):
+    """Generator that writes the typed columns of every chunk with the given columnar writers, and yields the chunks
+
+    Args:
+        chunks (iterable): typed columns and csv columns of each chunk, like the ones of raw_data_chunks
+        writers (list): ColumnarWriter of each columnar file
+    """
+    for chunk in chunks:
+        for writer in writers:
+            writer.write(chunk[0])
+        yield chunk
+
+
+def _process_experiment_file(
+    file_storage, experiment, file_name, method, block_timestamp_field, rebuild
+):
+    """Generates or updates one of the data files of a published experiment in the file storage, as a csv file
+    and as a file in each of the available columnar formats (see columnar). All of them are generated in a single pass.
+
+    Args:
+        file_storage (StorageBackend): file storage backend
+        experiment (Experiment): published experiment, annotated with last_trial_id and num_trials
+        file_name (str): type of data file
+        method (function): method that returns the chunks of the file, like raw_data_chunks
+        block_timestamp_field (str or Expression): field used to number the blocks in the file. See _block_order.
+        rebuild (bool): whether to generate the file from scratch
+
+    Returns:
+        str: "skipped" if the file was up to date, "updated" if new subjects were merged into it,
+            or "processed" if it was generated from scratch
+    """
+    code = experiment.code
+    user = experiment.creator
+    metadata = {
+        "processing_version": PROCESSING_VERSION,
+        "last_trial_id": str(experiment.last_trial_id or 0),
+        "num_trials": str(experiment.num_trials),
+    }
+    file_formats = ["csv"] + columnar.available_formats()
+    stored_files = {
+        file_format: file_storage.get(f"{file_name}/{code}.{file_format}")
+        for file_format in file_formats
+    }
+    stored_metadata = [
+        stored_file.metadata if stored_file is not None else {}
+        for stored_file in stored_files.values()
+    ]
+    # If no trials were saved since the last run, the experiment is already processed.
+    if not rebuild and all(
+        file_metadata.get(key) == value
+        for file_metadata in stored_metadata
+        for key, value in metadata.items()
+    ):
+        # Already processed this data
+        logging.info(f"[{code}][{file_name}] Experiment already processed")
+        return "skipped"
+
+    file_metadata = {
+        **metadata,
+        "block_ids": _block_order(experiment, block_timestamp_field),
+    }
+    new_subjects = None
+    # Files are only updated if all of them were generated from the same trials
+    if (
+        not rebuild
+        and stored_metadata[0].get("processing_version") == PROCESSING_VERSION
+        and stored_metadata[0].get("block_ids") == file_metadata["block_ids"]
+        and all(other == stored_metadata[0] for other in stored_metadata[1:])
+    ):
+        new_subjects = _new_subjects(experiment, stored_metadata[0])
+
+    # Write the files to temporary files, so that they do not have to fit in memory
+    with contextlib.ExitStack() as stack:
+        files = {
+            file_format: stack.enter_context(tempfile.TemporaryFile(mode="w+b"))
+            for file_format in file_formats
+        }
+        writers = [
+            columnar.ColumnarWriter(files[file_format], file_format)
+            for file_format in file_formats[1:]
+        ]
+        if new_subjects is None:
             logging.info(f"[{code}][{file_name}] Processing experiment...")
+            lines = csv_lines(
+                export_rows(_write_columns(method(user, code), writers)),
+                EXPORT_COLUMNS[file_name],
+            )
+        else:
+            logging.info(
+                f"[{code}][{file_name}] Processing {len(new_subjects)} new subjects..."
+            )
+            chunks = list(method(user, code, subjects=new_subjects))
+            subjects_starting_timestamp = experiment.subjects_starting_timestamps(
+                experiment.published_timestamp
+            )
+            lines = _merge_subject_rows(
+                file_storage,
+                stored_files["csv"].name,
+                export_rows(chunks),
+                subjects_starting_timestamp,
+            )
+            new_columns = columnar.concatenate([columns for columns, _ in chunks])
+            for writer in writers:
+                _merge_columnar_file(
+                    file_storage,
+                    stored_files[writer.file_format].name,
+                    writer,
+                    new_columns,
+                    subjects_starting_timestamp,
+                )
+        for line in lines:
+            files["csv"].write(line.encode("utf-8"))
+        for writer in writers:
+            writer.close()
+        logging.info(f"[{code}][{file_name}] Uploading files to the file storage...")
+        for file_format, f in files.items():
+            f.seek(0)
+            # Add the last processed trial to the metadata, to know which trials to process in the next run.
+            file_storage.upload_file(
+                f"{file_name}/{code}.{file_format}",
+                f,
+                content_type=EXPORT_CONTENT_TYPES[file_format],
+                metadata=file_metadata,
+            )
+    return "processed" if new_subjects is None else "updated"
+
+
+@login_required
+def download_study_analytics(request, pk):
+    """Downloads the analytics of a study of the current user (see study_analytics) as a json file.
+    The analytics of published studies are updated and kept in the file storage, and the ones of
+    unpublished studies are calculated every time.
+    """
+    study = get_object_or_404(Study, pk=pk, creator=request.user)
+    filename = f"study_analytics_{study.code}.json"
+    if not study.published:
+        response = JsonResponse(analytics.study_analytics(study))
+        response["Content-Disposition"] = f'attachment; filename="{filename}"'
+        return response
+    file_storage = get_storage()
+    analytics.process_study_analytics(file_storage, study, rebuild=False)
+    return stored_file_response(
+        file_storage.get(f"study_analytics/{study.code}.json"),
+        filename,
+        "application/json",
+    )
+
+
+def _cloud_process_job(owner, file_name, process, *args):
+    """Runs a function that processes a stored file in a worker thread, retrying it if it fails.
+    Every thread uses its own database connection, which is closed when the job finishes.
+
+    Args:
+        owner (dict): type and code of the owner of the file, like {"experiment": "ABCD"}
+        file_name (str): type of data file
+        process (function): function that processes the file and returns its status, like _process_experiment_file
+        args: arguments of the function
+
+    Returns:
+        dict: summary of the job
+    """
+    start_time = time.perf_counter()
+    (code,) = owner.values()
+    result = {**owner, "file": file_name}
+    try:
+        for attempt in range(1, CLOUD_PROCESS_ATTEMPTS + 1):
             try:
-                # Run the corresponding method
-                output_dict = method(user, code)
+                result["status"] = process(*args)
+                result.pop("error", None)
+                break
             except Exception as e:
-                logging.error(e)
-                continue
+                logging.error(f"[{code}][{file_name}] Attempt {attempt} failed: {e}")
+                result["status"] = "failed"
+                result["error"] = str(e)
+                # The connection could be the reason of the failure, so start the next attempt with a new one
+                connection.close()
+    finally:
+        connection.close()
+    result["attempts"] = attempt
+    result["seconds"] = round(time.perf_counter() - start_time, 3)
+    return result
+
+
+def _with_processed_trials(experiments):
+    """Annotates published experiments with the last trial id and number of trials that their stored files
+    are generated from, as needed by _process_experiment_file
 
-            f = io.StringIO()
-            if len(output_dict) > 0:
-                writer = csv.DictWriter(f, output_dict[0].keys())
-                writer.writeheader()
-            else:
-                writer = csv.DictWriter(f, ["experiment"])
-            writer.writerows(output_dict)
-            logging.info(f"[{code}][{file_name}] Uploading csv to Cloud Storage...")
-            # Upload to Cloud Storage
-            blob = cs_bucket.blob(f"{file_name}/{code}.csv")
-            # Add number of responses to metadata for easy check on whether we should run the processing again or not.
-            blob.metadata = {"num_responses": num_responses}
-            f.seek(0)
-            blob.upload_from_file(f, content_type="text/csv")
-            f.close()
-
-    return HttpResponse()
-
-
-# region
-# def process_bonstrup(user, exp_code):
-#     pk = exp_code
-#     # Get all experiments subjects
-#     experiment = get_object_or_404(Experiment, pk=pk, creator=user)
-#     # If the experiment hasn't been published, get all responses
-#     starting_date_useful_data = experiment.created_at
-#     # If it has, then only get those after the publishing timestamp
-#     if experiment.published:
-#         starting_date_useful_data = experiment.published_timestamp
-
-#     results = (
-#         Experiment.objects.filter(
-#             pk=pk,
-#             creator=user,
-#             blocks__trials__started_at__gt=starting_date_useful_data,
-#         )
-#         .annotate(Count("blocks__trials__keypresses"))
-#         .values(
-#             "code",
-#             "blocks",
-#             "blocks__trials__subject",
-#             "blocks__sequence",
-#             "blocks__trials",
-#             "blocks__trials__partial_correct",
-#             "blocks__trials__correct",
-#             "blocks__trials__started_at",
-#             "blocks__trials__keypresses__count",
-#         )
-#         .order_by("blocks__trials__started_at")
-#         .distinct()
-#     )
-#     results = list(results)
-
-#     acc_correct_trials = defaultdict(lambda: 0)
-#     for values_dict in results:
-#         values_dict["experiment_code"] = values_dict.pop("code")
-#         values_dict["subject_code"] = values_dict.pop("blocks__trials__subject")
-#         values_dict["block_id"] = values_dict.pop("blocks")
-#         values_dict["block_sequence"] = values_dict.pop("blocks__sequence")
-#         values_dict["trial_id"] = values_dict.pop("blocks__trials")
-#         values_dict["correct_trial"] = values_dict.pop("blocks__trials__correct")
-#         values_dict["partial_correct_trial"] = values_dict.pop(
-#             "blocks__trials__partial_correct"
-#         )
-#         values_dict.pop("blocks__trials__started_at")
-#         if values_dict["correct_trial"]:
-#             acc_correct_trials[
-#                 (values_dict["block_id"], values_dict["subject_code"])
-#             ] += 1
-#         values_dict["accumulated_correct_trials"] = acc_correct_trials[
-#             (values_dict["block_id"], values_dict["subject_code"])
-#         ]
-#         values_dict["num_keypresses"] = values_dict.pop(
-#             "blocks__trials__keypresses__count"
-#         )
-
-#     # For each block, subject, get the first and last trial starting and finish timestamps.
-#     trial_timestamps = {}
-#     block_results = (
-#         Block.objects.filter(experiment__code=pk, trials__partial_correct=True)
-#         .annotate(first_trial_started_at=Min("trials__started_at"))
-#         .annotate(last_trial_finished_at=Max("trials__finished_at"))
-#         .values(
-#             "id", "trials__subject", "first_trial_started_at", "last_trial_finished_at"
-#         )
-#     )
-#     for values_dict in block_results:
-#         trial_timestamps[(values_dict["id"], values_dict["trials__subject"])] = (
-#             values_dict["first_trial_started_at"],
-#             values_dict["last_trial_finished_at"],
-#         )
-
-#     trials_query = (
-#         Trial.objects.filter(block__experiment__code=pk)
-#         .order_by("keypresses__timestamp")
-#         .values(
-#             "id",
-#             "keypresses__id",
-#             "keypresses__timestamp",
-#             "started_at",
-#             "finished_at",
-#             "block__id",
-#             "subject__code",
-#             "partial_correct",
-#         )
-#     )
-#     # From the trials, I need all the keypress timestamps ordered from low to high
-#     trials = {}
-#     for res in trials_query:
-#         trial_dict = trials.get(res["id"], {})
-#         # Starting timestamp
-#         trial_dict["started_at"] = res["started_at"]
-#         # Finishing timestamp
-#         trial_dict["finished_at"] = res["finished_at"]
-#         # Block id
-#         trial_dict["block_id"] = res["block__id"]
-#         # Subject code
-#         trial_dict["subject_code"] = res["subject__code"]
-#         # Partial correct
-#         trial_dict["partial_correct"] = res["partial_correct"]
-#         # Keypresses
-#         trial_dict["keypresses"] = trial_dict.get("keypresses", []) + [
-#             res["keypresses__timestamp"]
-#         ]
-#         trials[res["id"]] = trial_dict
-#     for values_dict in results:
-#         # If first trial of block: difference between starting of trial and first keypress of next.
-#         # If last trial of block: difference between first keypress and end of trial
-#         # else: difference between first keypress of this block, and first of the next.
-#         trial = trials.get(values_dict["trial_id"], None)
-#         if (
-#             trial is not None
-#             and len(trial.get("keypresses", [])) > 0
-#             and trial["partial_correct"]
-#         ):
-#             execution_time_ms = -1
-#             start_time = None
-#             finish_time = None
-#             # Check if the trial is the last one of the block
-#             if (
-#                 trial["finished_at"]
-#                 == trial_timestamps[
-#                     (values_dict["block_id"], values_dict["subject_code"])
-#                 ][1]
-#             ):
-#                 start_time = trial["keypresses"][0]
-#                 finish_time = trial["finished_at"]
-#             # Else, get next trial: same subject and block, minimum starting time that is greater than this finishing time
-#             else:
-#                 next_trials = sorted(
-#                     [
-#                         (key, values["started_at"])
-#                         for key, values in trials.items()
-#                         if values["started_at"] >= trial["finished_at"]
-#                         and values["subject_code"] == trial["subject_code"]
-#                         and values["block_id"] == trial["block_id"]
-#                     ],
-#                     key=lambda val: val[1],
-#                 )
-#                 try:
-#                     next_trial_id = next_trials[0][0]
-#                 except IndexError:
-#                     raise Exception("Next trial not found")
-#                 next_trial = trials[next_trial_id]
-#                 # Check if the next trial has any keypresses
-#                 if len(next_trial["keypresses"]) == 0:
-#                     # Then, execution time is as if this is the last trial
-#                     finish_time = trial["finished_at"]
-#                 else:
-#                     finish_time = next_trial["keypresses"][0]
-#                 # Check if it's the first trial
-#                 if (
-#                     trial["started_at"]
-#                     == trial_timestamps[
-#                         (values_dict["block_id"], values_dict["subject_code"])
-#                     ][0]
-#                 ):
-#                     start_time = trial["started_at"]
-#                 else:
-#                     start_time = trial["keypresses"][0]
-#             execution_time_ms = (finish_time - start_time).total_seconds() * 1000
-#             # Tapping speed
-#             tap_speed = []
-#             keypresses = trial["keypresses"]
-#             # print("keypresses", keypresses)
-#             for index, keypress in enumerate(keypresses):
-#                 if index == 0:
-#                     continue
-#                 elapsed = (keypress - keypresses[index - 1]).total_seconds()
-#                 # FIXME: this happens when two keypresses are mapped to the same timestamp
-#                 try:
-#                     tap_speed.append(1.0 / elapsed)
-#                 except ZeroDivisionError:
-#                     tap_speed.append(np.nan)
-#             # Mean and std deviation of tapping speed
-#             mean_tap_speed = np.nanmean(tap_speed)
-#             std_dev_tap_speed = np.nanstd(tap_speed, ddof=1)
-
-#             # Execution time
-#             values_dict["execution_time_ms"] = execution_time_ms
-#             # Tapping data
-#             values_dict["tapping_speed_mean_individual"] = (
-#                 mean_tap_speed if not np.isnan(mean_tap_speed) else None
-#             )
-#             values_dict["tapping_speed_std_dev_individual"] = (
-#                 std_dev_tap_speed if not np.isnan(std_dev_tap_speed) else None
-#             )
-#             mean_tap_speed_2 = (
-#                 1000 * len(keypresses) / execution_time_ms
-#                 if execution_time_ms > 0
-#                 else None
-#             )
-#             values_dict["tapping_speed_mean_aggregated"] = mean_tap_speed_2
-#         else:
-#             values_dict["execution_time_ms"] = None
-#             # Tapping data
-#             values_dict["tapping_speed_mean_individual"] = None
-#             values_dict["tapping_speed_std_dev_individual"] = None
-#             values_dict["tapping_speed_mean_aggregated"] = None
-#     # Order subjects by time when they started the first trial
-#     subjects = [
-#         Subject.objects.get(pk=code)
-#         for code in unique([value["subject_code"] for value in results])
-#     ]
-#     # Sort by time when the user started the first trial
-#     subjects.sort(
-#         key=lambda subj: subj.trials.order_by("started_at").first().started_at
-#     )
-#     subjects_starting_timestamp = {
-#         subject.code: subject.trials.order_by("started_at").first().started_at
-#         for subject in subjects
-#     }
-#     possible_subjects = [subj.code for subj in subjects]
-#     new_subject_codes = {
-#         subject: index + 1 for index, subject in enumerate(possible_subjects)
-#     }
-#     possible_blocks = unique([value["block_id"] for value in results])
-#     new_block_codes = {block: index + 1 for index, block in enumerate(possible_blocks)}
-#     # Trials are not fixed across different experiments or blocks.
-#     # If we are on the same experiment and block, start adding up
-#     # for every combination of block-subject, we have a different count
-#     # {(block, subject): {trial_1: 1, trial_2:2, trial_3:3}}
-#     aux_values = defaultdict(dict)
-#     for values_dict in results:
-#         # To get the new id
-#         trial_id_dict = aux_values[
-#             (values_dict["block_id"], values_dict["subject_code"])
-#         ]
-#         if values_dict["trial_id"] not in trial_id_dict:
-#             trial_id_dict[values_dict["trial_id"]] = len(trial_id_dict.keys()) + 1
-#     # Change the subject, block and trials ids to a numbered code
-#     for values_dict in results:
-#         values_dict["trial_id"] = aux_values[
-#             (values_dict["block_id"], values_dict["subject_code"])
-#         ][values_dict["trial_id"]]
-#         # values_dict["subject_code"] = new_subject_codes[values_dict["subject_code"]]
-#         values_dict["block_id"] = new_block_codes[values_dict["block_id"]]
-#         # values_dict["trial_id"] = new_trial_codes[values_dict["trial_id"]]
-#     # Order the list by block and then subject
-#     results.sort(
-#         key=lambda value_dict: (
-#             subjects_starting_timestamp[value_dict["subject_code"]],
-#             value_dict["block_id"],
-#             value_dict["trial_id"],
-#         )
-#     )
-
-#     return results
-
-
-# @login_required
-# def download_bonstrup_processed(request, pk):
-#     cloud_process_data(request)
-#     cs_bucket = storage.Client().bucket(BUCKET_NAME)
-#     blob = cs_bucket.blob(f"bonstrup_processed/{pk}.csv")
-#     if blob is None:
-#         raise Http404("Experiment is not ready for downloading yet")
-#     csv_content = blob.download_as_string()
-#     # Output csv
-#     response = HttpResponse(csv_content, content_type="text/csv")
-#     response[
-#         "Content-Disposition"
-#     ] = 'attachment; filename="bonstrup_processed_{}.csv"'.format(pk)
-
-#     return response
-# endregion
+    Args:
+        experiments (QuerySet): published experiments
+    """
+    useful_trials = Q(blocks__trials__started_at__gt=F("published_timestamp"))
+    return experiments.annotate(
+        last_trial_id=Max("blocks__trials__id", filter=useful_trials),
+        num_trials=Count("blocks__trials", filter=useful_trials),
+    )
 
 
-@login_required
-def download_survey(request, pk):
-    """Downloads a csv file containing the end survey for the experiment
+def _experiment_files():
+    """Data files of every published experiment kept in the file storage by cloud_process_data
+
+    Returns:
+        list: name of each file, method that returns its chunks, and field used to number its blocks
+            (see _block_order)
+    """
+    # Blocks are numbered by the first trial in processed and Bönstrup data, and by the first keypress in raw data
+    return [
+        ("processed_data", process_data_chunks, "trials__started_at"),
+        (
+            "raw_data",
+            raw_data_chunks,
+            Coalesce(
+                "trials__keypresses__timestamp", "trials__packed_first_keypress_at"
+            ),
+        ),
+        ("bonstrup_processed", process_bonstrup_chunks, "trials__started_at"),
+    ]
+
+
+def process_stored_file(experiment, file_name):
+    """Brings one of the data files of a published experiment up to date in the file storage before it is
+    downloaded. Only that file is processed: the rest of the files and the study analytics are left to
+    cloud_process_data.
 
     Args:
-        request (HTML request)
-        pk (str): Experiment identifier
+        experiment (Experiment): published experiment
+        file_name (str): type of data file, one of the names of _experiment_files
+    """
+    experiment = _with_processed_trials(
+        Experiment.objects.filter(pk=experiment.pk).select_related("creator")
+    ).get()
+    for name, method, block_timestamp_field in _experiment_files():
+        if name == file_name:
+            _process_experiment_file(
+                get_storage(),
+                experiment,
+                file_name,
+                method,
+                block_timestamp_field,
+                False,
+            )
+
 
+def process_stored_files(rebuild=False):
+    """Processes the experiment data available and generates the raw and processed data files that can then be
+    downloaded from the file storage. Each file is stored as csv and in the available columnar formats.
+    Files are updated incrementally: the metadata of each file stores the last trial that was processed, and only the
+    subjects with newer trials are processed and merged into the file.
+    The analytics of every published study (see study_analytics) are updated in the same way.
+    Each experiment file is processed as a separate job, and jobs run in a pool of CLOUD_PROCESS_WORKERS threads.
+
+    Args:
+        rebuild (bool, optional): process every experiment and study from scratch. Defaults to False.
+
+    Returns:
+        list: summary of every job
     """
-    # Get all experiments subjects
-    experiment = get_object_or_404(Experiment, pk=pk, creator=request.user)
+    # For every published experiment, run the processing only if needed.
+    experiments = _with_processed_trials(
+        Experiment.objects.filter(published=True).select_related("creator")
+    )
+    file_storage = get_storage()
+    with ThreadPoolExecutor(max_workers=CLOUD_PROCESS_WORKERS) as executor:
+        jobs = [
+            executor.submit(
+                _cloud_process_job,
+                {"experiment": experiment.code},
+                file_name,
+                _process_experiment_file,
+                file_storage,
+                experiment,
+                file_name,
+                method,
+                block_timestamp_field,
+                rebuild,
+            )
+            for experiment in experiments
+            for file_name, method, block_timestamp_field in _experiment_files()
+        ]
+        # The analytics of every published study, comparing its groups
+        jobs += [
+            executor.submit(
+                _cloud_process_job,
+                {"study": study.code},
+                "study_analytics",
+                analytics.process_study_analytics,
+                file_storage,
+                study,
+                rebuild,
+            )
+            for study in Study.objects.filter(published=True)
+        ]
+        return [job.result() for job in jobs]
+
+
+def cloud_process_data(request):
+    """Method to be run often by the cron job (see cron.yaml) that updates the stored files with process_stored_files,
+    and returns a summary of every job. Adding "rebuild=true" to the request processes every experiment from scratch,
+    which is only allowed to the cron job and to staff users.
+    """
+    rebuild = request.GET.get("rebuild", "false").lower() == "true"
+    # App Engine removes this header from requests that don't come from its cron service
+    from_cron = request.headers.get("X-Appengine-Cron") == "true"
+    if rebuild and not (from_cron or request.user.is_staff):
+        return HttpResponseForbidden(
+            "Only the cron job and staff users can rebuild the files"
+        )
+    return JsonResponse({"jobs": process_stored_files(rebuild)})
+
+
+def process_bonstrup(user, exp_code, subjects=None):
+    """Processes an experiment's data for the micro-online and micro-offline analysis of Bönstrup et al. (2019),
+    and returns a list with a row per trial. See process_bonstrup_chunks.
+
+    Args:
+        user (object): current user object
+        exp_code (str): experiment identifier
+        subjects (list, optional): only return the rows of these subject codes. Blocks are still
+            numbered using every trial of the experiment. Defaults to all subjects.
+    """
+    return list(export_rows(process_bonstrup_chunks(user, exp_code, subjects)))
+
+
+def process_bonstrup_chunks(user, exp_code, subjects=None):
+    """Processes an experiment's data like process_bonstrup, returning it as a single chunk of rows.
+    Only partially correct trials with keypresses get an execution time and tapping speeds. The execution time
+    of the first trial of each block goes from the start of the trial to the first keypress of the next trial,
+    the one of the last trial from its first keypress to its end, and the one of the rest from their first
+    keypress to the first keypress of the next trial. Every trial also gets the micro-online and micro-offline
+    gains of its block (see processing.block_gains).
+
+    Returns:
+        list: tuple with the typed columns of the chunk (see columnar) and the same columns as the
+            values written to the csv file, or no chunks if there is no data
+    """
+    code = exp_code
+    # Make sure that the user downloading it is the owner of the experiment
+    experiment = get_object_or_404(Experiment, pk=code, creator=user)
     # If the experiment hasn't been published, get all responses
     starting_date_useful_data = experiment.created_at
     # If it has, then only get those after the publishing timestamp
     if experiment.published:
         starting_date_useful_data = experiment.published_timestamp
-    # For each subject, check if it has a survey
-    subjects_surveys = (
-        Experiment.objects.filter(
-            pk=pk,
-            creator=request.user,
-            blocks__trials__started_at__gt=starting_date_useful_data,
+    # All trials in the experiment, ordered by starting time. Trials before the starting date are
+    # also needed, as they can be the trial after one of the useful trials.
+    trials_query = (
+        Trial.objects.filter(block__experiment=experiment)
+        .order_by("started_at", "id")
+        .values_list(
+            "id",
+            "block_id",
+            "subject_id",
+            "correct",
+            "partial_correct",
+            "started_at",
+            "finished_at",
         )
-        .values("code", "blocks__trials__subject")
-        .distinct()
     )
-    subjects_surveys = list(subjects_surveys)
-    subjects = [
-        Subject.objects.get(pk=code)
-        for code in unique(
-            [value["blocks__trials__subject"] for value in subjects_surveys]
-        )
+    (
+        trial_ids,
+        trial_blocks,
+        trial_subjects,
+        trial_correct,
+        trial_partial_correct,
+        trial_started_at,
+        trial_finished_at,
+    ) = processing.rows_to_columns(
+        trials_query.iterator(chunk_size=EXPORT_CHUNK_SIZE),
+        [np.int64, np.int64, object, bool, bool, "timestamp", "timestamp"],
+        chunk_size=EXPORT_CHUNK_SIZE,
+    )
+    keypress_trials_query = Trial.objects.filter(block__experiment=experiment)
+    if subjects is not None:
+        # The metrics of a trial only depend on the trials of the same subject
+        keypress_trials_query = keypress_trials_query.filter(subject__in=subjects)
+    keypress_trials, keypress_timestamps = load_keypresses(
+        keypress_trials_query, with_values=False
+    )
+    trials_order = np.argsort(trial_ids)
+    keypress_trial_index = trials_order[
+        np.searchsorted(trial_ids, keypress_trials, sorter=trials_order)
     ]
-    # Sort by time when the user started the first trial
-    subjects.sort(
-        key=lambda subj: subj.trials.order_by("started_at").first().started_at
+    (
+        num_keypresses,
+        first_keypress_at,
+        tapping_speed_mean,
+        tapping_speed_std,
+    ) = processing.keypress_speeds(
+        keypress_trial_index, keypress_timestamps, len(trial_ids)
     )
-    # Dict containing the starting timestamp for each subject
-    subjects_starting_timestamp = {
-        subject.code: subject.trials.order_by("started_at").first().started_at
-        for subject in subjects
-    }
-    # Translation of the survey components
-    survey = {
-        "age": "Age",
-        "gender": "Gender",
-        "comp_type": "Computer Type",
-        "medical_condition": "Medical condition",
-        "hours_of_sleep": "Hours of Sleep night before",
-        "excercise_regularly": "Excercise Regularly",
-        "level_education": "Level of Education",
-        "keypress_experiment_before": "Done keypress experiment before",
-        "followed_instructions": "Followed instructions",
-        "hand_used": "Hand used for experiment",
-        "dominant_hand": "Dominant Hand",
-        "comments": "Comments",
+
+    # First and last partially correct trials of every block and subject
+    subject_index = processing.factorize(trial_subjects)
+    block_subject = processing.factorize(
+        subject_index * (trial_blocks.max(initial=0) + 1) + trial_blocks
+    )
+    num_block_subjects = block_subject.max(initial=-1) + 1
+    first_started_at = processing.group_extremes(
+        trial_started_at, block_subject, num_block_subjects, trial_partial_correct
+    )[0]
+    last_finished_at = processing.group_extremes(
+        trial_finished_at, block_subject, num_block_subjects, trial_partial_correct
+    )[1]
+    is_first = trial_started_at == first_started_at[block_subject]
+    is_last = trial_finished_at == last_finished_at[block_subject]
+    # First keypress of the next trial of the same subject and block
+    next_trial = processing.next_in_group(
+        trial_started_at, trial_finished_at, subject_index, trial_blocks
+    )
+    next_first_keypress_at = np.where(
+        next_trial >= 0, first_keypress_at[next_trial], processing.MISSING_TIMESTAMP
+    )
+    execution_started_at = np.where(
+        is_first & ~is_last, trial_started_at, first_keypress_at
+    )
+    # If there is no next trial, or it has no keypresses, the execution time is calculated as if it was the last trial
+    execution_finished_at = np.where(
+        is_last | (next_first_keypress_at == processing.MISSING_TIMESTAMP),
+        trial_finished_at,
+        next_first_keypress_at,
+    )
+    with_metrics = trial_partial_correct & (num_keypresses > 0)
+    execution_time_ms = np.where(
+        with_metrics,
+        (execution_finished_at - execution_started_at) / 1e6 * 1000,
+        np.nan,
+    )
+    tapping_speed_mean = np.where(with_metrics, tapping_speed_mean, np.nan)
+    tapping_speed_std = np.where(with_metrics, tapping_speed_std, np.nan)
+    with np.errstate(divide="ignore", invalid="ignore"):
+        tapping_speed_aggregated = np.where(
+            execution_time_ms > 0, 1000 * num_keypresses / execution_time_ms, np.nan
+        )
+
+    # Only keep the trials after the starting date
+    useful = np.flatnonzero(
+        trial_started_at > processing.to_microseconds(starting_date_useful_data)
+    )
+    if len(useful) == 0:
+        return []
+    useful_subjects = trial_subjects[useful]
+    blocks = trial_blocks[useful]
+    subject_index = subject_index[useful]
+    # Accumulated count of correct trials for every block and subject
+    accumulated_correct_trials = processing.cumsum_within_groups(
+        trial_correct[useful], blocks, subject_index
+    )
+    new_block_ids = processing.first_appearance_codes(blocks)
+    new_trial_ids = processing.rank_within_groups(blocks, subject_index)
+    subjects_starting_timestamp = experiment.subjects_starting_timestamps(
+        starting_date_useful_data
+    )
+    starting_timestamps = np.array(
+        [
+            processing.to_microseconds(subjects_starting_timestamp[subject])
+            for subject in useful_subjects
+        ],
+        dtype=np.int64,
+    )
+    # Order by starting timestamp of the subject, block and then trial. Subjects that started at the
+    #   same time are kept apart, so that the blocks of every subject are together.
+    order = np.lexsort(
+        (new_trial_ids, new_block_ids, subject_index, starting_timestamps)
+    )
+    if subjects is not None:
+        order = order[_subjects_mask(useful_subjects[order], subjects)]
+    if len(order) == 0:
+        return []
+    micro_online_gain, micro_offline_gain = processing.block_gains(
+        tapping_speed_mean[useful][order], subject_index[order], new_block_ids[order]
+    )
+    block_sequences = dict(experiment.blocks.values_list("id", "sequence"))
+
+    columns = {
+        "experiment_code": np.full(len(order), code, dtype=object),
+        "subject_code": useful_subjects[order],
+        "block_id": new_block_ids[order],
+        "block_sequence": np.array(
+            [block_sequences[block] for block in blocks[order].tolist()], dtype=object
+        ),
+        "trial_id": new_trial_ids[order],
+        "correct_trial": trial_correct[useful][order],
+        "partial_correct_trial": trial_partial_correct[useful][order],
+        "accumulated_correct_trials": accumulated_correct_trials[order],
+        "num_keypresses": num_keypresses[useful][order],
+        "execution_time_ms": execution_time_ms[useful][order],
+        "tapping_speed_mean_individual": tapping_speed_mean[useful][order],
+        "tapping_speed_std_dev_individual": tapping_speed_std[useful][order],
+        "tapping_speed_mean_aggregated": tapping_speed_aggregated[useful][order],
+        "micro_online_gain": micro_online_gain,
+        "micro_offline_gain": micro_offline_gain,
     }
-    for values_dict in subjects_surveys:
-        values_dict["experiment_code"] = values_dict.pop("code")
-        started_experiment_at = subjects_starting_timestamp[
-            values_dict["blocks__trials__subject"]
-        ]
-        values_dict["subject_code"] = values_dict.pop("blocks__trials__subject")
-        values_dict["started_experiment_at"] = started_experiment_at
-
-        for value in survey.values():
-            values_dict[value] = None
-        
-        # Get the survey for this subject and experiment
-        survey_obj = EndSurvey.objects.filter(
-            experiment=pk,
-            subject=values_dict["subject_code"]
-        ).first()
-        
-        if survey_obj is not None:
-            # Add survey values
-            for key, value in survey.items():
-                values_dict[value] = getattr(survey_obj, key)
-
-    # Order the list by block and then subject
-    subjects_surveys.sort(
-        key=lambda value_dict: (subjects_starting_timestamp[value_dict["subject_code"]])
+    return [(columns, {name: _csv_values(values) for name, values in columns.items()})]
+
+
+@login_required
+def download_bonstrup_processed(request):
+    """Updates the stored Bönstrup data of the experiment if necessary (see process_stored_file), and then downloads
+    the file from the file storage. The file is downloaded in the format given by the "format" parameter
+    (see export_format).
+    """
+    form = ExperimentCode(request.GET)
+    if form.is_valid():
+        code = form.cleaned_data["code"]
+        file_format = export_format(request)
+        experiment = Experiment.objects.get(pk=code)
+        filename = "bonstrup_processed_{}".format(code)
+        # If the experiment is not published, just download the experiment data
+        if not experiment.published:
+            return export_response(
+                process_bonstrup_chunks(experiment.creator, code),
+                filename,
+                file_format,
+                EXPORT_COLUMNS["bonstrup_processed"],
+            )
+        process_stored_file(experiment, "bonstrup_processed")
+        stored_file = get_storage().get(f"bonstrup_processed/{code}.{file_format}")
+        if stored_file is None:
+            raise Http404("Experiment is not ready for downloading yet")
+        return stored_file_response(
+            stored_file,
+            f"{filename}.{file_format}",
+            EXPORT_CONTENT_TYPES[file_format],
+        )
+
+
+# Translation of the survey components
+SURVEY_QUESTIONS = {
+    "age": "Age",
+    "gender": "Gender",
+    "comp_type": "Computer Type",
+    "medical_condition": "Medical condition",
+    "hours_of_sleep": "Hours of Sleep night before",
+    "excercise_regularly": "Excercise Regularly",
+    "level_education": "Level of Education",
+    "keypress_experiment_before": "Done keypress experiment before",
+    "followed_instructions": "Followed instructions",
+    "hand_used": "Hand used for experiment",
+    "dominant_hand": "Dominant Hand",
+    "comments": "Comments",
+}
+# Columns of the survey file
+SURVEY_COLUMNS = [
+    "experiment_code",
+    "subject_code",
+    "started_experiment_at",
+    *SURVEY_QUESTIONS.values(),
+]
+
+
+def survey_rows(experiment):
+    """Reads the end survey of every subject of an experiment
+
+    Args:
+        experiment (Experiment): experiment whose survey is read
+
+    Returns:
+        iterable: row dictionaries, ordered by the time when each subject started the experiment
+    """
+    # If the experiment hasn't been published, get all responses
+    starting_date_useful_data = experiment.created_at
+    # If it has, then only get those after the publishing timestamp
+    if experiment.published:
+        starting_date_useful_data = experiment.published_timestamp
+    # Dict containing the starting timestamp for each subject
+    subjects_starting_timestamp = experiment.subjects_starting_timestamps(
+        starting_date_useful_data
     )
+    # Get all the surveys of this experiment at once, indexed by subject. If a subject
+    #   has more than one, keep the first one.
+    surveys = {}
+    for survey_values in (
+        EndSurvey.objects.filter(experiment=experiment, subject__isnull=False)
+        .order_by("id")
+        .values("subject_id", *SURVEY_QUESTIONS.keys())
+    ):
+        surveys.setdefault(survey_values["subject_id"], survey_values)
+
+    def rows():
+        # Order the rows by the time when each subject started the experiment
+        for subject_code, started_experiment_at in sorted(
+            subjects_starting_timestamp.items(), key=lambda item: item[1]
+        ):
+            values_dict = {
+                "experiment_code": experiment.code,
+                "subject_code": subject_code,
+                "started_experiment_at": started_experiment_at,
+            }
+            # Add survey values, if the subject answered it
+            survey_values = surveys.get(subject_code, {})
+            for key, value in SURVEY_QUESTIONS.items():
+                values_dict[value] = survey_values.get(key)
+            yield values_dict
+
+    return rows()
+
+
+@login_required
+def download_survey(request, pk):
+    """Downloads a csv file containing the end survey for the experiment
+
+    Args:
+        request (HTML request)
+        pk (str): Experiment identifier
+
+    """
+    # Get all experiments subjects
+    experiment = get_object_or_404(Experiment, pk=pk, creator=request.user)
     # Output csv
-    response = HttpResponse(content_type="text/csv")
-    response[
-        "Content-Disposition"
-    ] = 'attachment; filename="survey_experiment_{}.csv"'.format(pk)
-
-    if len(subjects_surveys) > 0:
-        writer = csv.DictWriter(response, subjects_surveys[0].keys())
-        writer.writeheader()
-    else:
-        writer = csv.DictWriter(response, ["experiment"])
-    writer.writerows(subjects_surveys)
+    return csv_response(
+        survey_rows(experiment),
+        "survey_experiment_{}.csv".format(pk),
+        SURVEY_COLUMNS,
+    )
+
+
+def _encoded_lines(lines):
+    """Generator that encodes text lines, like the ones of csv_lines, as utf-8"""
+    for line in lines:
+        yield line.encode("utf-8")
+
+
+def _study_archive_files(file_storage, experiment):
+    """Prepares the raw and processed data files of an experiment for archive.study_archive, in a worker thread.
+    The files of published experiments are brought up to date in the file storage, which only processes the
+    subjects that are not in them yet (see _process_experiment_file), and are then read from there. The processed
+    data of unpublished experiments is calculated here, and their raw data is read while it is written.
+
+    Args:
+        file_storage (StorageBackend): file storage backend
+        experiment (Experiment): experiment, annotated like in _with_processed_trials if it is published
+
+    Returns:
+        list: name of each file, where its content comes from ("storage" or "generated"), and its bytes chunks
+    """
+    try:
+        files = []
+        for file_name, method, block_timestamp_field in _experiment_files():
+            if file_name not in ["raw_data", "processed_data"]:
+                continue
+            if experiment.published:
+                _process_experiment_file(
+                    file_storage,
+                    experiment,
+                    file_name,
+                    method,
+                    block_timestamp_field,
+                    False,
+                )
+                stored_file = file_storage.get(f"{file_name}/{experiment.code}.csv")
+                chunks = file_storage.read_chunks(stored_file, DOWNLOAD_CHUNK_SIZE)
+                files.append((file_name, "storage", chunks))
+            else:
+                rows = export_rows(method(experiment.creator, experiment.code))
+                lines = csv_lines(rows, EXPORT_COLUMNS[file_name])
+                files.append((file_name, "generated", _encoded_lines(lines)))
+        return files
+    finally:
+        connection.close()
+
+
+def _study_archive_survey(experiment):
+    """End survey file of an experiment for archive.study_archive, generated while it is written"""
+    lines = csv_lines(survey_rows(experiment), SURVEY_COLUMNS)
+    return [("survey", "generated", _encoded_lines(lines))]
+
+
+@login_required
+def download_study(request, pk):
+    """Downloads the raw data, processed data and end survey of every experiment of a study of the current user,
+    as a single ZIP archive that is streamed while it is written (see archive.study_archive)
+    """
+    study = get_object_or_404(Study, pk=pk, creator=request.user)
+    experiments = _with_processed_trials(
+        study.experiments.filter(creator=request.user)
+        .select_related("creator", "group")
+        .order_by("group__created_at", "created_at", "code")
+    )
+    response = StreamingHttpResponse(
+        archive.study_archive(
+            study,
+            list(experiments),
+            partial(_study_archive_files, get_storage()),
+            _study_archive_survey,
+        ),
+        content_type="application/zip",
+    )
+    response["Content-Disposition"] = f'attachment; filename="study_{study.code}.zip"'
     return response
 
 
@@ -1406,48 +2281,58 @@ def current_user(request):
         return JsonResponse(user)
 
 
+def experiments_changed(user_id):
+    """Discards the cached version of the experiments of a user, so that user_experiments doesn't answer
+    with a 304 to an ETag given before the change. Must be called after any change to their experiments
+    or to the responses to them.
+
+    Args:
+        user_id (int): identifier of the creator of the experiments
+    """
+    cache.delete(f"experiments_version:{user_id}")
+
+
+def _user_experiments_etag(request):
+    """ETag of the experiments of the current user. Taken from the cache, so a request with a matching
+    If-None-Match header gets a 304 without querying the experiments."""
+    return cache.get_or_set(
+        f"experiments_version:{request.user.id}",
+        lambda: uuid.uuid4().hex,
+        EXPERIMENTS_VERSION_TIMEOUT,
+    )
+
+
 @login_required
+@cache_control(private=True, no_cache=True)
+@condition(etag_func=_user_experiments_etag)
 def user_experiments(request):
-    """API method to get all the experiments for the current user
+    """API method to get all the experiments for the current user, with their number of responses.
+    Supports ETags, so polling with If-None-Match gets a 304 if the experiments haven't changed.
 
 
     Returns:
         list: list of experiment dictionaries
     """
     if request.method == "GET":
-        exp_array = []
-        for experiment in request.user.experiments.all():
-            exp_obj = {}
-            exp_obj["code"] = experiment.code
-            exp_obj["name"] = experiment.name
-            exp_obj["published"] = experiment.published
-            if experiment.published:
-                exp_obj["responses"] = (
-                    Subject.objects.filter(
-                        trials__block__experiment=experiment,
-                        trials__started_at__gt=experiment.published_timestamp,
-                    )
-                    .distinct()
-                    .count()
-                )
-            else:
-                exp_obj["responses"] = (
-                    Subject.objects.filter(trials__block__experiment=experiment)
-                    .distinct()
-                    .count()
-                )
-            exp_obj["enabled"] = experiment.enabled
-            exp_array.append(exp_obj)
-        return JsonResponse({"experiments": exp_array})
+        experiments = request.user.experiments.annotate(
+            responses=EXPERIMENT_RESPONSES
+        ).values("code", "name", "published", "responses", "enabled")
+        return JsonResponse({"experiments": list(experiments)})
+
+
+@staff_member_required
+def request_metrics(request):
+    """API method for admins that returns the percentiles of the latest requests of each view.
+    Empty unless the REQUEST_METRICS setting is enabled, and only covers the process serving the request.
+    """
+    return JsonResponse({"views": instrumentation.view_percentiles()})
 
 
 @login_required
 def user_studies(request):
     """API method to get all studies from the current user"""
     if request.method == "GET":
-        return JsonResponse(
-            {"studies": [s.to_dict() for s in request.user.studies.all()]}
-        )
+        return JsonResponse({"studies": Study.to_dicts(request.user.studies.all())})
 
 
 def _publish_experiment(experiment):
@@ -1463,20 +2348,21 @@ def _publish_experiment(experiment):
     experiment.published = True
     experiment.published_timestamp = timezone.now()
     experiment.save()
+    experiment.config_changed()
     return
 
 
 @login_required
 def delete_experiment(request, pk):
-    """Deletes an experiment given by the pk experiment identifier. Also deletes data from Cloud Storage"""
+    """Deletes an experiment given by the pk experiment identifier. Also deletes data from the file storage"""
     experiment = get_object_or_404(Experiment, pk=pk, creator=request.user)
-    # Remove stuff from Cloud Storage
-    cs_bucket = storage.Client().bucket(BUCKET_NAME)
-    blobs = cs_bucket.list_blobs(prefix=f"experiment_files/{pk}")
-    for blob in blobs:
-        blob.delete()
+    # Remove stuff from the file storage
+    file_storage = get_storage()
+    for name in file_storage.list(f"experiment_files/{pk}"):
+        file_storage.delete(name)
 
     experiment.delete()
+    experiments_changed(request.user.id)
     return JsonResponse({})
 
 
@@ -1486,6 +2372,8 @@ def disable_experiment(request, pk):
     experiment = get_object_or_404(Experiment, pk=pk, creator=request.user)
     experiment.enabled = False
     experiment.save()
+    experiment.config_changed()
+    experiments_changed(request.user.id)
     return JsonResponse({})
 
 
@@ -1495,6 +2383,8 @@ def enable_experiment(request, pk):
     experiment = get_object_or_404(Experiment, pk=pk, creator=request.user)
     experiment.enabled = True
     experiment.save()
+    experiment.config_changed()
+    experiments_changed(request.user.id)
     return JsonResponse({})
 
 
@@ -1516,22 +2406,18 @@ def duplicate_experiment(request, pk):
         block.save()
 
     # Copy the consent and video
-    cs_bucket = storage.Client().bucket(BUCKET_NAME)
-    source_consent = cs_bucket.blob(
-        f"experiment_files/{original_pk_experiment}/consent.pdf"
-    )
-    source_video = cs_bucket.blob(
-        f"experiment_files/{original_pk_experiment}/video.mp4"
-    )
-
+    file_storage = get_storage()
     # Consent
-    cs_bucket.copy_blob(
-        source_consent, cs_bucket, f"experiment_files/{experiment.pk}/consent.pdf"
+    file_storage.copy(
+        f"experiment_files/{original_pk_experiment}/consent.pdf",
+        f"experiment_files/{experiment.pk}/consent.pdf",
     )
     # Video
-    cs_bucket.copy_blob(
-        source_video, cs_bucket, f"experiment_files/{experiment.pk}/video.mp4"
+    file_storage.copy(
+        f"experiment_files/{original_pk_experiment}/video.mp4",
+        f"experiment_files/{experiment.pk}/video.mp4",
     )
+    experiments_changed(request.user.id)
     return JsonResponse({})
 
 
@@ -1549,6 +2435,7 @@ def publish_study(request, pk):
     # Publish all experiments in this study
     for experiment in study.experiments.all():
         _publish_experiment(experiment)
+    experiments_changed(request.user.id)
     return JsonResponse({})
 
 
@@ -1557,6 +2444,7 @@ def delete_study(request, pk):
     """Delete study given by the study identifier pk"""
     study = get_object_or_404(Study, pk=pk, creator=request.user)
     study.delete()
+    experiments_changed(request.user.id)
     return JsonResponse({})
 
 
@@ -1569,7 +2457,10 @@ def disable_study(request, pk):
     # For every group and experiment inside, enable those too
     study.groups.all().update(enabled=False)
     exp_codes = study.groups.all().values_list("experiments__code", flat=True)
-    Experiment.objects.filter(code__in=exp_codes).update(enabled=False)
+    Experiment.objects.filter(code__in=exp_codes).update(
+        enabled=False, config_version=F("config_version") + 1
+    )
+    experiments_changed(request.user.id)
     return JsonResponse({})
 
 
@@ -1582,7 +2473,10 @@ def enable_study(request, pk):
     # For every group and experiment inside, enable those too
     study.groups.all().update(enabled=True)
     exp_codes = study.groups.all().values_list("experiments__code", flat=True)
-    Experiment.objects.filter(code__in=exp_codes).update(enabled=True)
+    Experiment.objects.filter(code__in=exp_codes).update(
+        enabled=True, config_version=F("config_version") + 1
+    )
+    experiments_changed(request.user.id)
     return JsonResponse({})
 
 
@@ -1673,6 +2567,7 @@ def delete_group(request, pk):
     """Deletes a group with the group identifier pk"""
     group = get_object_or_404(Group, pk=pk, creator=request.user)
     group.delete()
+    experiments_changed(request.user.id)
     return JsonResponse({})
 
 
@@ -1683,7 +2578,10 @@ def disable_group(request, pk):
     group.enabled = False
     group.save()
     # For every group and experiment inside, enable those too
-    group.experiments.all().update(enabled=False)
+    group.experiments.all().update(
+        enabled=False, config_version=F("config_version") + 1
+    )
+    experiments_changed(request.user.id)
     return JsonResponse({})
 
 
@@ -1694,5 +2592,6 @@ def enable_group(request, pk):
     group.enabled = True
     group.save()
     # For every group and experiment inside, enable those too
-    group.experiments.all().update(enabled=True)
+    group.experiments.all().update(enabled=True, config_version=F("config_version") + 1)
+    experiments_changed(request.user.id)
     return JsonResponse({})
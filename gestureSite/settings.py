@@ -66,6 +66,8 @@ INSTALLED_APPS = [
 ]
 
 MIDDLEWARE = [
+    # Only used if REQUEST_METRICS is enabled
+    "gestureApp.instrumentation.RequestMetricsMiddleware",
     "whitenoise.middleware.WhiteNoiseMiddleware",
     "django.middleware.security.SecurityMiddleware",
     "django.contrib.sessions.middleware.SessionMiddleware",
@@ -102,6 +104,11 @@ WSGI_APPLICATION = "gestureSite.wsgi.application"
 # Extracts the database from the environment variable
 DATABASES = {"default": env.db()}
 
+# Cache
+# Extracts the cache from the CACHE_URL environment variable (e.g. redis://host:6379/0). The default local memory
+#   cache is not shared between processes, so deployments with more than one process should use a shared cache
+CACHES = {"default": env.cache("CACHE_URL", default="locmemcache://")}
+
 
 # Password validation
 # https://docs.djangoproject.com/en/3.1/ref/settings/#auth-password-validators
@@ -141,6 +148,26 @@ STATICFILES_STORAGE = "whitenoise.storage.CompressedManifestStaticFilesStorage"
 
 CRISPY_TEMPLATE_PACK = "bootstrap4"
 
+# Save the keypresses of each trial packed in the trial, instead of one Keypress row per keypress
+PACKED_KEYPRESSES = env.bool("PACKED_KEYPRESSES", default=False)
+
+# Storage for the experiment files (consent forms and videos) and the processed data files.
+# Available backends, in gestureApp.storage_backends: GoogleCloudStorage, LocalFileSystemStorage and InMemoryStorage
+FILE_STORAGE_BACKEND = env(
+    "FILE_STORAGE_BACKEND", default="gestureApp.storage_backends.GoogleCloudStorage"
+)
+# Google Cloud Storage bucket used by GoogleCloudStorage
+FILE_STORAGE_BUCKET = env("FILE_STORAGE_BUCKET", default="motor-learning")
+# Directory used by LocalFileSystemStorage
+FILE_STORAGE_ROOT = env(
+    "FILE_STORAGE_ROOT", default=os.path.join(BASE_DIR, "file_storage")
+)
+
+# Measure the queries, storage calls and latency of every request (see gestureApp.instrumentation)
+REQUEST_METRICS = env.bool("REQUEST_METRICS", default=False)
+# Requests slower than this number of milliseconds are logged with their most repeated SQL statements
+REQUEST_METRICS_SLOW_MS = env.int("REQUEST_METRICS_SLOW_MS", default=1000)
+
 # Email
 ANYMAIL = {
     "MAILJET_API_KEY": env("MAILJET_API_KEY"),